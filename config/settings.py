@@ -46,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Первым - чтобы в Server-Timing попадали и запросы остальных middleware
+    'quiz.request_metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -61,7 +63,8 @@ ROOT_URLCONF = 'config.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates + замер времени рендера для Server-Timing
+        'BACKEND': 'quiz.request_metrics.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -155,4 +158,75 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 # Google AI API Key (для генерации отчетов)
-GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY', None)
\ No newline at end of file
+GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY', None)
+
+# Кеши:
+# default - локальный кеш процесса (быстрый, у каждого gunicorn-воркера свой)
+# shared  - общий для всех воркеров на машине, здесь храним счетчики версий,
+#           по которым воркеры понимают, что их локальные копии устарели
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('SHARED_CACHE_DIR', os.path.join('/tmp', 'iq_platform_cache')),
+        'TIMEOUT': None,
+    },
+}
+
+# Провайдер ИИ для отчетов: 'gemini' или 'fake' (заглушка для локальных запусков и тестов)
+AI_PROVIDER = os.getenv('AI_PROVIDER', 'gemini')
+# Искусственная задержка ответа заглушки (сек)
+AI_FAKE_DELAY = float(os.getenv('AI_FAKE_DELAY', '0'))
+# Сколько потоков генерации запускает run_report_workers по умолчанию
+AI_REPORT_WORKERS = int(os.getenv('AI_REPORT_WORKERS', '2'))
+# Сколько секунд отчет пользователю ждет страницу результата (стриминг), прежде чем его возьмет воркер
+AI_STREAM_GRACE_SECONDS = int(os.getenv('AI_STREAM_GRACE_SECONDS', '15'))
+# Выбранная модель Gemini кешируется в процессе; перепроверка раз в столько секунд,
+# через AI_MODEL_RETRY_SECONDS, если API не подтвердил модель, и после стольких ошибок подряд
+AI_MODEL_REPROBE_SECONDS = int(os.getenv('AI_MODEL_REPROBE_SECONDS', '3600'))
+AI_MODEL_RETRY_SECONDS = int(os.getenv('AI_MODEL_RETRY_SECONDS', '60'))
+AI_MODEL_MAX_FAILURES = int(os.getenv('AI_MODEL_MAX_FAILURES', '3'))
+# Дедлайн одного вызова ИИ (сек)
+AI_TIMEOUT = float(os.getenv('AI_TIMEOUT', '30'))
+# Бюджет (оценка в токенах) на блок ответов в промпте психологического отчета
+AI_PROMPT_TOKEN_BUDGET = int(os.getenv('AI_PROMPT_TOKEN_BUDGET', '1500'))
+# Ограничение вызовов провайдера ИИ в минуту на процесс (воркеры очереди, generate_reports); 0 - без ограничения
+AI_RATE_LIMIT_PER_MINUTE = int(os.getenv('AI_RATE_LIMIT_PER_MINUTE', '0'))
+# Предохранитель: открывается после стольких ошибок/медленных ответов подряд
+# (медленный - дольше AI_BREAKER_SLOW_SECONDS) и пропускает пробный вызов через AI_BREAKER_COOLDOWN сек
+AI_BREAKER_FAILURES = int(os.getenv('AI_BREAKER_FAILURES', '5'))
+AI_BREAKER_SLOW_SECONDS = float(os.getenv('AI_BREAKER_SLOW_SECONDS', '20'))
+AI_BREAKER_COOLDOWN = float(os.getenv('AI_BREAKER_COOLDOWN', '60'))
+
+# Кеш готовых ИИ-анализов (IQ-тесты с одинаковым профилем результата)
+AI_REPORT_MEMO_SIZE = int(os.getenv('AI_REPORT_MEMO_SIZE', '2048'))            # записей в памяти процесса
+AI_REPORT_CACHE_TTL_DAYS = int(os.getenv('AI_REPORT_CACHE_TTL_DAYS', '30'))    # срок жизни в БД
+AI_REPORT_CACHE_MAX_ROWS = int(os.getenv('AI_REPORT_CACHE_MAX_ROWS', '100000'))  # максимум строк в БД
+
+# Telegram-бот
+# Адрес Bot API (пусто - официальный api.telegram.org; можно указать локальный/фейковый сервер)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '')
+# Размер пула HTTP-соединений бота в одном воркере
+TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', '20'))
+# Очереди обновлений вебхука: число воркеров, размер каждой очереди, сколько update_id помнить для дедупликации
+TELEGRAM_WORKERS = int(os.getenv('TELEGRAM_WORKERS', '4'))
+TELEGRAM_QUEUE_SIZE = int(os.getenv('TELEGRAM_QUEUE_SIZE', '100'))
+TELEGRAM_DEDUPE_SIZE = int(os.getenv('TELEGRAM_DEDUPE_SIZE', '10000'))
+# Кеш "chat_id -> пользователь" в памяти воркера: срок жизни (сек) и размер
+TELEGRAM_USER_CACHE_TTL = int(os.getenv('TELEGRAM_USER_CACHE_TTL', '300'))
+TELEGRAM_USER_CACHE_SIZE = int(os.getenv('TELEGRAM_USER_CACHE_SIZE', '10000'))
+
+# Метрики запросов (Server-Timing, гистограммы в ops/requests/)
+REQUEST_METRICS_ENABLED = os.getenv('REQUEST_METRICS_ENABLED', '1') == '1'
+# Доля запросов, у которых собираются тексты SQL (0 - выключено)
+REQUEST_METRICS_SAMPLE_RATE = float(os.getenv('REQUEST_METRICS_SAMPLE_RATE', '0'))
+# Сэмплированный запрос дольше этого (мс) пишется в лог с самыми частыми SQL
+REQUEST_METRICS_SLOW_MS = int(os.getenv('REQUEST_METRICS_SLOW_MS', '500'))
+
+# Процентили результатов (гистограммы ScoreHistogram, см. quiz/score_stats.py)
+# Сколько секунд процесс держит распределение баллов теста в памяти
+SCORE_PERCENTILE_TTL = int(os.getenv('SCORE_PERCENTILE_TTL', '60'))
+# Процентиль не показываем, пока результатов теста меньше этого
+SCORE_PERCENTILE_MIN_RESULTS = int(os.getenv('SCORE_PERCENTILE_MIN_RESULTS', '10'))
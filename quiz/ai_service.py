@@ -1,6 +1,317 @@
 import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 import google.generativeai as genai
 from django.conf import settings
+from django.utils import timezone
+from . import report_cache
+from .circuit_breaker import CircuitBreaker
+from .prompt_builder import build_answers_context
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """
+    Заглушка вместо Gemini (AI_PROVIDER=fake) для локальных запусков и тестов.
+    Отвечает детерминированным текстом после задержки AI_FAKE_DELAY секунд.
+    """
+    def __init__(self, delay=None):
+        self.delay = getattr(settings, 'AI_FAKE_DELAY', 0) if delay is None else delay
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        if self.delay:
+            time.sleep(self.delay)
+        text = f"[FAKE AI] {prompt[:300]}"
+        if stream:
+            # Как у Gemini: итератор ответов с кусками текста
+            return (FakeResponse(text[i:i + 16]) for i in range(0, len(text), 16))
+        return FakeResponse(text)
+
+
+# Модели по порядку предпочтения
+MODEL_NAMES = [
+    'gemini-2.5-flash',         # Рекомендуемая модель
+    'gemini-1.5-flash',         # Стабильная версия flash
+    'gemini-1.5-pro',            # Стабильная версия pro
+    'gemini-pro',                # Стабильная версия pro (старое имя)
+    'gemini-1.0-pro',           # Альтернатива
+]
+# Таймаут одного сетевого запроса при проверке модели (сек)
+PROBE_TIMEOUT = 10
+# Максимум одновременных вызовов generate_content в процессе
+CALL_THREADS = 32
+
+
+class ModelRegistry:
+    """
+    Модель Gemini одна на процесс.
+
+    Раньше каждый отчет вызывал genai.configure и перебирал model_names, а при
+    ошибке - genai.list_models() прямо в запросе пользователя. Теперь рабочая
+    модель выбирается один раз (при первом обращении или warm_up() на старте
+    воркера) и дальше get() сразу возвращает готовый объект. Перепроверка
+    идет в фоновом потоке: раз в AI_MODEL_REPROBE_SECONDS или после
+    AI_MODEL_MAX_FAILURES ошибок генерации подряд.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._model = None
+        self._model_name = None
+        self._verified = False
+        self._configured_key = None
+        self._probed_at = None      # time.monotonic() последней проверки
+        self._probing = False
+        self._failures = 0
+        self._stats = {'probes': 0, 'probe_ms': None, 'last_error': '', 'probed_at': None}
+
+    def _api_key(self):
+        # Пробуем получить API ключ из разных источников
+        return getattr(settings, "GOOGLE_API_KEY", None) or os.getenv('GOOGLE_API_KEY')
+
+    def get(self):
+        """Модель с методом generate_content или None, если ИИ недоступен."""
+        if getattr(settings, 'AI_PROVIDER', 'gemini') == 'fake':
+            return FakeGenerativeModel()
+
+        model = self._model
+        if model is None:
+            with self._lock:
+                # Проверяет только первый поток, остальные ждут его результат
+                if self._model is None and self._probe_due():
+                    self._probe()
+                model = self._model
+        elif self._probe_due() or self._failures >= settings.AI_MODEL_MAX_FAILURES:
+            self._reprobe_in_background()
+        return model
+
+    def _probe_due(self):
+        if self._probed_at is None:
+            return True
+        # Без подтвержденной модели (сеть/ключ) перепроверяем чаще
+        interval = settings.AI_MODEL_REPROBE_SECONDS if self._verified else settings.AI_MODEL_RETRY_SECONDS
+        return time.monotonic() - self._probed_at >= interval
+
+    def warm_up(self):
+        """Выбрать модель заранее (на старте воркера), а не в первом запросе."""
+        return self.get()
+
+    def report_success(self):
+        self._failures = 0
+
+    def report_failure(self, error):
+        self._failures += 1
+        self._stats['last_error'] = f"{type(error).__name__}: {str(error)[:200]}"
+        if self._failures >= settings.AI_MODEL_MAX_FAILURES:
+            self._reprobe_in_background()
+
+    def _reprobe_in_background(self):
+        with self._lock:
+            if self._probing:
+                return
+            self._probing = True
+        threading.Thread(target=self._background_probe, name='ai-model-probe', daemon=True).start()
+
+    def _background_probe(self):
+        try:
+            with self._lock:
+                self._probe()
+        finally:
+            self._probing = False
+
+    def _probe(self):
+        """Выбирает модель. Вызывается под self._lock."""
+        started = time.perf_counter()
+        self._stats['probes'] += 1
+        self._probed_at = time.monotonic()
+        self._stats['probed_at'] = timezone.now().isoformat(timespec='seconds')
+
+        api_key = self._api_key()
+        if not api_key:
+            print("[WARNING] GOOGLE_API_KEY not found, using fallback text")
+            self._set_model(None, None, False)
+            return
+        if api_key != self._configured_key:
+            genai.configure(api_key=api_key)
+            self._configured_key = api_key
+
+        name, verified = self._find_model_name()
+        self._set_model(genai.GenerativeModel(name), name, verified)
+        self._failures = 0
+        self._stats['probe_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        print(f"[OK] AI model: {name} (verified={verified}, probe {self._stats['probe_ms']} ms)")
+
+    def _find_model_name(self):
+        """(имя модели, подтверждена ли она API)."""
+        options = {'timeout': PROBE_TIMEOUT}
+        for m_name in MODEL_NAMES:
+            try:
+                info = genai.get_model(f'models/{m_name}', request_options=options)
+                if 'generateContent' in info.supported_generation_methods:
+                    return m_name, True
+            except Exception as e:
+                self._stats['last_error'] = f"{m_name}: {str(e)[:200]}"
+                print(f"[WARNING] Model {m_name} failed: {str(e)[:150]}")
+
+        try:
+            available_models = [m.name for m in genai.list_models(request_options=options)
+                                if 'generateContent' in m.supported_generation_methods]
+            print(f"[INFO] Available models: {available_models[:5]}")  # Показываем первые 5
+            if available_models:
+                # Используем первую доступную модель
+                return available_models[0].split('/')[-1], True
+        except Exception as list_error:
+            self._stats['last_error'] = f"list_models: {str(list_error)[:200]}"
+            print(f"[ERROR] Could not list models: {str(list_error)[:150]}")
+
+        # API не ответил (сеть?) - работаем с основной моделью без проверки, повторим позже
+        return MODEL_NAMES[0], False
+
+    def _set_model(self, model, name, verified):
+        self._model = model
+        self._model_name = name
+        self._verified = verified
+
+    def reset(self):
+        with self._lock:
+            self._set_model(None, None, False)
+            self._configured_key = None
+            self._probed_at = None
+            self._failures = 0
+
+    def stats(self):
+        data = dict(self._stats)
+        data.update({
+            'provider': getattr(settings, 'AI_PROVIDER', 'gemini'),
+            'model': self._model_name,
+            'verified': self._verified,
+            'consecutive_failures': self._failures,
+            'probing': self._probing,
+        })
+        return data
+
+
+model_registry = ModelRegistry()
+breaker = CircuitBreaker(
+    failure_threshold=settings.AI_BREAKER_FAILURES,
+    cooldown=settings.AI_BREAKER_COOLDOWN,
+    slow_call_seconds=settings.AI_BREAKER_SLOW_SECONDS,
+)
+_stats_lock = threading.Lock()
+_generation_stats = {'reports': 0, 'streamed': 0, 'ai': 0, 'fallbacks': 0}
+
+
+def get_model():
+    """
+    Возвращает модель с методом generate_content или None, если ИИ недоступен.
+    """
+    return model_registry.get()
+
+
+class AIDeadlineExceeded(Exception):
+    pass
+
+
+class AIPoolBusy(Exception):
+    """Все потоки _call_pool заняты дольше AI_TIMEOUT - вызов так и не начался."""
+
+
+# Потоки для вызовов с дедлайном (зависший вызов занимает поток, но не воркер)
+_call_pool = ThreadPoolExecutor(max_workers=CALL_THREADS, thread_name_prefix='ai-call')
+
+
+def _request_options(timeout):
+    # Таймаут транспорта освобождает поток пула, даже если провайдер завис.
+    # Повторы клиента выключены: каждый повтор получил бы свой таймаут заново,
+    # а повторяем мы сами (очередь задач, предохранитель)
+    return {'timeout': timeout, 'retry': None}
+
+
+def _submit(fn, timeout):
+    """
+    Запускает fn в _call_pool и ждет, пока вызов реально начнется. Ожидание
+    свободного потока - не задержка провайдера: дедлайн и время для
+    предохранителя считаются от старта. Возвращает (future, момент старта).
+    """
+    started = {}
+    ready = threading.Event()
+
+    def run():
+        started['at'] = time.monotonic()
+        ready.set()
+        return fn()
+
+    future = _call_pool.submit(run)
+    if not ready.wait(timeout) and future.cancel():
+        raise AIPoolBusy(f"No free AI call thread for {timeout}s")
+    ready.wait()
+    return future, started['at']
+
+
+def _call_with_deadline(model, prompt):
+    """
+    generate_content не дольше AI_TIMEOUT секунд от начала вызова. Таймаут
+    передается клиенту (request_options) - он закрывает соединение и
+    освобождает поток; ожидание future - страховка, если клиент его не соблюдет.
+    Возвращает (ответ, длительность вызова в секундах).
+    """
+    timeout = settings.AI_TIMEOUT
+    future, started = _submit(
+        lambda: model.generate_content(prompt, request_options=_request_options(timeout)), timeout,
+    )
+    try:
+        response = future.result(timeout=max(0.0, started + timeout - time.monotonic()))
+    except FutureTimeout:
+        raise AIDeadlineExceeded(f"AI call exceeded {timeout}s deadline")
+    return response, time.monotonic() - started
+
+
+def _stream_with_deadline(model, prompt, timing):
+    """
+    Куски текста generate_content(stream=True). Поток читает ответ в отдельном
+    потоке пула, поэтому весь ответ укладывается в AI_TIMEOUT от начала вызова,
+    даже если соединение зависло посреди ответа. В timing['started'] - момент старта вызова.
+    """
+    timeout = settings.AI_TIMEOUT
+    chunks = queue.Queue()
+    stop = threading.Event()
+
+    def pump():
+        if stop.is_set():
+            return
+        try:
+            for part in model.generate_content(prompt, stream=True, request_options=_request_options(timeout)):
+                if stop.is_set():
+                    return
+                chunks.put(('chunk', part.text))
+            chunks.put(('end', None))
+        except Exception as e:
+            chunks.put(('error', e))
+
+    try:
+        _, timing['started'] = _submit(pump, timeout)
+        deadline = timing['started'] + timeout
+        while True:
+            try:
+                kind, value = chunks.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                raise AIDeadlineExceeded(f"AI stream exceeded {timeout}s deadline")
+            if kind == 'end':
+                return
+            if kind == 'error':
+                raise value
+            if value:
+                yield value
+    finally:
+        # Клиент ушел или дедлайн - поток пула бросает ответ на следующем куске
+        stop.set()
+
 
 def generate_test_report(user_name, category_stats, total_score, test_type='iq', language='ru', detailed_answers=None, total_questions=0, analysis_for='user'):
     """
@@ -9,8 +320,59 @@ def generate_test_report(user_name, category_stats, total_score, test_type='iq',
     detailed_answers: список словарей с детальной информацией об ответах (для психологических тестов)
     total_questions: общее количество вопросов
     analysis_for: 'recruiter' (для рекрутера - оценка кандидата) или 'user' (для пользователя - самопознание)
+
+    IQ-отчеты кешируются по профилю результата (report_cache.py): одинаковые
+    профили не вызывают Gemini повторно.
     """
-    
+    text, _ = generate_report(user_name, category_stats, total_score, test_type, language,
+                              detailed_answers, total_questions, analysis_for)
+    return text
+
+
+def generate_report(user_name, category_stats, total_score, test_type='iq', language='ru', detailed_answers=None, total_questions=0, analysis_for='user'):
+    """Как generate_test_report, но возвращает (текст, True если его написал ИИ или он из кеша)."""
+    if test_type == 'psychology':
+        # Психологический отчет строится по конкретным ответам - не кешируем
+        return generate_report_uncached(user_name, category_stats, total_score, test_type, language,
+                                        detailed_answers, total_questions, analysis_for)
+
+    key = report_cache.make_key(test_type, language, analysis_for, total_score, total_questions, category_stats)
+    cached = report_cache.lookup(key)
+    if cached is not None:
+        return report_cache.personalize(cached, user_name), True
+
+    text, from_ai = generate_report_uncached(report_cache.NAME_PLACEHOLDER, category_stats, total_score, test_type,
+                                             language, detailed_answers, total_questions, analysis_for)
+    if from_ai:
+        report_cache.store(key, text)
+    return report_cache.personalize(text, user_name), from_ai
+
+
+def generate_report_uncached(user_name, category_stats, total_score, test_type='iq', language='ru', detailed_answers=None, total_questions=0, analysis_for='user'):
+    """
+    Генерация без кеша. Возвращает (текст, True) если текст написал ИИ,
+    или (заглушка, False).
+    """
+    text, from_ai = _generate_report(user_name, category_stats, total_score, test_type, language,
+                                     detailed_answers, total_questions, analysis_for)
+    with _stats_lock:
+        _generation_stats['reports'] += 1
+        _generation_stats['ai' if from_ai else 'fallbacks'] += 1
+    return text, from_ai
+
+
+def generation_stats():
+    """Сколько отчетов этого процесса написал ИИ, а сколько ушло в заглушку."""
+    with _stats_lock:
+        data = dict(_generation_stats)
+    data['fallback_rate'] = round(data['fallbacks'] / data['reports'], 3) if data['reports'] else 0.0
+    data['breaker'] = breaker.stats()
+    return data
+
+
+def _prepare_report(user_name, category_stats, total_score, test_type, language, detailed_answers, total_questions, analysis_for):
+    """(заглушка, модель, промпт). Модель None - ИИ сейчас не вызываем, отдаем заглушку."""
+
     # --- 1. ЗАГОТОВКИ НА СЛУЧАЙ ОШИБКИ ИИ (Fallback) ---
     local_texts = {
         'iq': {
@@ -40,122 +402,28 @@ def generate_test_report(user_name, category_stats, total_score, test_type='iq',
     else:
         fallback_text = local_texts.get(test_type, local_texts['iq']).get(language, local_texts['iq']['ru'])
 
-    # Пробуем получить API ключ из разных источников
-    api_key = getattr(settings, "GOOGLE_API_KEY", None) or os.getenv('GOOGLE_API_KEY')
-    if not api_key:
-        try:
-            print(f"[WARNING] GOOGLE_API_KEY not found, using fallback text. test_type={test_type}, analysis_for={analysis_for}")
-        except UnicodeEncodeError:
-            print(f"[WARNING] GOOGLE_API_KEY not found, using fallback text")
-        return fallback_text
-    
-    try:
-        print(f"[OK] API Key found (length: {len(api_key)}), generating report for {test_type} test, analysis_for={analysis_for}")
-    except UnicodeEncodeError:
-        print(f"[OK] API Key found, generating report for {test_type} test")
+    # Провайдер недавно падал или тормозил - сразу заглушка, не держим воркер
+    if not breaker.allow():
+        print("[WARNING] AI circuit breaker is open, using fallback text")
+        return fallback_text, None, None
 
-    genai.configure(api_key=api_key)
-    
-    # Выбираем модель (пробуем по очереди доступные модели)
-    model = None
-    model_names = [
-        'gemini-2.5-flash',         # Рекомендуемая модель
-        'gemini-1.5-flash',         # Стабильная версия flash
-        'gemini-1.5-pro',            # Стабильная версия pro
-        'gemini-pro',                # Стабильная версия pro (старое имя)
-        'gemini-1.0-pro',           # Альтернатива
-    ]
-    
-    last_error = None
-    for m_name in model_names:
-        try:
-            try:
-                print(f"[INFO] Trying model: {m_name}")
-            except UnicodeEncodeError:
-                print(f"[INFO] Trying model: {m_name}")
-            model = genai.GenerativeModel(m_name)
-            # Проверяем, что модель доступна, делая тестовый запрос (необязательно, но полезно)
-            try:
-                print(f"[OK] Model {m_name} initialized successfully")
-            except UnicodeEncodeError:
-                print(f"[OK] Model {m_name} initialized")
-            break
-        except Exception as e:
-            last_error = str(e)
-            try:
-                print(f"[WARNING] Model {m_name} failed: {str(e)[:150]}")
-            except UnicodeEncodeError:
-                print(f"[WARNING] Model {m_name} failed")
-            continue
-            
+    model = get_model()
     if not model:
-        try:
-            print(f"[ERROR] No available models found. Last error: {last_error[:200] if last_error else 'Unknown'}")
-            print("[INFO] Trying to list available models...")
-            try:
-                available_models = [m.name for m in genai.list_models() 
-                                  if 'generateContent' in m.supported_generation_methods]
-                print(f"[INFO] Available models: {available_models[:5]}")  # Показываем первые 5
-                if available_models:
-                    # Пробуем использовать первую доступную модель
-                    model_name = available_models[0].split('/')[-1]
-                    print(f"[INFO] Trying first available model: {model_name}")
-                    model = genai.GenerativeModel(model_name)
-                    print(f"[OK] Using model: {model_name}")
-            except Exception as list_error:
-                print(f"[ERROR] Could not list models: {str(list_error)[:150]}")
-        except UnicodeEncodeError:
-            print("[ERROR] No available models found")
-        
-        if not model:
-            return fallback_text
+        # Вызова не было - освобождаем пробный слот предохранителя
+        breaker.release()
+        return fallback_text, None, None
 
     # --- 2. ФОРМИРОВАНИЕ ПРОМПТА (ЗАПРОСА К ИИ) ---
     
     # >> ЛОГИКА ДЛЯ ПСИХОЛОГИИ <<
     if test_type == 'psychology':
-        # Формируем детальную информацию об ответах для анализа
-        answers_context = ""
+        # Компактный блок ответов в пределах бюджета токенов (prompt_builder.py)
+        context = build_answers_context(detailed_answers, language, settings.AI_PROMPT_TOKEN_BUDGET)
+        answers_context = context.text
         if detailed_answers:
-            # Выбираем заголовки в зависимости от языка
-            headers = {
-                'ru': {
-                    'title': 'Детальные ответы кандидата:',
-                    'question': 'Вопрос:',
-                    'selected': 'Выбранный ответ:',
-                    'correct': 'Правильный ответ:',
-                    'result_ok': '✓ Правильно',
-                    'result_fail': '✗ Неправильно'
-                },
-                'kk': {
-                    'title': 'Кандидаттың толық жауаптары:',
-                    'question': 'Сұрақ:',
-                    'selected': 'Таңдалған жауап:',
-                    'correct': 'Дұрыс жауап:',
-                    'result_ok': '✓ Дұрыс',
-                    'result_fail': '✗ Дұрыс емес'
-                },
-                'en': {
-                    'title': 'Detailed candidate answers:',
-                    'question': 'Question:',
-                    'selected': 'Selected answer:',
-                    'correct': 'Correct answer:',
-                    'result_ok': '✓ Correct',
-                    'result_fail': '✗ Incorrect'
-                }
-            }
-            h = headers.get(language, headers['ru'])
-            
-            answers_context = f"\n\n{h['title']}\n"
-            for idx, answer_data in enumerate(detailed_answers, 1):
-                answers_context += f"\n{idx}. {h['question']} {answer_data['question_text']}\n"
-                answers_context += f"   {h['selected']} {answer_data['selected_answer_text']}\n"
-                answers_context += f"   {h['correct']} {answer_data['correct_answer_text']}\n"
-                result_text = h['result_ok'] if answer_data['is_correct'] else h['result_fail']
-                # Используем правильный язык для "Результат"
-                result_label = {'ru': 'Результат:', 'kk': 'Нәтиже:', 'en': 'Result:'}.get(language, 'Результат:')
-                answers_context += f"   {result_label} {result_text}\n"
-        
+            print(f"[INFO] Answers context: ~{context.tokens_before} -> ~{context.tokens_after} tokens "
+                  f"(budget {settings.AI_PROMPT_TOKEN_BUDGET}, not shown: {context.dropped})")
+
         # Разные промпты для рекрутера и пользователя
         if analysis_for == 'recruiter':
             # ПРОМПТ ДЛЯ РЕКРУТЕРА (оценка кандидата)
@@ -268,40 +536,117 @@ def generate_test_report(user_name, category_stats, total_score, test_type='iq',
                 f"Дай рекомендацию по развитию. Ответ на русском языке."
             )
 
+    return fallback_text, model, prompt
+
+
+def _generate_report(user_name, category_stats, total_score, test_type, language, detailed_answers, total_questions, analysis_for):
+    fallback_text, model, prompt = _prepare_report(user_name, category_stats, total_score, test_type, language,
+                                                   detailed_answers, total_questions, analysis_for)
+    if model is None:
+        return fallback_text, False
+
     # --- 3. ГЕНЕРАЦИЯ ---
     try:
-        if not model:
-            print("[ERROR] Model is None, cannot generate content")
-            return fallback_text
-            
         try:
             print(f"[INFO] Prompt length: {len(prompt)} characters")
             print(f"[INFO] Prompt preview (first 200 chars): {prompt[:200]}...")
         except UnicodeEncodeError:
             print(f"[INFO] Prompt length: {len(prompt)} characters")
         
-        response = model.generate_content(prompt)
+        response, duration = _call_with_deadline(model, prompt)
+        breaker.record_success(duration)
+        model_registry.report_success()
         
         if not response or not hasattr(response, 'text'):
             print("[ERROR] Invalid response from model")
-            return fallback_text
+            return fallback_text, False
             
         result_text = response.text
         
         if not result_text or len(result_text.strip()) == 0:
             print("[WARNING] Empty response from AI, using fallback")
-            return fallback_text
+            return fallback_text, False
             
         try:
             print(f"[OK] AI Response received, length: {len(result_text)} characters")
         except UnicodeEncodeError:
             print(f"[OK] AI Response received, length: {len(result_text)} characters")
-        return result_text
+        return result_text, True
+    except AIPoolBusy as e:
+        # Провайдер тут ни при чем - вызов просто не начался
+        breaker.release()
+        print(f"[WARNING] {e}, using fallback")
+        return fallback_text, False
     except Exception as e:
+        breaker.record_failure(timeout=isinstance(e, AIDeadlineExceeded))
+        model_registry.report_failure(e)
         try:
             print(f"[ERROR] AI Generation Error: {type(e).__name__}: {str(e)[:200]}")
             import traceback
             traceback.print_exc()
         except UnicodeEncodeError:
             print(f"[ERROR] AI Generation Error occurred")
-        return fallback_text
\ No newline at end of file
+        return fallback_text, False
+
+
+def _stream_report(outcome, user_name, category_stats, total_score, test_type, language, detailed_answers, total_questions, analysis_for):
+    """
+    Как _generate_report, но отдает текст кусками по мере генерации.
+    В outcome кладет 'parts' (все отданные куски) и 'from_ai'. Если ИИ упал
+    после первого куска, исключение пробрасывается - показанный текст неполный.
+    """
+    outcome['parts'] = parts = []
+    outcome['from_ai'] = False
+    fallback_text, model, prompt = _prepare_report(user_name, category_stats, total_score, test_type, language,
+                                                   detailed_answers, total_questions, analysis_for)
+    if model is not None:
+        timing = {}
+        try:
+            for chunk in _stream_with_deadline(model, prompt, timing):
+                if not parts:
+                    # Для предохранителя важно время до первого куска, а не длина всего ответа
+                    breaker.record_success(time.monotonic() - timing['started'])
+                    model_registry.report_success()
+                parts.append(chunk)
+                yield chunk
+            outcome['from_ai'] = bool(parts)
+        except AIPoolBusy as e:
+            breaker.release()
+            print(f"[WARNING] {e}, using fallback")
+        except Exception as e:
+            if not parts:
+                breaker.record_failure(timeout=isinstance(e, AIDeadlineExceeded))
+            model_registry.report_failure(e)
+            print(f"[ERROR] AI Streaming Error: {type(e).__name__}: {str(e)[:200]}")
+            if parts:
+                raise
+
+    if not parts:
+        parts.append(fallback_text)
+        yield fallback_text
+    with _stats_lock:
+        _generation_stats['reports'] += 1
+        _generation_stats['streamed'] += 1
+        _generation_stats['ai' if outcome['from_ai'] else 'fallbacks'] += 1
+
+
+def stream_test_report(user_name, category_stats, total_score, test_type='iq', language='ru', detailed_answers=None, total_questions=0, analysis_for='user'):
+    """
+    Потоковая версия generate_test_report: генератор кусков текста,
+    склеенные куски - итоговый отчет. IQ-отчеты так же берутся из кеша и кладутся в него.
+    """
+    args = (category_stats, total_score, test_type, language, detailed_answers, total_questions, analysis_for)
+    outcome = {}
+    if test_type == 'psychology':
+        yield from _stream_report(outcome, user_name, *args)
+        return
+
+    key = report_cache.make_key(test_type, language, analysis_for, total_score, total_questions, category_stats)
+    cached = report_cache.lookup(key)
+    if cached is not None:
+        yield report_cache.personalize(cached, user_name)
+        return
+
+    yield from report_cache.personalize_stream(_stream_report(outcome, report_cache.NAME_PLACEHOLDER, *args), user_name)
+    if outcome['from_ai']:
+        report_cache.store(key, ''.join(outcome['parts']))
@@ -0,0 +1,149 @@
+"""
+Состояние прохождения теста (TestAttempt вместо ключей в сессии).
+
+Раньше прогресс жил в четырех ключах сессии (test_{id}_order/index/answers/locked),
+и каждый клик перезаписывал в django_session весь сериализованный blob.
+Теперь у попытки своя маленькая строка, и каждый шаг обновляет только
+изменившиеся колонки. Попытка вошедшего пользователя привязана к нему,
+поэтому ее можно продолжить после выхода или с другого устройства.
+
+Порядок вопросов и вариантов ответа не хранится: он детерминированно
+выводится из seed попытки и отпечатка содержимого теста (TestBlueprint.fingerprint,
+в него входит и questions_count - от него зависит длина ответов попытки).
+Поэтому варианты не перемешиваются заново при обновлении страницы, а в
+состоянии остается только seed и по байту на ответ.
+"""
+import random
+import secrets
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from .models import TestAttempt
+
+
+def question_order(test, seed):
+    """id вопросов попытки: перестановка (и, если задано, выборка questions_count) из seed."""
+    order = list(test.question_ids)
+    random.Random(f'{seed}:{test.fingerprint}').shuffle(order)
+    # Обрезаем, если в настройках теста задано ограничение количества
+    if test.questions_count > 0 and len(order) > test.questions_count:
+        order = order[:test.questions_count]
+    return order
+
+
+def answer_order(question, seed):
+    """Варианты ответа вопроса в порядке показа - одинаковом при каждом обновлении страницы."""
+    answers = list(question.answers)
+    random.Random(f'{seed}:{question.id}').shuffle(answers)
+    return answers
+
+
+class AttemptState:
+    """Распакованная попытка: изменения копятся в памяти и пишутся одним UPDATE в save()."""
+
+    def __init__(self, attempt, test):
+        self.attempt = attempt
+        self.test = test
+        self.seed = attempt.seed
+        self.question_ids = question_order(test, attempt.seed)
+        self._answers = bytearray(bytes(attempt.answers or b''))
+        self._locked = bytearray(bytes(attempt.locked_steps or b''))
+        self.current_index = attempt.current_index
+        self._dirty = set()
+
+    def _question(self, index):
+        return self.test.questions[self.question_ids[index]]
+
+    def answer_for(self, index):
+        """id выбранного ответа на шаге index (или None)."""
+        position = self._answers[index]
+        return self._question(index).answers[position - 1].id if position else None
+
+    def set_answer(self, index, answer_id):
+        """Запоминает ответ; False, если такого варианта у вопроса нет."""
+        answers = self._question(index).answers
+        position = next((i + 1 for i, a in enumerate(answers) if a.id == answer_id), 0)
+        if not position or position > 255:
+            return False
+        if self._answers[index] != position:
+            self._answers[index] = position
+            self._dirty.add('answers')
+        return True
+
+    def is_locked(self, index):
+        return bool(self._locked[index // 8] & (1 << (index % 8)))
+
+    def lock(self, index):
+        if not self.is_locked(index):
+            self._locked[index // 8] |= 1 << (index % 8)
+            self._dirty.add('locked_steps')
+
+    def move_to(self, index):
+        if self.current_index != index:
+            self.current_index = index
+            self._dirty.add('current_index')
+
+    def saved_answers(self):
+        """Ответы в формате finish_test / score_attempt: {"<id вопроса>": id ответа}."""
+        return {
+            str(q_id): self.answer_for(index)
+            for index, q_id in enumerate(self.question_ids)
+            if self._answers[index]
+        }
+
+    def save(self):
+        if not self._dirty:
+            return
+        values = {'updated_at': timezone.now()}
+        if 'answers' in self._dirty:
+            values['answers'] = bytes(self._answers)
+        if 'locked_steps' in self._dirty:
+            values['locked_steps'] = bytes(self._locked)
+        if 'current_index' in self._dirty:
+            values['current_index'] = self.current_index
+        TestAttempt.objects.filter(pk=self.attempt.pk).update(**values)
+        self._dirty.clear()
+
+    def delete(self):
+        TestAttempt.objects.filter(pk=self.attempt.pk).delete()
+
+
+def _owner(request):
+    if request.user.is_authenticated:
+        return {'user': request.user}
+    if not request.session.session_key:
+        # Гостю (кандидату по приглашению) нужен ключ сессии, чтобы найти попытку
+        request.session.save()
+    return {'session_key': request.session.session_key}
+
+
+def _start(test, owner):
+    steps = len(question_order(test, 0))
+    attempt = TestAttempt(
+        test_id=test.id,
+        seed=secrets.randbits(63),
+        content_fingerprint=test.fingerprint,
+        answers=bytes(steps),
+        locked_steps=bytes((steps + 7) // 8),
+        current_index=0,
+        **owner,
+    )
+    try:
+        with transaction.atomic():
+            attempt.save()
+    except IntegrityError:
+        # Параллельный запрос (двойной клик) уже создал попытку
+        attempt = TestAttempt.objects.get(test_id=test.id, **owner)
+    return attempt
+
+
+def load_attempt(request, test):
+    """Текущая попытка пользователя (или гостя) для теста; создает новую при первом заходе."""
+    owner = _owner(request)
+    attempt = TestAttempt.objects.filter(test_id=test.id, **owner).first()
+    if attempt is not None and attempt.content_fingerprint != test.fingerprint:
+        # Вопросы теста (или их число) изменились - прежний порядок уже не восстановить, начинаем заново
+        TestAttempt.objects.filter(pk=attempt.pk).delete()
+        attempt = None
+    if attempt is None:
+        attempt = _start(test, owner)
+    return AttemptState(attempt, test)
@@ -0,0 +1,181 @@
+"""
+Кеш "чертежей" тестов в памяти процесса.
+
+Тест вместе с вопросами и ответами меняется редко, а читается на каждом
+шаге прохождения. Поэтому держим его в виде компактных неизменяемых
+объектов сразу со всеми переводами (ru/kk/en) и пересобираем только
+когда меняется общая версия содержимого (см. versioning.py).
+"""
+import hashlib
+import threading
+from dataclasses import dataclass
+from types import MappingProxyType
+from django.db.models import Prefetch
+from django.utils.translation import get_language
+from .models import Test, Question, Answer, CATEGORY_CHOICES
+from .versioning import CONTENT_VERSION, get_version
+
+CATEGORY_NAMES = dict(CATEGORY_CHOICES)
+
+
+def is_psychology_category(category):
+    cat_code = (category or '').lower()
+    return 'psychology' in cat_code or 'психология' in cat_code
+
+
+def _translated(obj, field):
+    """Аналог поведения modeltranslation: текущий язык, иначе русский."""
+    lang = (get_language() or 'ru')[:2]
+    return getattr(obj, f'{field}_{lang}', '') or getattr(obj, f'{field}_ru', '')
+
+
+@dataclass(frozen=True, slots=True)
+class AnswerBlueprint:
+    id: int
+    is_correct: bool
+    text_ru: str
+    text_kk: str
+    text_en: str
+
+    @property
+    def text(self):
+        return _translated(self, 'text')
+
+
+@dataclass(frozen=True, slots=True)
+class QuestionBlueprint:
+    id: int
+    category: str
+    order: int
+    exposure_time: int
+    answer_time: int
+    image_url: str
+    text_ru: str
+    text_kk: str
+    text_en: str
+    answers: tuple
+
+    @property
+    def text(self):
+        return _translated(self, 'text')
+
+    def get_category_display(self):
+        return CATEGORY_NAMES.get(self.category, self.category)
+
+
+@dataclass(frozen=True, slots=True)
+class TestBlueprint:
+    id: int
+    title_ru: str
+    title_kk: str
+    title_en: str
+    description_ru: str
+    description_kk: str
+    description_en: str
+    questions_count: int
+    time_limit: int
+    test_audience: str
+    # id вопроса -> QuestionBlueprint (только чтение)
+    questions: MappingProxyType
+    # id вопросов в порядке (order, id)
+    question_ids: tuple
+    # Отпечаток набора вопросов и ответов (id) и questions_count: от него
+    # зависят порядок и число шагов в попытке
+    fingerprint: int
+
+    @property
+    def title(self):
+        return _translated(self, 'title')
+
+    @property
+    def description(self):
+        return _translated(self, 'description')
+
+    @property
+    def test_type(self):
+        """'psychology', если в тесте есть такие вопросы или это видно из названия, иначе 'iq'."""
+        if any(is_psychology_category(q.category) for q in self.questions.values()):
+            return 'psychology'
+        if 'psychology' in self.title_en.lower() or 'психология' in self.title_ru.lower():
+            return 'psychology'
+        return 'iq'
+
+
+def _texts(obj, field):
+    return {f'{field}_{lang}': getattr(obj, f'{field}_{lang}', None) or '' for lang in ('ru', 'kk', 'en')}
+
+
+def _fingerprint(question_map, questions_count):
+    digest = hashlib.blake2b(digest_size=8)
+    # Число шагов попытки: иначе после правки questions_count ее ответы короче порядка вопросов
+    digest.update(f'n{questions_count};'.encode())
+    for q_id, question in question_map.items():
+        digest.update(f'{q_id}:{",".join(str(a.id) for a in question.answers)};'.encode())
+    # Знаковое 64-битное число - помещается в BigIntegerField
+    return int.from_bytes(digest.digest(), 'big', signed=True)
+
+
+def _build(test_id):
+    test = Test.objects.filter(pk=test_id).first()
+    if test is None:
+        return None
+
+    questions = (
+        Question.objects.filter(test_id=test_id)
+        .order_by('order', 'id')
+        .prefetch_related(Prefetch('answers', queryset=Answer.objects.order_by('id')))
+    )
+
+    question_map = {}
+    for q in questions:
+        answers = tuple(
+            AnswerBlueprint(id=a.id, is_correct=a.is_correct, **_texts(a, 'text'))
+            for a in q.answers.all()
+        )
+        question_map[q.id] = QuestionBlueprint(
+            id=q.id,
+            category=q.category or '',
+            order=q.order,
+            exposure_time=q.exposure_time,
+            answer_time=q.answer_time,
+            image_url=q.image.url if q.image else '',
+            answers=answers,
+            **_texts(q, 'text'),
+        )
+
+    return TestBlueprint(
+        id=test.id,
+        fingerprint=_fingerprint(question_map, test.questions_count),
+        questions_count=test.questions_count,
+        time_limit=test.time_limit,
+        test_audience=test.test_audience,
+        questions=MappingProxyType(question_map),
+        question_ids=tuple(question_map),
+        **_texts(test, 'title'),
+        **_texts(test, 'description'),
+    )
+
+
+# Локальный кеш процесса: версия + {test_id: TestBlueprint | None}
+_cache = {'version': None, 'tests': {}}
+_lock = threading.Lock()
+
+
+def get_test_blueprint(test_id):
+    """
+    Возвращает TestBlueprint (или None, если теста нет).
+    После прогрева не делает ни одного запроса к таблицам тестов.
+    """
+    version = get_version(CONTENT_VERSION)
+    tests = _cache['tests']
+    if _cache['version'] == version and test_id in tests:
+        return tests[test_id]
+
+    blueprint = _build(test_id)
+    with _lock:
+        if _cache['version'] != version:
+            # Версия сменилась - выбрасываем все старые копии разом
+            _cache['version'] = version
+            _cache['tests'] = {}
+        _cache['tests'][test_id] = blueprint
+    return blueprint
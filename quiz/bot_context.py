@@ -0,0 +1,117 @@
+"""
+Контекст пользователя Telegram на одно обновление.
+
+Middleware один раз на обновление находит пользователя по chat_id и
+передает хендлерам готовый TgUser (id, язык, категория, тариф). Данные
+берутся из TTL-кеша в памяти воркера, помеченного версией BOT_USERS_VERSION:
+изменение привязки чата, языка, категории или тарифа поднимает версию (см. сигналы в models.py),
+и все воркеры сбрасывают свои копии (версию воркер перечитывает раз в
+VERSION_CHECK_SECONDS). Цикл /train -> ответ -> следующий
+вопрос обращается к таблице пользователей не больше одного раза.
+"""
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from asgiref.sync import sync_to_async
+from cachetools import TTLCache
+from django.conf import settings
+from .versioning import BOT_USERS_VERSION, get_version
+
+# Кешируем и "чат не привязан", чтобы незнакомцы не ходили в БД на каждое сообщение
+_UNKNOWN = object()
+
+_cache = {'version': None, 'users': None}
+_lock = threading.Lock()
+# Как часто (сек) перечитывать BOT_USERS_VERSION из общего кеша
+VERSION_CHECK_SECONDS = 1.0
+_version = {'value': None, 'checked_at': 0.0}
+
+
+@dataclass(frozen=True, slots=True)
+class TgUser:
+    id: int
+    language: str
+    bot_category: str
+    plan: str
+
+
+def _new_store():
+    return TTLCache(maxsize=settings.TELEGRAM_USER_CACHE_SIZE, ttl=settings.TELEGRAM_USER_CACHE_TTL)
+
+
+def _load(chat_id):
+    from users.models import CustomUser
+
+    user = (
+        CustomUser.objects.filter(telegram_chat_id=str(chat_id))
+        .select_related('profile')
+        .only('id', 'language', 'bot_category', 'profile__plan')
+        .first()
+    )
+    if user is None:
+        return None
+    profile = getattr(user, 'profile', None)
+    return TgUser(
+        id=user.id,
+        language=user.language or 'ru',
+        bot_category=user.bot_category,
+        plan=profile.plan if profile else 'free',
+    )
+
+
+def _cached(chat_id, version):
+    with _lock:
+        if _cache['version'] != version:
+            # Версия сменилась - выбрасываем все старые записи разом
+            _cache['version'] = version
+            _cache['users'] = _new_store()
+        return _cache['users'].get(chat_id, None)
+
+
+def _remember(chat_id, version, value):
+    with _lock:
+        if _cache['version'] == version:
+            _cache['users'][chat_id] = value
+
+
+async def _current_version():
+    # Общий кеш версий файловый: чтение - блокирующий ввод-вывод, в loop бота его не делаем.
+    # Перечитываем не чаще раза в VERSION_CHECK_SECONDS - чужие правки видны с такой задержкой
+    now = time.monotonic()
+    if _version['value'] is None or now - _version['checked_at'] >= VERSION_CHECK_SECONDS:
+        _version['value'] = await sync_to_async(get_version)(BOT_USERS_VERSION)
+        _version['checked_at'] = now
+    return _version['value']
+
+
+def expire_version():
+    """Бот сам изменил пользователя - следующее обновление перечитает версию сразу."""
+    _version['value'] = None
+
+
+async def resolve_tg_user(chat_id):
+    """TgUser для чата или None, если чат не привязан к аккаунту."""
+    chat_id = str(chat_id)
+    version = await _current_version()
+    value = _cached(chat_id, version)
+    if value is None:
+        user = await sync_to_async(_load)(chat_id)
+        value = user if user is not None else _UNKNOWN
+        _remember(chat_id, version, value)
+    return None if value is _UNKNOWN else value
+
+
+class TgUserMiddleware(BaseMiddleware):
+    """Outer-middleware на update: добавляет в data ключ 'tg_user'."""
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        chat = data.get('event_chat')
+        data['tg_user'] = await resolve_tg_user(chat.id) if chat else None
+        return await handler(event, data)
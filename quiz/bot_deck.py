@@ -0,0 +1,109 @@
+"""
+"Колода" вопросов для тренажера в Telegram.
+
+Раньше каждый вопрос выбирался через exclude(id__in=<вся история BotResult>)
+и random.choice(list(...)) по всем оставшимся вопросам - время росло и с
+размером банка, и с историей пользователя. Теперь на пару (пользователь,
+категория) хранится перемешанный массив id вопросов и курсор: следующий
+вопрос - элемент под курсором, курсор двигается условным UPDATE.
+
+- Колода собирается один раз; уже отвеченные вопросы уходят в ее конец.
+- Когда банк меняется (CONTENT_VERSION), колода пересобирается: еще не
+  показанные вопросы остаются, удаленные выбрасываются, новые добавляются.
+- Когда колода кончилась, она перемешивается заново по всему банку.
+"""
+import random
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from .id_arrays import id_at, ids_count, pack_ids, unpack_ids
+from .models import BotQuestionDeck, BotResult, Question
+from .versioning import CONTENT_VERSION, get_version
+
+# Сколько раз повторяем выбор при гонке с другим обновлением того же пользователя
+MAX_RETRIES = 3
+
+
+def _bank_ids(category):
+    return list(Question.objects.filter(category=category).values_list('id', flat=True))
+
+
+def _shuffled(ids):
+    ids = list(ids)
+    random.shuffle(ids)
+    return ids
+
+
+def _create_deck(user_id, category, version):
+    # Единственный раз смотрим историю: уже отвеченные вопросы идут в конец колоды
+    answered = set(
+        BotResult.objects.filter(user_id=user_id, question__category=category)
+        .values_list('question_id', flat=True)
+    )
+    bank = _bank_ids(category)
+    ids = _shuffled(q for q in bank if q not in answered) + _shuffled(q for q in bank if q in answered)
+    try:
+        with transaction.atomic():
+            return BotQuestionDeck.objects.create(
+                user_id=user_id, category=category,
+                question_ids=pack_ids(ids), cursor=0, bank_version=version,
+            )
+    except IntegrityError:
+        # Параллельное обновление уже создало колоду
+        return None
+
+
+def _save_deck(deck, ids, version):
+    deck.question_ids = pack_ids(ids)
+    deck.cursor = 0
+    deck.bank_version = version
+    deck.save(update_fields=['question_ids', 'cursor', 'bank_version', 'updated_at'])
+
+
+def _refresh_deck(deck, version):
+    """Банк изменился: оставляем непоказанные вопросы и подмешиваем новые."""
+    bank = set(_bank_ids(deck.category))
+    old = unpack_ids(deck.question_ids)
+    remaining = [q for q in old[deck.cursor:] if q in bank]
+    known = set(old)
+    added = [q for q in bank if q not in known]
+    # Новые вопросы вставляем в случайные места среди оставшихся
+    for q in added:
+        remaining.insert(random.randint(0, len(remaining)), q)
+    _save_deck(deck, remaining, version)
+
+
+def _reshuffle_deck(deck, version):
+    """Колода кончилась - новый круг по всему банку."""
+    old = unpack_ids(deck.question_ids)
+    ids = _shuffled(_bank_ids(deck.category))
+    # Не начинаем новый круг с того же вопроса, которым закончили прошлый
+    if len(ids) > 1 and old and ids[0] == old[-1]:
+        ids[0], ids[-1] = ids[-1], ids[0]
+    _save_deck(deck, ids, version)
+
+
+def next_question_id(user_id, category):
+    """id следующего вопроса для пользователя или None, если в категории нет вопросов."""
+    version = get_version(CONTENT_VERSION)
+    for _ in range(MAX_RETRIES):
+        deck = BotQuestionDeck.objects.filter(user_id=user_id, category=category).first()
+        if deck is None:
+            deck = _create_deck(user_id, category, version)
+            if deck is None:
+                continue
+        elif deck.bank_version != version:
+            _refresh_deck(deck, version)
+
+        if deck.cursor >= ids_count(deck.question_ids):
+            _reshuffle_deck(deck, version)
+            if not ids_count(deck.question_ids):
+                return None
+
+        # Читаем один элемент, не распаковывая массив целиком
+        question_id = id_at(deck.question_ids, deck.cursor)
+        moved = BotQuestionDeck.objects.filter(
+            pk=deck.pk, cursor=deck.cursor, bank_version=deck.bank_version,
+        ).update(cursor=F('cursor') + 1)
+        if moved:
+            return question_id
+    return None
@@ -0,0 +1,258 @@
+"""
+Долгоживущий клиент Telegram Bot API на процесс.
+
+Раньше вебхук создавал новый Bot (а значит новую aiohttp-сессию, TCP и TLS
+рукопожатие) на каждое обновление. Теперь в каждом воркере есть один Bot
+с пулом соединений. aiohttp-сессия привязана к event loop, а Django под WSGI
+запускает каждую async-view в новом loop, поэтому бот живет в собственном
+фоновом потоке со своим loop, а вебхук передает ему обновления.
+
+Вебхук не ждет обработки: он кладет обновление в одну из ограниченных
+очередей и сразу отвечает Telegram 200. Очередь выбирается по chat_id, так
+что сообщения одного чата обрабатываются строго по порядку, а разные чаты -
+параллельно (TELEGRAM_WORKERS воркеров). Повторные доставки того же
+update_id отбрасываются по LRU последних id. Если очередь переполнена или
+loop бота не успел принять обновление, вебхук отвечает 503, id забывается и
+Telegram повторит доставку позже.
+"""
+import asyncio
+import atexit
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+import aiohttp
+from asgiref.sync import sync_to_async
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramNetworkError
+from django.conf import settings
+from django.db import close_old_connections
+from .telegram_bot import dp
+
+logger = logging.getLogger(__name__)
+
+
+def make_session(api_url=None, pool_size=None):
+    """aiohttp-сессия с пулом соединений (api_url - например, локальный фейковый сервер)."""
+    kwargs = {'limit': pool_size or settings.TELEGRAM_POOL_SIZE}
+    api_url = api_url or settings.TELEGRAM_API_URL
+    if api_url:
+        kwargs['api'] = TelegramAPIServer.from_base(api_url)
+    return AiohttpSession(**kwargs)
+
+
+# Результаты enqueue()
+QUEUED = 'queued'
+DUPLICATE = 'duplicate'
+QUEUE_FULL = 'full'
+LOOP_BUSY = 'busy'
+
+
+def shard_key(update):
+    """Ключ очереди: чат (или пользователь) обновления - чтобы сохранить порядок внутри чата."""
+    event = update.event
+    chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, 'from_user', None)
+    return user.id if user is not None else update.update_id
+
+
+class BotRuntime:
+    def __init__(self, token=None, api_url=None, workers=None, queue_size=None, dedupe_size=None):
+        self.token = token
+        self.api_url = api_url
+        self.workers = workers or settings.TELEGRAM_WORKERS
+        self.queue_size = queue_size or settings.TELEGRAM_QUEUE_SIZE
+        self.dedupe_size = dedupe_size or settings.TELEGRAM_DEDUPE_SIZE
+        self._bot = None
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._queues = []
+        self._tasks = []
+        self._seen = OrderedDict()
+        self._seen_lock = threading.Lock()
+        self._metrics = {
+            'received': 0, 'duplicates': 0, 'rejected': 0,
+            'processed': 0, 'failed': 0, 'busy_seconds': 0.0, 'max_queue_depth': 0,
+        }
+
+    # --- Фоновый event loop ---
+    def _ensure_loop(self):
+        if self._loop is not None:
+            return self._loop
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name='telegram-bot', daemon=True)
+                thread.start()
+                self._thread = thread
+                self._loop = loop
+        return self._loop
+
+    def submit(self, coro):
+        """Запускает корутину в loop бота. Возвращает concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    # --- Бот (создается лениво внутри loop бота) ---
+    async def get_bot(self):
+        if self._bot is None:
+            token = self.token or os.getenv('TELEGRAM_TOKEN')
+            if not token:
+                raise RuntimeError('TELEGRAM_TOKEN is not set')
+            self._bot = Bot(token=token, session=make_session(self.api_url))
+        return self._bot
+
+    async def reset_bot(self):
+        """Закрывает сессию после сетевой ошибки - следующий запрос откроет новые соединения."""
+        bot, self._bot = self._bot, None
+        if bot is not None:
+            try:
+                await bot.session.close()
+            except Exception as e:
+                logger.warning(f"Telegram session close error: {e}")
+
+    async def process_update(self, update):
+        bot = await self.get_bot()
+        try:
+            await dp.feed_update(bot, update)
+        except (TelegramNetworkError, aiohttp.ClientError):
+            await self.reset_bot()
+            raise
+        finally:
+            # Поток бота живет долго - не держим протухшие соединения с БД
+            await sync_to_async(close_old_connections)()
+
+    def feed_update(self, update):
+        return self.submit(self.process_update(update))
+
+    # --- Очереди обновлений ---
+    async def _start_workers(self):
+        if self._queues:
+            return
+        self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+    async def _worker(self, queue):
+        while True:
+            update = await queue.get()
+            started = time.perf_counter()
+            try:
+                await self.process_update(update)
+                self._metrics['processed'] += 1
+            except Exception as e:
+                self._metrics['failed'] += 1
+                logger.error(f"Telegram update {update.update_id} failed: {e}")
+            finally:
+                self._metrics['busy_seconds'] += time.perf_counter() - started
+                queue.task_done()
+
+    async def _put(self, update, state):
+        await self._start_workers()
+        queue = self._queues[hash(shard_key(update)) % len(self._queues)]
+        with self._seen_lock:
+            # Вебхук уже ответил 503 - повторная доставка придет заново
+            if state.get('abandoned'):
+                return False
+            try:
+                queue.put_nowait(update)
+            except asyncio.QueueFull:
+                return False
+            state['queued'] = True
+        self._metrics['max_queue_depth'] = max(self._metrics['max_queue_depth'], queue.qsize())
+        return True
+
+    def _mark_seen(self, update_id):
+        """True, если update_id новый (и запоминает его)."""
+        with self._seen_lock:
+            if update_id in self._seen:
+                self._seen.move_to_end(update_id)
+                return False
+            self._seen[update_id] = True
+            if len(self._seen) > self.dedupe_size:
+                self._seen.popitem(last=False)
+            return True
+
+    def _forget(self, update_id):
+        with self._seen_lock:
+            self._seen.pop(update_id, None)
+
+    def enqueue(self, update, timeout=2):
+        """
+        Ставит обновление в очередь и сразу возвращает QUEUED / DUPLICATE / QUEUE_FULL / LOOP_BUSY.
+        Вызывается из потока запроса (вебхука).
+        """
+        self._metrics['received'] += 1
+        if not self._mark_seen(update.update_id):
+            self._metrics['duplicates'] += 1
+            return DUPLICATE
+        state = {}
+        future = self.submit(self._put(update, state))
+        try:
+            accepted = future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            # Loop бота занят. Если обновление еще не в очереди - отказываемся от него,
+            # иначе Telegram не повторит доставку, а повтор отбросился бы как дубль
+            with self._seen_lock:
+                accepted = state.get('queued', False)
+                state['abandoned'] = True
+            if not accepted:
+                self._forget(update.update_id)
+                self._metrics['rejected'] += 1
+                return LOOP_BUSY
+        if not accepted:
+            # Не приняли - повторная доставка от Telegram должна пройти
+            self._forget(update.update_id)
+            self._metrics['rejected'] += 1
+            return QUEUE_FULL
+        return QUEUED
+
+    def stats(self):
+        depths = [queue.qsize() for queue in self._queues]
+        stats = dict(self._metrics)
+        stats.update({
+            'workers': self.workers,
+            'queue_size': self.queue_size,
+            'queue_depths': depths,
+            'queued': sum(depths),
+            'avg_processing_ms': round(stats['busy_seconds'] * 1000 / max(1, stats['processed'] + stats['failed']), 2),
+        })
+        stats['busy_seconds'] = round(stats['busy_seconds'], 3)
+        return stats
+
+    async def _drain(self, timeout):
+        """Дает воркерам доработать очередь и останавливает их."""
+        if self._queues:
+            try:
+                await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Telegram update queue was not drained before shutdown")
+        for task in self._tasks:
+            task.cancel()
+        self._queues, self._tasks = [], []
+        await self.reset_bot()
+
+    def shutdown(self, timeout=5):
+        """Закрывает сессию и останавливает loop (вызывается при выходе процесса)."""
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            self.submit(self._drain(timeout)).result(timeout=timeout + 1)
+        except Exception as e:
+            logger.warning(f"Telegram bot shutdown error: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+        self._loop = None
+        self._thread = None
+
+
+# Один клиент на процесс
+runtime = BotRuntime()
+atexit.register(runtime.shutdown)
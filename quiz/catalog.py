@@ -0,0 +1,88 @@
+"""
+Кеш каталога тестов на главной странице.
+
+Каталог (названия и описания тестов на языке пользователя) меняется
+несколько раз в месяц, а строился на каждый заход. Теперь готовый HTML
+карточек хранится в памяти процесса по ключу (класс аудитории, язык) и
+помечен версией CATALOG_VERSION - ее поднимает любое изменение Test
+(сигнал в models.py). Кнопка на карточке зависит от тарифа и выбранного
+бесплатного теста, поэтому в кеше на ее месте маркер, а сами кнопки
+подставляются для каждого пользователя заново, без запросов к БД.
+"""
+import re
+import threading
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
+from .models import Test
+from .versioning import CATALOG_VERSION, get_version
+
+# Классы аудитории: рекрутеры (и суперпользователи) видят все тесты, остальные - без тестов для рекрутеров
+AUDIENCE_ALL = 'all'
+AUDIENCE_PUBLIC = 'public'
+
+ACTION_KINDS = ('start', 'again', 'locked', 'choose')
+_ACTION_RE = re.compile(r'<!--catalog-action:(\d+)-->')
+URL_PLACEHOLDER = '__TEST_URL__'
+
+_cache = {'version': None, 'fragments': {}}
+# Кнопки зависят только от языка (тексты из шаблона) - версия каталога им не нужна
+_actions = {}
+_lock = threading.Lock()
+
+
+def _tests(audience):
+    tests = Test.objects.all()
+    if audience != AUDIENCE_ALL:
+        tests = tests.exclude(test_audience='recruiter')
+    return list(tests)
+
+
+def _fragment(audience, language):
+    version = get_version(CATALOG_VERSION)
+    key = (audience, language)
+    if _cache['version'] == version and key in _cache['fragments']:
+        return _cache['fragments'][key]
+
+    html = render_to_string('catalog/cards.html', {'tests': _tests(audience)})
+    with _lock:
+        if _cache['version'] != version:
+            # Каталог изменился - выбрасываем все старые фрагменты разом
+            _cache['version'] = version
+            _cache['fragments'] = {}
+        _cache['fragments'][key] = html
+    return html
+
+
+def _action_templates(language):
+    actions = _actions.get(language)
+    if actions is None:
+        actions = {kind: render_to_string('catalog/action.html', {'kind': kind}) for kind in ACTION_KINDS}
+        with _lock:
+            # Параллельный запрос мог успеть первым - оставляем его кнопки
+            actions = _actions.setdefault(language, actions)
+    return actions
+
+
+def render_catalog(audience, full_access, locked_test_id):
+    """
+    HTML каталога для пользователя. full_access - тариф pro/hr или суперпользователь;
+    locked_test_id - тест, выбранный на бесплатном тарифе.
+    """
+    language = (get_language() or 'ru')[:2]
+    fragment = _fragment(audience, language)
+    actions = _action_templates(language)
+    url_prefix = reverse('test_detail', args=[0]).rsplit('0', 1)[0]
+
+    def action(match):
+        test_id = int(match.group(1))
+        if full_access:
+            kind = 'start'
+        elif locked_test_id:
+            kind = 'again' if test_id == locked_test_id else 'locked'
+        else:
+            kind = 'choose'
+        return actions[kind].replace(URL_PLACEHOLDER, f'{url_prefix}{test_id}/')
+
+    return mark_safe(_ACTION_RE.sub(action, fragment))
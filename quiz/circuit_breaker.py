@@ -0,0 +1,108 @@
+"""
+Предохранитель (circuit breaker) для внешних вызовов.
+
+closed    - вызовы идут как обычно, считаем ошибки подряд;
+open      - после failure_threshold ошибок (или слишком медленных ответов)
+            подряд вызовы не делаются cooldown секунд, сразу отдается заглушка;
+half_open - после паузы пропускаем один пробный вызов: успех закрывает
+            предохранитель, ошибка снова открывает его.
+
+Состояние живет в памяти процесса: каждый воркер решает сам.
+"""
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, cooldown, slow_call_seconds=None):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.slow_call_seconds = slow_call_seconds
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._stats = {'calls': 0, 'successes': 0, 'failures': 0, 'slow_calls': 0, 'timeouts': 0,
+                       'rejected': 0, 'opened': 0}
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+            self._state = HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+
+    def allow(self):
+        """Можно ли сейчас делать вызов. False - сразу отдаем заглушку."""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                self._stats['calls'] += 1
+                return True
+            if state == HALF_OPEN and not self._probe_in_flight:
+                # Пробный вызов - один на весь процесс
+                self._probe_in_flight = True
+                self._stats['calls'] += 1
+                return True
+            self._stats['rejected'] += 1
+            return False
+
+    def release(self):
+        """Разрешенный вызов так и не был сделан (например, нет API-ключа)."""
+        with self._lock:
+            self._stats['calls'] -= 1
+            self._probe_in_flight = False
+
+    def record_success(self, duration):
+        with self._lock:
+            if self.slow_call_seconds and duration >= self.slow_call_seconds:
+                # Ответ получен, но так медленно, что это тоже признак проблем у провайдера
+                self._stats['slow_calls'] += 1
+                self._on_failure()
+                return
+            self._stats['successes'] += 1
+            self._failures = 0
+            self._probe_in_flight = False
+            self._state = CLOSED
+
+    def record_failure(self, timeout=False):
+        with self._lock:
+            self._stats['failures'] += 1
+            if timeout:
+                self._stats['timeouts'] += 1
+            self._on_failure()
+
+    def _on_failure(self):
+        self._failures += 1
+        self._probe_in_flight = False
+        if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+            if self._state != OPEN:
+                self._stats['opened'] += 1
+            self._state = OPEN
+            self._opened_at = time.monotonic()
+
+    def reset(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+            for key in self._stats:
+                self._stats[key] = 0
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data['state'] = self._current_state()
+            data['consecutive_failures'] = self._failures
+            if data['state'] == OPEN:
+                data['retry_in_seconds'] = round(max(0.0, self.cooldown - (time.monotonic() - self._opened_at)), 1)
+        return data
@@ -0,0 +1,26 @@
+"""
+Компактное хранение списков id в BinaryField: array('I') - 4 байта на число.
+Используется колодой бота (bot_deck).
+"""
+from array import array
+
+ITEM_SIZE = array('I').itemsize
+
+
+def pack_ids(ids):
+    return array('I', ids).tobytes()
+
+
+def unpack_ids(data):
+    ids = array('I')
+    ids.frombytes(bytes(data or b''))
+    return ids
+
+
+def ids_count(data):
+    return len(data or b'') // ITEM_SIZE
+
+
+def id_at(data, index):
+    """Один элемент без распаковки всего массива."""
+    return memoryview(data).cast('I')[index]
@@ -0,0 +1,47 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from quiz.models import UserTestResult, UserAnswer
+from quiz.result_summary import build_summary_from_details
+
+
+class Command(BaseCommand):
+    help = 'Заполняет сводку (summary) у старых результатов, проходя таблицу порциями'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Результатов за одну порцию')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = 0
+        total = 0
+
+        while True:
+            # Порции по первичному ключу - без OFFSET, скорость не падает к концу таблицы
+            ids = list(
+                UserTestResult.objects.filter(summary__isnull=True, pk__gt=last_id)
+                .order_by('pk')
+                .values_list('pk', flat=True)[:chunk_size]
+            )
+            if not ids:
+                break
+            last_id = ids[-1]
+
+            details_by_result = defaultdict(list)
+            details = (
+                UserAnswer.objects.filter(result_id__in=ids)
+                .select_related('question', 'selected_answer')
+                .order_by('result_id', 'id')
+            )
+            for detail in details:
+                details_by_result[detail.result_id].append(detail)
+
+            results = [
+                UserTestResult(pk=result_id, summary=build_summary_from_details(details_by_result[result_id]))
+                for result_id in ids
+            ]
+            UserTestResult.objects.bulk_update(results, ['summary'])
+
+            total += len(ids)
+            self.stdout.write(f'Обработано: {total} (последний id {last_id})')
+
+        self.stdout.write(self.style.SUCCESS(f'Готово! Заполнено сводок: {total}'))
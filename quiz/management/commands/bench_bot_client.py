@@ -0,0 +1,96 @@
+import asyncio
+import statistics
+import time
+from aiohttp import web
+from aiogram import Bot
+from django.core.management.base import BaseCommand
+from quiz.bot_runtime import make_session
+
+FAKE_TOKEN = '123456:FAKE-benchmark-token'
+# Методы Bot API, которые возвращают True вместо Message
+BOOL_METHODS = {'answercallbackquery', 'deletemessage', 'setwebhook', 'deletewebhook'}
+
+
+def _fake_api_app(latency):
+    """Минимальный фейковый Bot API: на любой метод отвечает успешным Message."""
+    async def handle(request):
+        if latency:
+            await asyncio.sleep(latency)
+        if request.match_info['method'].lower() in BOOL_METHODS:
+            return web.json_response({'ok': True, 'result': True})
+        message = {
+            'message_id': 1,
+            'date': int(time.time()),
+            'chat': {'id': 1, 'type': 'private'},
+            'text': 'ok',
+        }
+        if request.match_info['method'].lower() == 'sendphoto':
+            message['photo'] = [{'file_id': 'FAKE-FILE-ID', 'file_unique_id': 'fake', 'width': 1, 'height': 1}]
+        return web.json_response({'ok': True, 'result': message})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', handle)
+    return app
+
+
+class Command(BaseCommand):
+    help = 'Бенчмарк клиента Telegram: новый Bot на каждое обновление против долгоживущего Bot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='Сколько вызовов sendMessage')
+        parser.add_argument('--concurrency', type=int, default=20, help='Одновременных вызовов (пачка колбэков)')
+        parser.add_argument('--latency', type=float, default=0.0, help='Задержка фейкового сервера (сек)')
+
+    def handle(self, *args, **options):
+        asyncio.run(self._run(options))
+
+    async def _run(self, options):
+        runner = web.AppRunner(_fake_api_app(options['latency']))
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        api_url = f'http://127.0.0.1:{port}'
+        self.stdout.write(f'Фейковый Bot API: {api_url}')
+
+        try:
+            per_update = await self._measure(options, api_url, persistent=False)
+            persistent = await self._measure(options, api_url, persistent=True)
+        finally:
+            await runner.cleanup()
+
+        self._print('Новый Bot на обновление', per_update)
+        self._print('Долгоживущий Bot', persistent)
+        speedup = statistics.mean(per_update) / statistics.mean(persistent)
+        self.stdout.write(self.style.SUCCESS(f'Ускорение (среднее): x{speedup:.1f}'))
+
+    async def _measure(self, options, api_url, persistent):
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        latencies = []
+        shared_bot = Bot(token=FAKE_TOKEN, session=make_session(api_url)) if persistent else None
+
+        async def one_call():
+            async with semaphore:
+                started = time.perf_counter()
+                if persistent:
+                    await shared_bot.send_message(chat_id=1, text='ping')
+                else:
+                    # Так работал старый вебхук: сессия и соединения создаются заново
+                    async with Bot(token=FAKE_TOKEN, session=make_session(api_url)) as bot:
+                        await bot.send_message(chat_id=1, text='ping')
+                latencies.append(time.perf_counter() - started)
+
+        try:
+            await asyncio.gather(*(one_call() for _ in range(options['requests'])))
+        finally:
+            if shared_bot:
+                await shared_bot.session.close()
+        return latencies
+
+    def _print(self, title, latencies):
+        ordered = sorted(latencies)
+        p95 = ordered[int(len(ordered) * 0.95) - 1]
+        self.stdout.write(
+            f'{title}: среднее {statistics.mean(ordered) * 1000:.2f} мс, '
+            f'p50 {statistics.median(ordered) * 1000:.2f} мс, p95 {p95 * 1000:.2f} мс'
+        )
@@ -0,0 +1,213 @@
+import json
+import os
+import re
+import statistics
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from users.models import CustomUser
+from quiz.models import Test, Question, Answer
+from quiz.versioning import CONTENT_VERSION, bump_version
+
+PREFIX = 'bench_'
+ANSWER_RE = re.compile(r'name="selected_answer"\s+value="(\d+)"')
+RESULT_RE = re.compile(r'/result/(\d+)/')
+
+
+def _percentile(ordered, pct):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def _finish_endpoint(response):
+    """Последний ответ (редирект на результат) - это finish_test."""
+    return 'finish_test' if RESULT_RE.search(response.get('Location', '')) else None
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except Exception:
+        return ''
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочный бенчмарк прохождения теста: home -> шаги test_detail -> finish -> результат -> HR-панель'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10, help='Одновременных кандидатов (потоков)')
+        parser.add_argument('--iterations', type=int, default=1, help='Сколько раз каждый проходит тест')
+        parser.add_argument('--questions', type=int, default=40, help='Вопросов в тестовом тесте')
+        parser.add_argument('--output', type=str, default='', help='Куда сохранить JSON (по умолчанию bench_results/)')
+        parser.add_argument('--keep-data', action='store_true', help='Не удалять созданные для бенчмарка данные')
+
+    def handle(self, *args, **options):
+        # ИИ не вызываем: в finish_test отчет только ставится в очередь, но на всякий случай - фейк
+        settings.AI_PROVIDER = 'fake'
+        self.samples = defaultdict(list)   # endpoint -> [(секунды, запросов к БД, ok)]
+        self.lock = threading.Lock()
+
+        test, candidates, recruiter = self._seed(options['users'], options['questions'])
+        try:
+            started = time.perf_counter()
+            threads = [
+                threading.Thread(target=self._candidate_flow, args=(user, test, options['iterations'], recruiter))
+                for user in candidates
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            wall = time.perf_counter() - started
+        finally:
+            if not options['keep_data']:
+                self._cleanup()
+
+        report = self._report(wall, options)
+        self._print(report)
+        path = options['output'] or os.path.join(
+            settings.BASE_DIR, 'bench_results',
+            f"test_flow_{report['meta']['commit'] or 'nogit'}_{datetime.now():%Y%m%d_%H%M%S}.json",
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Результаты сохранены: {path}'))
+
+    # --- Данные ---
+    def _seed(self, users, questions):
+        self._cleanup()
+        test = Test.objects.create(
+            title_ru=f'{PREFIX}IQ', title_kk=f'{PREFIX}IQ', title_en=f'{PREFIX}IQ', questions_count=questions,
+        )
+        question_objs = Question.objects.bulk_create([
+            Question(test=test, text_ru=f'Вопрос {i}', text_kk=f'Сұрақ {i}', text_en=f'Question {i}',
+                     category='logic', order=i)
+            for i in range(questions)
+        ])
+        Answer.objects.bulk_create([
+            Answer(question=q, text_ru=f'Ответ {j}', text_kk=f'Жауап {j}', text_en=f'Answer {j}', is_correct=(j == 0))
+            for q in question_objs for j in range(4)
+        ])
+        bump_version(CONTENT_VERSION)
+
+        candidates = []
+        for i in range(users):
+            user = CustomUser.objects.create_user(f'{PREFIX}user{i}', password='bench')
+            # Pro - чтобы можно было проходить тест несколько раз
+            user.profile.plan = 'pro'
+            user.profile.save()
+            candidates.append(user)
+        recruiter = CustomUser.objects.create_user(f'{PREFIX}hr', password='bench')
+        recruiter.profile.plan = 'hr'
+        recruiter.profile.save()
+        self.stdout.write(f'Подготовлено: тест на {questions} вопросов, {users} кандидатов')
+        return test, candidates, recruiter
+
+    def _cleanup(self):
+        Test.objects.filter(title_ru__startswith=PREFIX).delete()
+        CustomUser.objects.filter(username__startswith=PREFIX).delete()
+
+    # --- Нагрузка ---
+    def _request(self, client, endpoint, method, url, data=None, relabel=None):
+        """relabel(response) -> другое имя эндпоинта (или None); замер записывается один раз, уже под ним."""
+        with CaptureQueriesContext(connection) as ctx:
+            started = time.perf_counter()
+            try:
+                response = client.post(url, data) if method == 'POST' else client.get(url)
+                ok = response.status_code < 400
+            except Exception as e:
+                response, ok = None, False
+                self.stderr.write(f'{endpoint}: {e}')
+            elapsed = time.perf_counter() - started
+        if relabel and response is not None:
+            endpoint = relabel(response) or endpoint
+        with self.lock:
+            self.samples[endpoint].append((elapsed, len(ctx), ok))
+        return response
+
+    def _candidate_flow(self, user, test, iterations, recruiter):
+        client = Client()
+        client.force_login(user)
+        hr_client = Client()
+        hr_client.force_login(recruiter)
+        url = f'/test/{test.id}/'
+        try:
+            for _ in range(iterations):
+                self._request(client, 'home', 'GET', '/')
+                result_url = None
+                for _step in range(test.questions_count):
+                    page = self._request(client, 'test_detail GET', 'GET', url)
+                    if page is None or page.status_code != 200:
+                        break
+                    match = ANSWER_RE.search(page.content.decode())
+                    data = {'action': 'next', 'selected_answer': match.group(1) if match else ''}
+                    response = self._request(client, 'test_detail POST', 'POST', url, data, relabel=_finish_endpoint)
+                    if response is not None and _finish_endpoint(response):
+                        result_url = response['Location']
+                        break
+                if result_url:
+                    self._request(client, 'result_detail', 'GET', result_url)
+                self._request(hr_client, 'hr_dashboard', 'GET', '/hr/dashboard/')
+        finally:
+            connection.close()
+
+    # --- Отчет ---
+    def _report(self, wall, options):
+        endpoints = {}
+        total = 0
+        for name, samples in self.samples.items():
+            latencies = sorted(s[0] * 1000 for s in samples)
+            queries = [s[1] for s in samples]
+            total += len(samples)
+            endpoints[name] = {
+                'requests': len(samples),
+                'errors': sum(1 for s in samples if not s[2]),
+                'rps': round(len(samples) / wall, 2) if wall else 0,
+                'p50_ms': round(_percentile(latencies, 50), 2),
+                'p95_ms': round(_percentile(latencies, 95), 2),
+                'p99_ms': round(_percentile(latencies, 99), 2),
+                'mean_ms': round(statistics.mean(latencies), 2) if latencies else 0,
+                'queries_avg': round(statistics.mean(queries), 2) if queries else 0,
+                'queries_max': max(queries) if queries else 0,
+            }
+        return {
+            'meta': {
+                'commit': _git_commit(),
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'database': connection.vendor,
+                'debug': settings.DEBUG,
+                'users': options['users'],
+                'iterations': options['iterations'],
+                'questions': options['questions'],
+            },
+            'total': {
+                'requests': total,
+                'wall_seconds': round(wall, 3),
+                'rps': round(total / wall, 2) if wall else 0,
+            },
+            'endpoints': endpoints,
+        }
+
+    def _print(self, report):
+        self.stdout.write(
+            f"\n{'endpoint':<20}{'req':>6}{'err':>5}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'sql avg':>9}{'sql max':>9}"
+        )
+        for name, row in sorted(report['endpoints'].items()):
+            self.stdout.write(
+                f"{name:<20}{row['requests']:>6}{row['errors']:>5}{row['rps']:>9}{row['p50_ms']:>9}"
+                f"{row['p95_ms']:>9}{row['p99_ms']:>9}{row['queries_avg']:>9}{row['queries_max']:>9}"
+            )
+        total = report['total']
+        self.stdout.write(f"\nВсего: {total['requests']} запросов за {total['wall_seconds']} с ({total['rps']} rps)")
@@ -0,0 +1,31 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from quiz.models import TestAttempt
+
+
+class Command(BaseCommand):
+    help = 'Удаляет брошенные прохождения тестов (TestAttempt) порциями'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30, help='Удалять попытки без изменений дольше N дней')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Строк за одно удаление')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        total = 0
+
+        while True:
+            # Короткие транзакции: удаляем по batch-size строк, не блокируя таблицу надолго
+            ids = list(
+                TestAttempt.objects.filter(updated_at__lt=cutoff)
+                .order_by('pk')
+                .values_list('pk', flat=True)[:options['batch_size']]
+            )
+            if not ids:
+                break
+            TestAttempt.objects.filter(pk__in=ids).delete()
+            total += len(ids)
+            self.stdout.write(f'Удалено: {total}')
+
+        self.stdout.write(self.style.SUCCESS(f'Готово! Удалено попыток: {total}'))
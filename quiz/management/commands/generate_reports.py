@@ -0,0 +1,97 @@
+from datetime import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from users.models import CustomUser
+from quiz.report_batch import BatchRunner, backfill_jobs, select_results
+
+
+def _date(value):
+    try:
+        return timezone.make_aware(datetime.strptime(value, '%Y-%m-%d'))
+    except ValueError:
+        raise CommandError(f'Дата должна быть в формате ГГГГ-ММ-ДД: {value}')
+
+
+class Command(BaseCommand):
+    help = 'Пакетная (пере)генерация ИИ-анализов: параллельно, с лимитом частоты и повторами'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--test-id', type=int, help='Только результаты этого теста')
+        parser.add_argument('--date-from', type=str, help='Результаты с этой даты (ГГГГ-ММ-ДД)')
+        parser.add_argument('--date-to', type=str, help='Результаты до этой даты, не включая (ГГГГ-ММ-ДД)')
+        parser.add_argument('--recruiter', type=str, help='Только кандидаты, приглашенные этим рекрутером (username)')
+        parser.add_argument('--missing-only', action='store_true', help='Только результаты без анализа')
+        parser.add_argument('--limit', type=int, default=0, help='Максимум результатов (0 - все)')
+        parser.add_argument('--workers', type=int, default=settings.AI_REPORT_WORKERS, help='Параллельных генераций')
+        parser.add_argument('--rate', type=int, default=settings.AI_RATE_LIMIT_PER_MINUTE,
+                            help='Вызовов провайдера в минуту (0 - без ограничения)')
+        parser.add_argument('--retries', type=int, default=3, help='Повторов, если ИИ не ответил')
+        parser.add_argument('--backoff', type=float, default=2.0, help='Первая пауза перед повтором (сек), дальше x2')
+        parser.add_argument('--batch-size', type=int, default=50, help='Сколько готовых отчетов писать одним bulk_update')
+        parser.add_argument('--provider', choices=['gemini', 'fake'], help='Провайдер ИИ (fake - офлайн-прогон)')
+        parser.add_argument('--fake-delay', type=float, help='Задержка ответа фейкового провайдера (сек)')
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать результаты')
+
+    def handle(self, *args, **options):
+        if options['provider']:
+            settings.AI_PROVIDER = options['provider']
+        if options['fake_delay'] is not None:
+            settings.AI_FAKE_DELAY = options['fake_delay']
+
+        recruiter = None
+        if options['recruiter']:
+            recruiter = CustomUser.objects.filter(username=options['recruiter']).first()
+            if recruiter is None:
+                raise CommandError(f"Рекрутер {options['recruiter']} не найден")
+
+        results = select_results(
+            test_id=options['test_id'],
+            date_from=_date(options['date_from']) if options['date_from'] else None,
+            date_to=_date(options['date_to']) if options['date_to'] else None,
+            recruiter=recruiter,
+            missing_only=options['missing_only'],
+        ).order_by('id')
+        result_ids = list(results.values_list('id', flat=True))
+        if options['limit']:
+            result_ids = result_ids[:options['limit']]
+
+        if options['dry_run']:
+            self.stdout.write(f'[DRY RUN] Результатов для генерации: {len(result_ids)}')
+            return
+        if not result_ids:
+            self.stdout.write('Нет результатов для генерации')
+            return
+
+        backfilled = backfill_jobs(result_ids)
+        self.stdout.write(
+            f'Провайдер: {settings.AI_PROVIDER}, отчетов: {len(result_ids)} '
+            f'(задачи созданы для старых результатов: {backfilled}), '
+            f'потоков: {options["workers"]}, лимит: {options["rate"] or "нет"}/мин'
+        )
+
+        runner = BatchRunner(
+            workers=options['workers'],
+            rate_per_minute=options['rate'],
+            retries=options['retries'],
+            backoff=options['backoff'],
+            write_batch_size=options['batch_size'],
+            progress=self._progress,
+        )
+        stats = runner.run(result_ids)
+        generated = stats['total'] - stats['busy']
+        per_minute = generated * 60 / stats['seconds'] if stats['seconds'] else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Готово за {stats['seconds']} с ({per_minute:.1f} отчетов/мин): ИИ {stats['ai']}, "
+            f"заглушка {stats['fallback']}, оставлен прежний анализ {stats['kept']}, "
+            f"повторов {stats['retries']}, ожидание лимита {stats['throttled_seconds']} с, "
+            f"уже генерировались другими {stats['busy']}, забраны воркером очереди {stats['lost']}"
+        ))
+
+    def _progress(self, done, total, elapsed):
+        # Не чаще, чем каждые 10% (и последняя строка)
+        step = max(1, total // 10)
+        if done % step and done != total:
+            return
+        per_minute = done * 60 / elapsed if elapsed else 0
+        self.stdout.write(f'  {done}/{total} ({per_minute:.1f} отчетов/мин)')
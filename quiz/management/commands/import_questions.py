@@ -1,95 +1,216 @@
 import csv
+import hashlib
+import json
 import os
 import shutil
-from django.core.management.base import BaseCommand
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import translation
 from quiz.models import Test, Question, Answer
+from quiz.versioning import CONTENT_VERSION, bump_version
+
+LANGS = ('ru', 'kk', 'en')
+
+
+def _localized(row, name):
+    """
+    Тексты на трех языках. Поддерживаем оба формата файлов:
+    многоязычный (text_ru; text_kk; text_en) и одноязычный (text) - он идет в русский.
+    """
+    if f'{name}_ru' in row:
+        return {lang: (row.get(f'{name}_{lang}') or '').strip() for lang in LANGS}
+    return {'ru': (row.get(name) or '').strip(), 'kk': '', 'en': ''}
+
+
+def parse_row(row):
+    """Строка CSV -> словарь с вопросом, ответами и хешем содержимого."""
+    wrong = []
+    for i in range(1, 4):
+        texts = _localized(row, f'wrong_{i}')
+        if texts['ru']:  # Если ответ существует
+            wrong.append(texts)
+    item = {
+        'category': row['category'].strip(),
+        'text': _localized(row, 'text'),
+        'exposure_time': int(row.get('exposure_time') or 0),
+        'answer_time': int(row.get('answer_time') or 60),
+        'image': (row.get('image_filename') or '').strip(),
+        'correct': _localized(row, 'correct_answer'),
+        'wrong': wrong,
+    }
+    raw = json.dumps(item, ensure_ascii=False, sort_keys=True)
+    item['hash'] = hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    return item
+
+
+def copy_image(source_path, target_path):
+    # Не копируем повторно тот же файл
+    if os.path.exists(target_path) and os.path.getsize(target_path) == os.path.getsize(source_path):
+        return
+    shutil.copyfile(source_path, target_path)
+
 
 class Command(BaseCommand):
-    help = 'Импорт вопросов на трех языках (RU/KK/EN)'
+    help = 'Импорт вопросов на трех языках (RU/KK/EN) из одного или нескольких CSV'
 
     def add_arguments(self, parser):
-        parser.add_argument('csv_file', type=str, help='Путь к CSV файлу')
+        parser.add_argument('csv_files', nargs='+', type=str, help='Пути к CSV файлам')
+        parser.add_argument('--test-id', type=int, help='В какой тест импортировать (по умолчанию - общий IQ тест)')
+        parser.add_argument('--dry-run', action='store_true', help='Только показать, что будет добавлено')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Строк в одной пачке bulk_create')
+        parser.add_argument('--image-workers', type=int, default=8, help='Потоков для копирования картинок')
 
     def handle(self, *args, **kwargs):
-        csv_path = kwargs['csv_file']
-        
-        # Создаем тест (заголовки на 3 языках)
-        main_test, _ = Test.objects.get_or_create(
-            title_ru="IQ тест (Мультиязычный)",
-            title_kk="IQ тест (Көптілді)",
-            title_en="IQ test (Multilingual)",
-            defaults={
-                'description_ru': 'Тест на IQ (Мультиязычный)',
-                'description_kk': 'Тест на IQ (Көптілді)',
-                'description_en': 'Test on IQ (Multilingual)',
-                'questions_count': 96,
-                'time_limit': 60
-            }
-        )
-
-        source_images_dir = os.path.join(settings.MEDIA_ROOT, 'import_images')
-        target_images_dir = os.path.join(settings.MEDIA_ROOT, 'questions')
-        if not os.path.exists(target_images_dir):
-            os.makedirs(target_images_dir)
-
-        if not os.path.exists(csv_path):
-            self.stdout.write(self.style.ERROR(f'Файл {csv_path} не найден!'))
-            return
+        for csv_path in kwargs['csv_files']:
+            if not os.path.exists(csv_path):
+                raise CommandError(f'Файл {csv_path} не найден!')
+
+        self.dry_run = kwargs['dry_run']
+        self.batch_size = kwargs['batch_size']
+        self.source_images_dir = os.path.join(settings.MEDIA_ROOT, 'import_images')
+        self.target_images_dir = os.path.join(settings.MEDIA_ROOT, 'questions')
+        self.stats = {'rows': 0, 'created': 0, 'existing': 0, 'duplicates': 0, 'images': 0, 'missing_images': 0}
+
+        # Все файлы - одна транзакция: ошибка посередине не оставит полуимпортированный тест.
+        # Базовое поле text заполняется из активного языка - фиксируем язык по умолчанию.
+        with translation.override(settings.LANGUAGE_CODE), transaction.atomic(), \
+                ThreadPoolExecutor(max_workers=kwargs['image_workers']) as pool:
+            self.test = self._get_test(kwargs['test_id'])
+            self.pool = pool
+            self.copies = []
+            self.seen = set()
+            self.next_order = (
+                (self.test.questions.aggregate(m=Max('order'))['m'] or 0) + 1 if self.test.pk else 1
+            )
+            if not self.dry_run:
+                os.makedirs(self.target_images_dir, exist_ok=True)
+
+            for csv_path in kwargs['csv_files']:
+                self._import_file(csv_path)
+
+            # Ошибка копирования картинки откатывает весь импорт
+            for future in self.copies:
+                future.result()
 
+            if not self.dry_run and self.stats['created']:
+                # bulk_create не вызывает сигналы - сбрасываем кеши тестов сами
+                transaction.on_commit(lambda: bump_version(CONTENT_VERSION))
+
+        stats = self.stats
+        prefix = '[DRY RUN] Будет добавлено' if self.dry_run else 'Импорт завершен! Добавлено'
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix} вопросов: {stats['created']} (строк: {stats['rows']}, уже есть: {stats['existing']}, "
+            f"дублей в файлах: {stats['duplicates']}, картинок: {stats['images']}, "
+            f"картинок не найдено: {stats['missing_images']})"
+        ))
+
+    def _get_test(self, test_id):
+        if test_id:
+            try:
+                return Test.objects.get(pk=test_id)
+            except Test.DoesNotExist:
+                raise CommandError(f'Тест #{test_id} не найден!')
+
+        defaults = {
+            'description_ru': 'Тест на IQ (Мультиязычный)',
+            'description_kk': 'Тест на IQ (Көптілді)',
+            'description_en': 'Test on IQ (Multilingual)',
+            'questions_count': 96,
+            'time_limit': 60
+        }
+        lookup = {
+            'title_ru': "IQ тест (Мультиязычный)",
+            'title_kk': "IQ тест (Көптілді)",
+            'title_en': "IQ test (Multilingual)",
+        }
+        test = Test.objects.filter(**lookup).first()
+        if test:
+            return test
+        if self.dry_run:
+            # Тест еще не создан - в сухом прогоне ничего не пишем
+            return Test(**lookup, **defaults)
+        return Test.objects.create(**lookup, **defaults)
+
+    def _import_file(self, csv_path):
+        # Файл читается потоково, в памяти держим только одну пачку строк
         with open(csv_path, 'r', encoding='utf-8') as f:
             reader = csv.DictReader(f, delimiter=';')
-            
-            count = 0
+            batch = []
             for row in reader:
-                # 1. Создаем Вопрос (RU, KK, EN)
-                question = Question.objects.create(
-                    test=main_test,
-                    text_ru=row['text_ru'],
-                    text_kk=row['text_kk'],
-                    text_en=row['text_en'], # Английский
-                    category=row['category'],
-                    exposure_time=int(row['exposure_time']),
-                    answer_time=int(row['answer_time']),
-                    order=count + 1
-                )
-
-                # 2. Картинка
-                img_name = row['image_filename'].strip()
-                if img_name:
-                    source_path = os.path.join(source_images_dir, img_name)
-                    if os.path.exists(source_path):
-                        target_path = os.path.join(target_images_dir, img_name)
-                        shutil.copy(source_path, target_path)
-                        question.image = f'questions/{img_name}'
-                        question.save()
-
-                # 3. Ответы
-                # Правильный
-                Answer.objects.create(
-                    question=question, 
-                    text_ru=row['correct_answer_ru'], 
-                    text_kk=row['correct_answer_kk'], 
-                    text_en=row['correct_answer_en'], 
-                    is_correct=True
-                )
-                
-                # Неправильные (1, 2, 3)
-                for i in range(1, 4):
-                    ru = row.get(f'wrong_{i}_ru')
-                    kk = row.get(f'wrong_{i}_kk')
-                    en = row.get(f'wrong_{i}_en')
-                    
-                    if ru: # Если ответ существует
-                        Answer.objects.create(
-                            question=question, 
-                            text_ru=ru, 
-                            text_kk=kk, 
-                            text_en=en, 
-                            is_correct=False
-                        )
-                
-                count += 1
-                self.stdout.write(f'Добавлен: {question.text_en[:20]}...')
-
-        self.stdout.write(self.style.SUCCESS(f'Импорт завершен! Добавлено вопросов: {count}'))
\ No newline at end of file
+                batch.append(parse_row(row))
+                if len(batch) >= self.batch_size:
+                    self._import_batch(batch)
+                    batch = []
+            if batch:
+                self._import_batch(batch)
+        self.stdout.write(f'{csv_path}: обработано строк {self.stats["rows"]}')
+
+    def _import_batch(self, batch):
+        self.stats['rows'] += len(batch)
+        hashes = [item['hash'] for item in batch]
+        existing = set()
+        if self.test.pk:
+            existing = set(
+                # exclude(content_hash='') - условие частичного уникального индекса, чтобы он использовался
+                Question.objects.filter(test=self.test, content_hash__in=hashes)
+                .exclude(content_hash='')
+                .values_list('content_hash', flat=True)
+            )
+
+        new_items = []
+        for item in batch:
+            if item['hash'] in existing:
+                self.stats['existing'] += 1
+            elif item['hash'] in self.seen:
+                self.stats['duplicates'] += 1
+            else:
+                self.seen.add(item['hash'])
+                new_items.append(item)
+        self.stats['created'] += len(new_items)
+
+        questions = []
+        for item in new_items:
+            image = self._queue_image(item['image'])
+            questions.append(Question(
+                test=self.test,
+                **self._texts(item['text']),
+                category=item['category'],
+                exposure_time=item['exposure_time'],
+                answer_time=item['answer_time'],
+                order=self.next_order,
+                image=image,
+                content_hash=item['hash'],
+            ))
+            self.next_order += 1
+
+        if self.dry_run or not questions:
+            return
+
+        Question.objects.bulk_create(questions, batch_size=self.batch_size)
+        answers = []
+        for question, item in zip(questions, new_items):
+            answers.append(Answer(question=question, is_correct=True, **self._texts(item['correct'])))
+            for texts in item['wrong']:
+                answers.append(Answer(question=question, is_correct=False, **self._texts(texts)))
+        Answer.objects.bulk_create(answers, batch_size=self.batch_size)
+
+    def _texts(self, texts):
+        # Пустой перевод - None, чтобы сработал откат modeltranslation на русский
+        return {f'text_{lang}': texts[lang] or None for lang in LANGS}
+
+    def _queue_image(self, img_name):
+        """Ставит копирование картинки в пул потоков и возвращает значение поля image."""
+        if not img_name:
+            return None
+        source_path = os.path.join(self.source_images_dir, img_name)
+        if not os.path.exists(source_path):
+            self.stats['missing_images'] += 1
+            return None
+        self.stats['images'] += 1
+        if not self.dry_run:
+            target_path = os.path.join(self.target_images_dir, img_name)
+            self.copies.append(self.pool.submit(copy_image, source_path, target_path))
+        return f'questions/{img_name}'
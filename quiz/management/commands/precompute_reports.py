@@ -0,0 +1,77 @@
+import itertools
+from collections import Counter
+from django.core.management.base import BaseCommand, CommandError
+from quiz import report_cache
+from quiz.ai_service import generate_report_uncached
+from quiz.blueprints import get_test_blueprint
+
+
+class Command(BaseCommand):
+    help = 'Прогрев кеша ИИ-анализов: генерирует отчеты для всех возможных результатов IQ-теста'
+
+    def add_arguments(self, parser):
+        parser.add_argument('test_id', type=int, help='ID теста')
+        parser.add_argument('--languages', nargs='+', default=['ru', 'kk', 'en'], help='Языки отчетов')
+        parser.add_argument('--audience', nargs='+', default=['user', 'recruiter'],
+                            choices=['user', 'recruiter'], help='Для кого анализ')
+        parser.add_argument('--limit', type=int, default=0,
+                            help='Максимум новых отчетов за запуск (0 - без ограничений)')
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать, сколько отчетов нужно')
+
+    def handle(self, *args, **options):
+        test = get_test_blueprint(options['test_id'])
+        if test is None:
+            raise CommandError(f"Тест {options['test_id']} не найден")
+        if test.test_type == 'psychology':
+            raise CommandError('Психологические отчеты зависят от конкретных ответов и не кешируются')
+
+        total_questions = len(test.question_ids)
+        if test.questions_count > 0:
+            total_questions = min(total_questions, test.questions_count)
+
+        # Сколько вопросов каждой категории может попасть в попытку
+        per_category = Counter(q.get_category_display() for q in test.questions.values())
+        categories = sorted(per_category)
+        ranges = [range(min(per_category[c], total_questions) + 1) for c in categories]
+
+        combos = 0
+        generated = 0
+        skipped = 0
+        for counts in itertools.product(*ranges):
+            total_score = sum(counts)
+            if total_score > total_questions:
+                continue
+            # В finish_test в статистику попадают только категории с верными ответами
+            category_stats = {c: n for c, n in zip(categories, counts) if n}
+
+            for language in options['languages']:
+                for analysis_for in options['audience']:
+                    combos += 1
+                    if options['dry_run']:
+                        continue
+                    key = report_cache.make_key('iq', language, analysis_for, total_score,
+                                                total_questions, category_stats)
+                    if report_cache.lookup(key) is not None:
+                        skipped += 1
+                        continue
+
+                    text, from_ai = generate_report_uncached(
+                        report_cache.NAME_PLACEHOLDER, category_stats, total_score, 'iq', language,
+                        None, total_questions, analysis_for,
+                    )
+                    if not from_ai:
+                        raise CommandError('ИИ недоступен, прогрев остановлен')
+                    report_cache.store(key, text)
+                    generated += 1
+                    if generated % 50 == 0:
+                        self.stdout.write(f'Сгенерировано: {generated}')
+                    if options['limit'] and generated >= options['limit']:
+                        self.stdout.write(self.style.WARNING('Достигнут --limit, остановка'))
+                        return self._report(combos, generated, skipped)
+
+        self._report(combos, generated, skipped)
+
+    def _report(self, combos, generated, skipped):
+        self.stdout.write(self.style.SUCCESS(
+            f'Комбинаций: {combos}, сгенерировано: {generated}, уже было в кеше: {skipped}'
+        ))
@@ -0,0 +1,29 @@
+import time
+from django.core.management.base import BaseCommand
+from quiz.score_stats import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает гистограммы баллов (процентили) по таблице результатов, читая ее кусками'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--test-id', type=int, help='Только этот тест')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Результатов за один запрос')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        self._reported = 0
+        scanned, buckets = rebuild(
+            test_id=options['test_id'],
+            chunk_size=max(1, options['chunk_size']),
+            progress=self._progress,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Готово за {time.monotonic() - started:.1f} с: результатов {scanned}, корзин {buckets}'
+        ))
+
+    def _progress(self, scanned):
+        # Строка на каждые ~100 тысяч прочитанных результатов
+        if scanned // 100000 > self._reported:
+            self._reported = scanned // 100000
+            self.stdout.write(f'  прочитано {scanned}')
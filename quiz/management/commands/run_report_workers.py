@@ -0,0 +1,73 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from quiz.ai_service import model_registry
+from quiz.report_jobs import claim_jobs, requeue_stale_jobs, run_job
+
+
+def _run_in_thread(job_id):
+    # У каждого потока свое соединение с БД - закрываем его после задачи
+    try:
+        return run_job(job_id)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Воркеры генерации ИИ-отчетов (обрабатывают очередь ReportJob)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.AI_REPORT_WORKERS,
+                            help='Сколько отчетов генерировать параллельно')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Пауза между опросами пустой очереди (сек)')
+        parser.add_argument('--stale-after', type=int, default=600,
+                            help='Через сколько секунд зависшая задача возвращается в очередь')
+        parser.add_argument('--once', action='store_true',
+                            help='Обработать текущую очередь и выйти')
+
+    def handle(self, *args, **options):
+        workers = max(1, options['workers'])
+        poll_interval = options['poll_interval']
+        self.stdout.write(f'Запуск воркеров отчетов: {workers} поток(а)')
+        # Модель выбираем сразу, а не в первой задаче
+        model_registry.warm_up()
+
+        processed = 0
+        in_flight = set()
+        last_stale_check = 0
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                while True:
+                    if time.monotonic() - last_stale_check > 60:
+                        requeued = requeue_stale_jobs(options['stale_after'])
+                        if requeued:
+                            self.stdout.write(self.style.WARNING(f'Возвращено в очередь зависших задач: {requeued}'))
+                        last_stale_check = time.monotonic()
+
+                    free_slots = workers - len(in_flight)
+                    if free_slots > 0:
+                        for job_id in claim_jobs(free_slots):
+                            in_flight.add(pool.submit(_run_in_thread, job_id))
+
+                    if not in_flight:
+                        if options['once']:
+                            break
+                        time.sleep(poll_interval)
+                        continue
+
+                    done, in_flight = wait(in_flight, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            status = future.result()
+                            processed += 1
+                            self.stdout.write(f'Задача обработана: {status}')
+                        except Exception as e:
+                            self.stdout.write(self.style.ERROR(f'Ошибка воркера: {e}'))
+            except KeyboardInterrupt:
+                self.stdout.write('Остановка...')
+
+        self.stdout.write(self.style.SUCCESS(f'Готово. Обработано задач: {processed}'))
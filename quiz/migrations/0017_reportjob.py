@@ -0,0 +1,33 @@
+# Generated by Django 5.2.8 on 2026-10-18 20:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quiz', '0016_test_test_audience'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('running', 'Генерируется'), ('done', 'Готово'), ('failed', 'Ошибка')], default='pending', max_length=10, verbose_name='Статус')),
+                ('payload', models.JSONField(default=dict, verbose_name='Параметры отчета')),
+                ('attempts', models.IntegerField(default=0, verbose_name='Попыток')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='Последняя ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('result', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='report_job', to='quiz.usertestresult')),
+            ],
+            options={
+                'verbose_name': 'Задача ИИ-отчета',
+                'verbose_name_plural': 'Задачи ИИ-отчетов',
+                'indexes': [models.Index(fields=['status', 'created_at'], name='quiz_reportjob_queue_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.8 on 2026-10-18 20:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quiz', '0017_reportjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AIReportCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True, verbose_name='Хеш входных данных')),
+                ('text', models.TextField(verbose_name='Текст анализа')),
+                ('hits', models.IntegerField(default=0, verbose_name='Попаданий')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name': 'Кеш ИИ-анализа',
+                'verbose_name_plural': 'Кеш ИИ-анализов',
+            },
+        ),
+    ]
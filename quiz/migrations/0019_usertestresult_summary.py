@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 20:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quiz', '0018_aireportcache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usertestresult',
+            name='summary',
+            field=models.JSONField(blank=True, null=True, verbose_name='Сводка результата'),
+        ),
+    ]
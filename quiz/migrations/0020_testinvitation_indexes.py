@@ -0,0 +1,40 @@
+# Generated by Django 5.2.8 on 2026-10-18 20:38
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Lower
+
+
+def lowercase_emails(apps, schema_editor):
+    # Поиск по началу email работает по индексу только с учетом регистра,
+    # поэтому храним адреса в нижнем регистре
+    TestInvitation = apps.get_model('quiz', 'TestInvitation')
+    TestInvitation.objects.update(candidate_email=Lower('candidate_email'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quiz', '0019_usertestresult_summary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(lowercase_emails, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='testinvitation',
+            index=models.Index(fields=['recruiter', '-created_at', '-id'], name='quiz_invite_list_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='testinvitation',
+            index=models.Index(fields=['recruiter', 'completed', '-created_at', '-id'], name='quiz_invite_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='testinvitation',
+            index=models.Index(fields=['recruiter', 'test', '-created_at'], name='quiz_invite_test_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='testinvitation',
+            index=models.Index(fields=['recruiter', 'candidate_email'], name='quiz_invite_email_idx', opclasses=['int8_ops', 'varchar_pattern_ops']),
+        ),
+    ]
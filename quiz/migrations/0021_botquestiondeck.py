@@ -0,0 +1,33 @@
+# Generated by Django 5.2.8 on 2026-10-18 20:45
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quiz', '0020_testinvitation_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BotQuestionDeck',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(choices=[('logic', 'Логика'), ('math', 'Математика'), ('spatial', 'Пространственное мышление'), ('memory', 'Память'), ('Multi_table', 'Таблица умножения'), ('psychology', 'психология прием на работу')], max_length=20)),
+                ('question_ids', models.BinaryField(default=bytes)),
+                ('cursor', models.PositiveIntegerField(default=0)),
+                ('bank_version', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bot_decks', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Колода вопросов бота',
+                'verbose_name_plural': 'Колоды вопросов бота',
+                'constraints': [models.UniqueConstraint(fields=('user', 'category'), name='quiz_botdeck_user_category_uniq')],
+            },
+        ),
+    ]
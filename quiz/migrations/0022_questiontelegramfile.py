@@ -0,0 +1,30 @@
+# Generated by Django 5.2.8 on 2026-10-18 20:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quiz', '0021_botquestiondeck'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionTelegramFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bot_id', models.BigIntegerField()),
+                ('image_name', models.CharField(max_length=255)),
+                ('file_id', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now=True)),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='telegram_files', to='quiz.question')),
+            ],
+            options={
+                'verbose_name': 'Файл Telegram для вопроса',
+                'verbose_name_plural': 'Файлы Telegram для вопросов',
+                'constraints': [models.UniqueConstraint(fields=('question', 'bot_id'), name='quiz_question_tgfile_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.8 on 2026-10-18 21:01
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quiz', '0023_question_content_hash'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='botresult',
+            index=models.Index(fields=['user', 'question'], name='quiz_botresult_user_q_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['category'], name='quiz_question_category_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usertestresult',
+            index=models.Index(fields=['user', 'date_taken'], name='quiz_result_user_date_idx'),
+        ),
+    ]
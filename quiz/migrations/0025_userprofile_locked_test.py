@@ -0,0 +1,32 @@
+# Generated by Django 5.2.8 on 2026-10-18 21:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_locked_test(apps, schema_editor):
+    # Выбранный тест = тест самого первого результата пользователя
+    UserProfile = apps.get_model('quiz', 'UserProfile')
+    UserTestResult = apps.get_model('quiz', 'UserTestResult')
+    first_test = (
+        UserTestResult.objects.filter(user_id=OuterRef('user_id'))
+        .order_by('date_taken').values('test_id')[:1]
+    )
+    UserProfile.objects.update(locked_test_id=Subquery(first_test))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quiz', '0024_hot_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='locked_test',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='quiz.test', verbose_name='Выбранный тест (Free)'),
+        ),
+        migrations.RunPython(backfill_locked_test, migrations.RunPython.noop),
+    ]
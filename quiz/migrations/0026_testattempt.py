@@ -0,0 +1,37 @@
+# Generated by Django 5.2.8 on 2026-10-18 21:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quiz', '0025_userprofile_locked_test'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TestAttempt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_key', models.CharField(blank=True, max_length=40, null=True)),
+                ('seed', models.BigIntegerField()),
+                ('content_fingerprint', models.BigIntegerField()),
+                ('answers', models.BinaryField()),
+                ('locked_steps', models.BinaryField()),
+                ('current_index', models.PositiveIntegerField(default=0)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True)),
+                ('test', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='quiz.test')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='test_attempts', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Прохождение теста',
+                'verbose_name_plural': 'Прохождения тестов',
+                'constraints': [models.UniqueConstraint(condition=models.Q(('user__isnull', False)), fields=('user', 'test'), name='quiz_attempt_user_test_uniq'), models.UniqueConstraint(condition=models.Q(('session_key__isnull', False)), fields=('session_key', 'test'), name='quiz_attempt_session_test_uniq')],
+            },
+        ),
+    ]
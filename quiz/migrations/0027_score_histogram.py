@@ -0,0 +1,61 @@
+# Generated by Django 5.2.8 on 2026-10-18 21:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_score_histograms(apps, schema_editor):
+    # Результаты кандидатов (по приглашению) - аудитория recruiter; язык старых результатов неизвестен
+    UserTestResult = apps.get_model('quiz', 'UserTestResult')
+    TestInvitation = apps.get_model('quiz', 'TestInvitation')
+    ScoreHistogram = apps.get_model('quiz', 'ScoreHistogram')
+    invited = TestInvitation.objects.filter(result__isnull=False).values('result_id')
+    UserTestResult.objects.filter(pk__in=invited).update(audience='recruiter')
+    # Один GROUP BY: строк в ответе столько, сколько корзин, а не результатов
+    buckets = (
+        UserTestResult.objects.values('test_id', 'language', 'audience', 'score')
+        .annotate(n=Count('id')).order_by()
+    )
+    ScoreHistogram.objects.bulk_create(
+        (ScoreHistogram(test_id=b['test_id'], language=b['language'], audience=b['audience'],
+                        score=b['score'], count=b['n']) for b in buckets.iterator()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quiz', '0026_testattempt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usertestresult',
+            name='audience',
+            field=models.CharField(blank=True, default='user', max_length=10, verbose_name='Аудитория'),
+        ),
+        migrations.AddField(
+            model_name='usertestresult',
+            name='language',
+            field=models.CharField(blank=True, default='', max_length=10, verbose_name='Язык'),
+        ),
+        migrations.CreateModel(
+            name='ScoreHistogram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('language', models.CharField(blank=True, default='', max_length=10)),
+                ('audience', models.CharField(blank=True, default='', max_length=10)),
+                ('score', models.IntegerField()),
+                ('count', models.BigIntegerField(default=0)),
+                ('test', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='quiz.test')),
+            ],
+            options={
+                'verbose_name': 'Распределение баллов',
+                'verbose_name_plural': 'Распределения баллов',
+                'constraints': [models.UniqueConstraint(fields=('test', 'language', 'audience', 'score'), name='quiz_score_histogram_uniq')],
+            },
+        ),
+        migrations.RunPython(backfill_score_histograms, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,10 @@
 import uuid
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db.models.signals import post_init, post_save, post_delete
 from django.dispatch import receiver
+from django.core.cache import caches
+from .versioning import BOT_USERS_VERSION, CATALOG_VERSION, CONTENT_VERSION, bump_version
 from django.utils.translation import gettext_lazy as _ # Для перевода
 # Категории
 CATEGORY_CHOICES = [
@@ -73,6 +75,8 @@ class Question(models.Model):
         verbose_name="Время на ответ (сек)", 
         help_text="Лимит времени конкретно на этот вопрос."
     )
+    # Хеш содержимого строки CSV (см. import_questions) - повторный импорт не создает дублей
+    content_hash = models.CharField(max_length=64, blank=True, default='', editable=False)
 
     def __str__(self):
         return self.text[:50]
@@ -80,6 +84,17 @@ class Question(models.Model):
     class Meta:
         verbose_name = "Вопрос"
         verbose_name_plural = "Вопросы"
+        constraints = [
+            models.UniqueConstraint(
+                fields=['test', 'content_hash'],
+                condition=~models.Q(content_hash=''),
+                name='quiz_question_test_hash_uniq',
+            ),
+        ]
+        indexes = [
+            # Банк вопросов категории (колода бота, импорт)
+            models.Index(fields=['category'], name='quiz_question_category_idx'),
+        ]
 
 class Answer(models.Model):
     question = models.ForeignKey(Question, related_name='answers', on_delete=models.CASCADE)
@@ -99,10 +114,124 @@ class UserTestResult(models.Model):
     score = models.IntegerField(verbose_name="Баллы")
     ai_analysis = models.TextField(blank=True, null=True, verbose_name="Анализ ИИ")
     date_taken = models.DateTimeField(auto_now_add=True)
+    # Готовая сводка для страницы результата (см. result_summary.py)
+    summary = models.JSONField(null=True, blank=True, verbose_name="Сводка результата")
+    # Язык прохождения и аудитория (user - сам пользователь, recruiter - кандидат по приглашению)
+    # нужны для распределения баллов ScoreHistogram
+    language = models.CharField(max_length=10, blank=True, default='', verbose_name="Язык")
+    audience = models.CharField(max_length=10, blank=True, default='user', verbose_name="Аудитория")
     
     class Meta:
         verbose_name = "Результат теста"
         verbose_name_plural = "Результаты тестов"
+        indexes = [
+            # Первый тест пользователя (лимит бесплатного тарифа) и история в профиле
+            models.Index(fields=['user', 'date_taken'], name='quiz_result_user_date_idx'),
+        ]
+
+class ScoreHistogram(models.Model):
+    """
+    Сколько результатов теста набрали данный балл (см. score_stats.py).
+    Одна строка на (тест, язык, аудиторию, балл); finish_test увеличивает count атомарно.
+    """
+    test = models.ForeignKey(Test, on_delete=models.CASCADE, related_name='+')
+    language = models.CharField(max_length=10, blank=True, default='')
+    audience = models.CharField(max_length=10, blank=True, default='')
+    score = models.IntegerField()
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Распределение баллов"
+        verbose_name_plural = "Распределения баллов"
+        constraints = [
+            models.UniqueConstraint(fields=['test', 'language', 'audience', 'score'], name='quiz_score_histogram_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.test_id} {self.language}/{self.audience}: {self.score} x{self.count}"
+
+class TestAttempt(models.Model):
+    """
+    Незавершенное прохождение теста (см. attempts.py).
+    Порядок вопросов и ответов не хранится: он заново выводится из seed и
+    отпечатка содержимого теста, поэтому состояние - это seed плюс по байту на ответ.
+    """
+    # Вошедший пользователь (попытку можно продолжить с любого устройства) или сессия гостя
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True, related_name='test_attempts')
+    session_key = models.CharField(max_length=40, null=True, blank=True)
+    test = models.ForeignKey(Test, on_delete=models.CASCADE, related_name='+')
+    seed = models.BigIntegerField()
+    # TestBlueprint.fingerprint на момент старта - если набор вопросов изменился, попытка начинается заново
+    content_fingerprint = models.BigIntegerField()
+    # По байту на шаг: номер выбранного варианта + 1 (0 - нет ответа)
+    answers = models.BinaryField()
+    # Битовая маска шагов, на которые нельзя вернуться (вопросы на память)
+    locked_steps = models.BinaryField()
+    current_index = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return f"Attempt #{self.pk} ({self.test_id}, {self.current_index})"
+
+    class Meta:
+        verbose_name = "Прохождение теста"
+        verbose_name_plural = "Прохождения тестов"
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'test'], condition=models.Q(user__isnull=False), name='quiz_attempt_user_test_uniq',
+            ),
+            models.UniqueConstraint(
+                fields=['session_key', 'test'], condition=models.Q(session_key__isnull=False), name='quiz_attempt_session_test_uniq',
+            ),
+        ]
+
+class ReportJob(models.Model):
+    """Задача на генерацию ИИ-отчета (выполняется командой run_report_workers)."""
+    STATUS_CHOICES = [
+        ('pending', 'В очереди'),
+        ('running', 'Генерируется'),
+        ('done', 'Готово'),
+        ('failed', 'Ошибка'),
+    ]
+
+    result = models.OneToOneField(UserTestResult, on_delete=models.CASCADE, related_name='report_job')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', verbose_name="Статус")
+    # Аргументы для generate_test_report
+    payload = models.JSONField(default=dict, verbose_name="Параметры отчета")
+    attempts = models.IntegerField(default=0, verbose_name="Попыток")
+    last_error = models.TextField(blank=True, default='', verbose_name="Последняя ошибка")
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Report job #{self.pk} ({self.status})"
+
+    class Meta:
+        verbose_name = "Задача ИИ-отчета"
+        verbose_name_plural = "Задачи ИИ-отчетов"
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='quiz_reportjob_queue_idx'),
+        ]
+
+class AIReportCache(models.Model):
+    """
+    Готовые ИИ-анализы для одинаковых профилей результатов (IQ-тесты).
+    Вместо имени пользователя в тексте стоит плейсхолдер (см. report_cache.py).
+    """
+    key = models.CharField(max_length=64, unique=True, verbose_name="Хеш входных данных")
+    text = models.TextField(verbose_name="Текст анализа")
+    hits = models.IntegerField(default=0, verbose_name="Попаданий")
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.key[:12]}... ({self.hits} hits)"
+
+    class Meta:
+        verbose_name = "Кеш ИИ-анализа"
+        verbose_name_plural = "Кеш ИИ-анализов"
 
 class UserAnswer(models.Model):
     result = models.ForeignKey(UserTestResult, related_name='details', on_delete=models.CASCADE)
@@ -120,6 +249,56 @@ class BotResult(models.Model):
     def __str__(self):
         return f"{self.user} - {self.question} - {self.is_correct}"
 
+    class Meta:
+        indexes = [
+            # История ответов пользователя в тренажере
+            models.Index(fields=['user', 'question'], name='quiz_botresult_user_q_idx'),
+        ]
+
+class BotQuestionDeck(models.Model):
+    """
+    Перемешанная "колода" вопросов пользователя бота по категории (см. bot_deck.py).
+    Следующий вопрос - элемент под курсором, без перебора истории ответов.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='bot_decks')
+    category = models.CharField(max_length=20, choices=CATEGORY_CHOICES)
+    # id вопросов, упакованные в array('I') - 4 байта на вопрос
+    question_ids = models.BinaryField(default=bytes)
+    cursor = models.PositiveIntegerField(default=0)
+    # Версия банка вопросов (CONTENT_VERSION), из которой собрана колода
+    bank_version = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user} - {self.category} ({self.cursor})"
+
+    class Meta:
+        verbose_name = "Колода вопросов бота"
+        verbose_name_plural = "Колоды вопросов бота"
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'category'], name='quiz_botdeck_user_category_uniq'),
+        ]
+
+class QuestionTelegramFile(models.Model):
+    """file_id картинки вопроса в Telegram: после первой загрузки фото шлется по id, без байтов."""
+    question = models.ForeignKey(Question, on_delete=models.CASCADE, related_name='telegram_files')
+    # file_id действителен только для бота, который загрузил файл
+    bot_id = models.BigIntegerField()
+    # Имя файла картинки на момент загрузки - если картинку заменили, грузим заново
+    image_name = models.CharField(max_length=255)
+    file_id = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.question_id} @ {self.bot_id}"
+
+    class Meta:
+        verbose_name = "Файл Telegram для вопроса"
+        verbose_name_plural = "Файлы Telegram для вопросов"
+        constraints = [
+            models.UniqueConstraint(fields=['question', 'bot_id'], name='quiz_question_tgfile_uniq'),
+        ]
+
 class TestInvitation(models.Model):
     # Кто отправил (Рекрутер)
     recruiter = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='sent_invitations')
@@ -140,10 +319,29 @@ class TestInvitation(models.Model):
 
     def __str__(self):
         return f"Invite for {self.candidate_email} to {self.test.title}"
+
+    class Meta:
+        indexes = [
+            # Список приглашений рекрутера (keyset-пагинация по created_at, id)
+            models.Index(fields=['recruiter', '-created_at', '-id'], name='quiz_invite_list_idx'),
+            # Фильтр по статусу
+            models.Index(fields=['recruiter', 'completed', '-created_at', '-id'], name='quiz_invite_status_idx'),
+            # Фильтр по тесту
+            models.Index(fields=['recruiter', 'test', '-created_at'], name='quiz_invite_test_idx'),
+            # Поиск по началу email (LIKE 'abc%'); opclasses учитывается только в PostgreSQL
+            models.Index(fields=['recruiter', 'candidate_email'], name='quiz_invite_email_idx',
+                         opclasses=['int8_ops', 'varchar_pattern_ops']),
+        ]
     
 class UserProfile(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='profile')
     plan = models.CharField(max_length=10, choices=PLAN_CHOICES, default='free')
+    # Тест первого результата - единственный доступный на бесплатном тарифе.
+    # Ставится один раз в finish_test, чтобы не искать первый результат на каждой странице
+    locked_test = models.ForeignKey(
+        Test, on_delete=models.SET_NULL, null=True, blank=True, related_name='+',
+        verbose_name="Выбранный тест (Free)",
+    )
     
     def __str__(self):
         return f"{self.user.username} - {self.get_plan_display()}"
@@ -155,9 +353,107 @@ def create_user_profile(sender, instance, created, **kwargs):
         UserProfile.objects.create(user=instance)
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
-def save_user_profile(sender, instance, **kwargs):
+def save_user_profile(sender, instance, update_fields=None, **kwargs):
+    # Вход на сайт обновляет только last_login - профиль трогать незачем
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
     # try/except нужен на случай, если профиль уже есть
     try:
         instance.profile.save()
     except UserProfile.DoesNotExist:
-        UserProfile.objects.create(user=instance)
\ No newline at end of file
+        UserProfile.objects.create(user=instance)
+
+# Любое изменение содержимого тестов сбрасывает кеш чертежей во всех воркерах.
+# Версию поднимаем после коммита, чтобы другие процессы не успели закешировать
+# еще не сохраненные данные.
+@receiver([post_save, post_delete], sender=Test)
+@receiver([post_save, post_delete], sender=Question)
+@receiver([post_save, post_delete], sender=Answer)
+def bump_content_version(sender, **kwargs):
+    transaction.on_commit(lambda: bump_version(CONTENT_VERSION))
+
+# Каталог на главной (catalog.py) зависит только от самих тестов
+@receiver([post_save, post_delete], sender=Test)
+def bump_catalog_version(sender, **kwargs):
+    transaction.on_commit(lambda: bump_version(CATALOG_VERSION))
+
+# Счетчики приглашений рекрутера кешируются (см. views.hr_dashboard) - сбрасываем при изменениях
+def invitation_counts_key(recruiter_id):
+    return f'quiz:hr_counts:{recruiter_id}'
+
+@receiver([post_save, post_delete], sender=TestInvitation)
+def reset_invitation_counts(sender, instance, **kwargs):
+    key = invitation_counts_key(instance.recruiter_id)
+    transaction.on_commit(lambda: caches['shared'].delete(key))
+
+# Пользователи бота кешируются по chat_id (см. bot_context). Версию поднимаем,
+# только когда меняется то, что лежит в TgUser: привязка чата, язык, категория,
+# тариф. Остальные сохранения (в том числе profile.save() на каждый save()
+# пользователя, locked_test и т.п.) кеш бота не сбрасывают
+BOT_USER_FIELDS = {
+    settings.AUTH_USER_MODEL: ('telegram_chat_id', 'language', 'bot_category'),
+    'quiz.UserProfile': ('plan',),
+}
+
+def _bot_fields(instance):
+    return BOT_USER_FIELDS[instance._meta.label]
+
+def _bot_values(instance):
+    # Только загруженные поля: обращение к отложенному (only/defer) стоило бы запроса
+    return {name: instance.__dict__[name] for name in _bot_fields(instance) if name in instance.__dict__}
+
+def _differs_from_defaults(instance):
+    return any(
+        value != instance._meta.get_field(name).get_default() for name, value in _bot_values(instance).items()
+    )
+
+@receiver(post_init, sender=settings.AUTH_USER_MODEL)
+@receiver(post_init, sender=UserProfile)
+def remember_bot_fields(sender, instance, **kwargs):
+    instance._bot_values = _bot_values(instance)
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_save, sender=UserProfile)
+def reset_bot_users(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and not set(update_fields) & set(_bot_fields(instance)):
+        return
+    current = _bot_values(instance)
+    if created:
+        # Новый пользователь/профиль виден боту, только если отличается от того,
+        # что бот и так считает по умолчанию (чат не привязан, тариф free)
+        changed = _differs_from_defaults(instance)
+    else:
+        changed = current != instance._bot_values
+    instance._bot_values = current
+    if changed:
+        transaction.on_commit(lambda: bump_version(BOT_USERS_VERSION))
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=UserProfile)
+def reset_deleted_bot_user(sender, instance, **kwargs):
+    if _differs_from_defaults(instance):
+        transaction.on_commit(lambda: bump_version(BOT_USERS_VERSION))
+
+def first_result_test_id(user_id):
+    """Тест самого первого результата пользователя (по нему определяется locked_test)."""
+    return (
+        UserTestResult.objects.filter(user_id=user_id)
+        .order_by('date_taken').values_list('test_id', flat=True).first()
+    )
+
+# Удалили первый результат - выбранным становится тест следующего
+@receiver(post_delete, sender=UserTestResult)
+def reset_locked_test(sender, instance, **kwargs):
+    if instance.user_id is None:
+        return
+    profiles = UserProfile.objects.filter(user_id=instance.user_id, locked_test_id=instance.test_id)
+    if profiles.exists():
+        profiles.update(locked_test_id=first_result_test_id(instance.user_id))
+
+# Удаленный результат больше не участвует в процентилях
+@receiver(post_delete, sender=UserTestResult)
+def forget_result_score(sender, instance, **kwargs):
+    ScoreHistogram.objects.filter(
+        test_id=instance.test_id, language=instance.language, audience=instance.audience,
+        score=instance.score, count__gt=0,
+    ).update(count=models.F('count') - 1)
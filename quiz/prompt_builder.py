@@ -0,0 +1,186 @@
+"""
+Компактный блок ответов для промпта психологического отчета.
+
+Раньше в промпт шел полный текст каждого вопроса, выбранного и правильного
+ответа - промпт рос линейно с длиной теста, и именно он определял время и
+цену генерации. Теперь:
+
+- вопросы кодируются короткими кодами Q1..Qn (порядок попытки), карта
+  код -> id вопроса возвращается вместе с текстом;
+- итоги по категориям (шкалам) идут всегда - на них строятся выводы;
+- подробно расписываются только ошибки, верные ответы - списком кодов;
+- блок укладывается в бюджет AI_PROMPT_TOKEN_BUDGET: при нехватке места
+  первыми выпадают список верных, затем пропуски, затем ошибки
+  (по очереди из каждой категории, чтобы ни одна шкала не осталась без примеров).
+
+Токены оцениваем приближенно (символы / 4) - точный токенизатор Gemini
+требует сетевого запроса.
+"""
+from dataclasses import dataclass, field
+from itertools import zip_longest
+
+# Длинные тексты вопросов/ответов обрезаем до стольких символов
+MAX_TEXT_CHARS = 160
+CHARS_PER_TOKEN = 4
+
+HEADERS = {
+    'ru': {
+        'title': 'Детальные ответы кандидата:',
+        'question': 'Вопрос:',
+        'selected': 'Выбранный ответ:',
+        'correct': 'Правильный ответ:',
+        'result': 'Результат:',
+        'result_ok': '✓ Правильно',
+        'result_fail': '✗ Неправильно',
+        'legend': 'Формат: Q<номер> [категория] вопрос -> выбранный ответ | правильный ответ. '
+                  'Подробно приведены только ошибки; верные ответы учтены в итогах по категориям.',
+        'categories': 'Итоги по категориям (верно/всего):',
+        'wrong': 'Ошибки:',
+        'unanswered': 'Без ответа:',
+        'right': 'Верно:',
+        'omitted': 'еще не показано',
+    },
+    'kk': {
+        'title': 'Кандидаттың толық жауаптары:',
+        'question': 'Сұрақ:',
+        'selected': 'Таңдалған жауап:',
+        'correct': 'Дұрыс жауап:',
+        'result': 'Нәтиже:',
+        'result_ok': '✓ Дұрыс',
+        'result_fail': '✗ Дұрыс емес',
+        'legend': 'Пішім: Q<нөмір> [санат] сұрақ -> таңдалған жауап | дұрыс жауап. '
+                  'Тек қателер толық көрсетілген; дұрыс жауаптар санаттар бойынша қорытындыда ескерілген.',
+        'categories': 'Санаттар бойынша қорытынды (дұрыс/барлығы):',
+        'wrong': 'Қателер:',
+        'unanswered': 'Жауапсыз:',
+        'right': 'Дұрыс:',
+        'omitted': 'тағы көрсетілмеген',
+    },
+    'en': {
+        'title': 'Detailed candidate answers:',
+        'question': 'Question:',
+        'selected': 'Selected answer:',
+        'correct': 'Correct answer:',
+        'result': 'Result:',
+        'result_ok': '✓ Correct',
+        'result_fail': '✗ Incorrect',
+        'legend': 'Format: Q<number> [category] question -> selected answer | correct answer. '
+                  'Only mistakes are listed in detail; correct answers are counted in the category totals.',
+        'categories': 'Category totals (correct/total):',
+        'wrong': 'Mistakes:',
+        'unanswered': 'Unanswered:',
+        'right': 'Correct:',
+        'omitted': 'more not shown',
+    },
+}
+
+
+@dataclass
+class AnswersContext:
+    text: str
+    # Код в промпте -> id вопроса
+    codes: dict = field(default_factory=dict)
+    tokens_before: int = 0
+    tokens_after: int = 0
+    # Сколько ошибок/пропусков не поместилось в бюджет
+    dropped: int = 0
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _short(text):
+    text = ' '.join(str(text or '').split())
+    return text if len(text) <= MAX_TEXT_CHARS else text[:MAX_TEXT_CHARS - 1] + '…'
+
+
+def verbose_answers_context(detailed_answers, language):
+    """Прежний формат: все ответы целиком. Нужен только для сравнения размера."""
+    h = HEADERS.get(language, HEADERS['ru'])
+    text = f"\n\n{h['title']}\n"
+    for idx, answer_data in enumerate(detailed_answers, 1):
+        text += f"\n{idx}. {h['question']} {answer_data['question_text']}\n"
+        text += f"   {h['selected']} {answer_data['selected_answer_text']}\n"
+        text += f"   {h['correct']} {answer_data['correct_answer_text']}\n"
+        result_text = h['result_ok'] if answer_data['is_correct'] else h['result_fail']
+        text += f"   {h['result']} {result_text}\n"
+    return text
+
+
+def _round_robin(items_by_category):
+    """Ошибки по очереди из каждой категории."""
+    result = []
+    for group in zip_longest(*items_by_category.values()):
+        result.extend(item for item in group if item is not None)
+    return result
+
+
+def build_answers_context(detailed_answers, language, token_budget):
+    """Компактный блок ответов для промпта, не длиннее token_budget токенов (оценка)."""
+    if not detailed_answers:
+        return AnswersContext(text='')
+    h = HEADERS.get(language, HEADERS['ru'])
+
+    codes = {}
+    totals = {}
+    wrong = {}
+    unanswered = []
+    right = []
+    for idx, answer in enumerate(detailed_answers, 1):
+        code = f'Q{idx}'
+        # Старые задачи в очереди - без question_id/category
+        codes[code] = answer.get('question_id')
+        category = answer.get('category') or '-'
+        tally = totals.setdefault(category, [0, 0])
+        tally[1] += 1
+        if answer['is_correct']:
+            tally[0] += 1
+            right.append(code)
+        elif not answer.get('answered', True):
+            unanswered.append(code)
+        else:
+            wrong.setdefault(category, []).append(
+                f"{code} [{category}] {_short(answer['question_text'])} -> "
+                f"{_short(answer['selected_answer_text'])} | {_short(answer['correct_answer_text'])}"
+            )
+
+    # Обязательная часть: легенда и итоги по шкалам
+    lines = [h['legend'], h['categories']]
+    lines += [f"- {category}: {c}/{t}" for category, (c, t) in totals.items()]
+    used = estimate_tokens('\n'.join(lines))
+    dropped = 0
+
+    def take(title, items, joiner, count_dropped=True):
+        nonlocal used, dropped
+        if not items:
+            return
+        kept = []
+        cost = estimate_tokens(title) + 1
+        for item in items:
+            item_cost = estimate_tokens(item) + 1
+            if used + cost + item_cost > token_budget:
+                break
+            kept.append(item)
+            cost += item_cost
+        if kept:
+            lines.append(title + joiner + joiner.join(kept))
+            used += cost
+        left = len(items) - len(kept)
+        if left and count_dropped:
+            dropped += left
+            lines.append(f"({left} {h['omitted']})")
+
+    # По убыванию важности; верные ответы уже учтены в итогах - их список просто обрезаем
+    take(h['wrong'], _round_robin(wrong), '\n')
+    take(h['unanswered'], unanswered, ' ')
+    take(h['right'], right, ' ', count_dropped=False)
+
+    text = '\n\n' + '\n'.join(lines) + '\n'
+    return AnswersContext(
+        text=text,
+        codes=codes,
+        tokens_before=estimate_tokens(verbose_answers_context(detailed_answers, language)),
+        tokens_after=estimate_tokens(text),
+        dropped=dropped,
+    )
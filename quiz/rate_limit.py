@@ -0,0 +1,52 @@
+"""
+Ограничение частоты вызовов провайдера ИИ (token bucket).
+
+Лимит общий для всех потоков процесса: и воркеров очереди отчетов, и
+пакетной генерации generate_reports. Ключ - (провайдер, лимит), поэтому
+фейковый провайдер для офлайн-прогонов не расходует лимит Gemini.
+"""
+import threading
+import time
+from django.conf import settings
+
+
+class TokenBucket:
+    """Ограничение частоты: rate_per_minute вызовов, не больше burst подряд."""
+
+    def __init__(self, rate_per_minute, burst=1):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Ждет свободный токен; возвращает, сколько секунд пришлось ждать."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                pause = (1 - self._tokens) / self.rate
+            time.sleep(pause)
+            waited += pause
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def provider_limiter(rate_per_minute=None):
+    """Общий на процесс TokenBucket текущего провайдера ИИ (None - без ограничения)."""
+    rate = settings.AI_RATE_LIMIT_PER_MINUTE if rate_per_minute is None else rate_per_minute
+    if not rate:
+        return None
+    key = (settings.AI_PROVIDER, rate)
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = TokenBucket(rate)
+        return _limiters[key]
@@ -0,0 +1,263 @@
+"""
+Пакетная (пере)генерация ИИ-анализов для рекрутеров.
+
+Команда generate_reports выбирает результаты (по тесту, датам или
+приглашениям рекрутера) и генерирует отчеты в ограниченном пуле потоков:
+
+- задачи ReportJob забираются порциями, только когда для них есть
+  свободный поток, а захват задач в работе раз в HEARTBEAT_SECONDS
+  продлевается (started_at) - долгий пакет не теряет их из-за
+  requeue_stale_jobs; если задачу все же успели вернуть в очередь,
+  повторных вызовов провайдера для нее нет, а результат пишет тот, кто ее забрал;
+- не больше rate вызовов провайдера в минуту (rate_limit.py);
+- отчет, который не написал ИИ (ошибка, таймаут, открытый предохранитель),
+  повторяется с экспоненциальной паузой;
+- готовые тексты пишутся пачками: один bulk_update результатов и один
+  UPDATE задач на пачку.
+
+У результатов, сохраненных до очереди отчетов, нет ReportJob с параметрами
+отчета - backfill_jobs собирает их заново из UserAnswer по чертежу теста.
+
+Если и после повторов ИИ не ответил, уже существующий анализ не
+перезаписывается заглушкой; заглушку получают только результаты без анализа.
+"""
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone, translation
+from .ai_service import generate_report
+from .blueprints import get_test_blueprint
+from .models import ReportJob, TestInvitation, UserAnswer, UserTestResult
+from .rate_limit import provider_limiter
+from .report_jobs import UNAVAILABLE_TEXT
+from .scoring import score_attempt
+
+
+def select_results(test_id=None, date_from=None, date_to=None, recruiter=None, missing_only=False):
+    """Результаты для пакетной генерации (старым без ReportJob задачи создает backfill_jobs)."""
+    results = UserTestResult.objects.all()
+    if test_id:
+        results = results.filter(test_id=test_id)
+    if date_from:
+        results = results.filter(date_taken__gte=date_from)
+    if date_to:
+        results = results.filter(date_taken__lt=date_to)
+    if recruiter is not None:
+        # Результаты кандидатов, приглашенных этим рекрутером
+        results = results.filter(invitation__recruiter=recruiter)
+    if missing_only:
+        results = results.filter(Q(ai_analysis__isnull=True) | Q(ai_analysis=''))
+    return results.distinct()
+
+
+def backfill_jobs(result_ids):
+    """
+    Создает ReportJob для результатов, у которых его нет (сохранены до очереди
+    отчетов). Параметры отчета собираются как в finish_test: из UserAnswer
+    результата по текущему чертежу теста. Возвращает, для скольких
+    результатов собраны задачи.
+    """
+    results = list(
+        UserTestResult.objects.filter(pk__in=result_ids, report_job__isnull=True)
+        .select_related('user')
+        .annotate(invited=Exists(TestInvitation.objects.filter(result=OuterRef('pk'))))
+    )
+    if not results:
+        return 0
+    answers = defaultdict(list)
+    for result_id, question_id, answer_id in (
+        UserAnswer.objects.filter(result_id__in=[r.id for r in results])
+        .order_by('id')
+        .values_list('result_id', 'question_id', 'selected_answer_id')
+    ):
+        answers[result_id].append((question_id, answer_id))
+
+    jobs = []
+    for result in results:
+        test = get_test_blueprint(result.test_id)
+        rows = answers[result.id]
+        language = result.language or 'ru'
+        # Тексты вопросов в detailed_answers - на языке прохождения
+        with translation.override(language):
+            scored = score_attempt(test, [q_id for q_id, _ in rows],
+                                   {str(q_id): a_id for q_id, a_id in rows if a_id})
+        invited = result.invited or test.test_audience == 'recruiter'
+        jobs.append(ReportJob(result=result, status='done', payload={
+            'user_name': result.user.username if result.user else 'Candidate',
+            'category_stats': scored.category_stats,
+            'total_score': result.score,
+            'test_type': scored.test_type,
+            'language': language,
+            'detailed_answers': scored.detailed_answers,
+            'total_questions': len(rows),
+            'analysis_for': 'recruiter' if invited else 'user',
+        }))
+    # Параллельный backfill мог успеть создать часть задач
+    ReportJob.objects.bulk_create(jobs, ignore_conflicts=True)
+    return len(jobs)
+
+
+def requeue_results(result_ids):
+    """
+    Ставит отчеты результатов в обычную очередь run_report_workers заново
+    (действие на HR-панели). Задачи, которые сейчас генерируются, не трогаем.
+    """
+    return ReportJob.objects.filter(result_id__in=result_ids).exclude(status='running').update(
+        status='pending', attempts=0, last_error='', started_at=None, finished_at=None,
+    )
+
+
+def claim_batch(result_ids):
+    """
+    Забирает задачи результатов под пакетную генерацию. Метка - общее
+    started_at порции: по ней потом завершаем только свои задачи.
+    Возвращает (метка, [(job_id, result_id, payload, есть ли уже анализ)]).
+    """
+    marker = timezone.now()
+    ReportJob.objects.filter(result_id__in=result_ids).exclude(status='running').update(
+        status='running', started_at=marker,
+    )
+    jobs = list(
+        ReportJob.objects.filter(result_id__in=result_ids, status='running', started_at=marker)
+        .values_list('id', 'result_id', 'payload', 'result__ai_analysis')
+    )
+    return marker, [(job_id, result_id, payload, bool(analysis)) for job_id, result_id, payload, analysis in jobs]
+
+
+# Как часто продлевать захват задач в работе; должно быть заметно меньше
+# порога requeue_stale_jobs (run_report_workers --stale-after)
+HEARTBEAT_SECONDS = 30
+
+
+class BatchRunner:
+    def __init__(self, workers=4, rate_per_minute=None, retries=3, backoff=2.0, write_batch_size=50, progress=None,
+                 heartbeat_seconds=HEARTBEAT_SECONDS):
+        self.workers = max(1, workers)
+        self.limiter = provider_limiter(rate_per_minute)
+        self.retries = retries
+        self.backoff = backoff
+        self.write_batch_size = max(1, write_batch_size)
+        self.progress = progress
+        self.heartbeat_seconds = heartbeat_seconds
+        self.stats = {'total': 0, 'busy': 0, 'ai': 0, 'fallback': 0, 'kept': 0, 'lost': 0, 'retries': 0,
+                      'throttled_seconds': 0.0, 'seconds': 0.0}
+        self._lock = threading.Lock()
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def _heartbeat(self, claims):
+        """Продлевает захват задач в работе; задачи, которые уже вернули в очередь, помечает потерянными."""
+        now = timezone.now()
+        for claim in claims:
+            if claim['lost']:
+                continue
+            if ReportJob.objects.filter(pk=claim['job_id'], status='running', started_at=claim['marker']).update(
+                started_at=now,
+            ):
+                claim['marker'] = now
+            else:
+                claim['lost'] = True
+
+    def _generate(self, claim, payload):
+        """(текст, написал ли ИИ) с повторами или None, если задача уже не наша; выполняется в потоке пула."""
+        try:
+            for attempt in range(self.retries + 1):
+                if self.limiter is not None:
+                    self._count('throttled_seconds', self.limiter.acquire())
+                if claim['lost']:
+                    return None
+                text, from_ai = generate_report(**payload)
+                if from_ai:
+                    return text, True
+                if attempt < self.retries:
+                    self._count('retries')
+                    # Экспоненциальная пауза с разбросом, чтобы потоки не били в провайдера разом
+                    time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+            return text, False
+        finally:
+            connection.close()
+
+    def run(self, result_ids):
+        result_ids = list(result_ids)
+        self.stats['total'] = len(result_ids)
+        started = time.monotonic()
+        pending = []
+        done = 0
+        position = 0
+        in_flight = {}
+        heartbeat_at = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while position < len(result_ids) or in_flight:
+                free = self.workers - len(in_flight)
+                if free > 0 and position < len(result_ids):
+                    # Забираем ровно столько задач, сколько потоков свободно
+                    chunk = result_ids[position:position + free]
+                    position += len(chunk)
+                    marker, jobs = claim_batch(chunk)
+                    self.stats['busy'] += len(chunk) - len(jobs)
+                    for job_id, result_id, payload, has_analysis in jobs:
+                        claim = {'job_id': job_id, 'marker': marker, 'lost': False}
+                        in_flight[pool.submit(self._generate, claim, payload)] = (claim, result_id, has_analysis)
+                    if len(in_flight) < self.workers and position < len(result_ids):
+                        continue
+                if not in_flight:
+                    continue
+
+                finished, _ = wait(in_flight, timeout=self.heartbeat_seconds, return_when=FIRST_COMPLETED)
+                if time.monotonic() - heartbeat_at >= self.heartbeat_seconds:
+                    # В БД пишет только этот поток: потоки пула лишь читают флаг lost.
+                    # Готовые, но еще не записанные задачи тоже должны оставаться нашими
+                    self._heartbeat([claim for claim, _, _ in [*in_flight.values(), *pending]])
+                    heartbeat_at = time.monotonic()
+                for future in finished:
+                    claim, result_id, has_analysis = in_flight.pop(future)
+                    outcome = future.result()
+                    done += 1
+                    if outcome is None:
+                        self.stats['lost'] += 1
+                    else:
+                        text, from_ai = outcome
+                        if from_ai:
+                            self.stats['ai'] += 1
+                        elif has_analysis:
+                            # Не заменяем прежний анализ заглушкой
+                            self.stats['kept'] += 1
+                            text = None
+                        else:
+                            self.stats['fallback'] += 1
+                            text = text or UNAVAILABLE_TEXT
+                        pending.append((claim, result_id, text))
+                    if len(pending) >= self.write_batch_size:
+                        self._flush(pending)
+                        pending = []
+                    if self.progress:
+                        self.progress(done, self.stats['total'] - self.stats['busy'], time.monotonic() - started)
+        self._flush(pending)
+        self.stats['seconds'] = round(time.monotonic() - started, 2)
+        self.stats['throttled_seconds'] = round(self.stats['throttled_seconds'], 2)
+        return self.stats
+
+    def _flush(self, items):
+        if not items:
+            return
+        with transaction.atomic():
+            # Только задачи, которые все еще наши (не вернул в очередь requeue_stale_jobs)
+            current = dict(
+                ReportJob.objects.select_for_update()
+                .filter(pk__in=[claim['job_id'] for claim, _, _ in items], status='running')
+                .values_list('id', 'started_at')
+            )
+            ours = {claim['job_id'] for claim, _, _ in items if current.get(claim['job_id']) == claim['marker']}
+            self.stats['lost'] += len(items) - len(ours)
+            ReportJob.objects.filter(pk__in=ours).update(status='done', finished_at=timezone.now())
+            UserTestResult.objects.bulk_update(
+                [UserTestResult(pk=result_id, ai_analysis=text)
+                 for claim, result_id, text in items if claim['job_id'] in ours and text is not None],
+                ['ai_analysis'],
+            )
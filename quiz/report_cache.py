@@ -0,0 +1,157 @@
+"""
+Двухуровневый кеш готовых ИИ-анализов.
+
+Промпт IQ-отчета зависит только от (test_type, language, analysis_for,
+total_score, total_questions, category_stats) и имени пользователя.
+Поэтому генерируем текст один раз с плейсхолдером вместо имени, кладем его
+в LRU процесса и в таблицу AIReportCache, а имя подставляем при выдаче.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F, Sum
+from django.utils import timezone
+from .models import AIReportCache
+
+# Подставляется в промпт вместо имени; модель повторяет его в тексте
+NAME_PLACEHOLDER = '{{user_name}}'
+# Чистим просроченные/лишние строки в БД раз в столько записей
+PRUNE_EVERY = 200
+
+_lock = threading.Lock()
+_memory = OrderedDict()
+_stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'stores': 0}
+_stores_since_prune = 0
+
+
+def make_key(test_type, language, analysis_for, total_score, total_questions, category_stats):
+    """Канонический хеш входных данных отчета (порядок категорий и нулевые значения не важны)."""
+    stats = sorted((str(k), int(v)) for k, v in (category_stats or {}).items() if v)
+    raw = json.dumps(
+        [test_type, language, analysis_for, int(total_score), int(total_questions), stats],
+        ensure_ascii=False, separators=(',', ':'),
+    )
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def personalize(text, user_name):
+    return text.replace(NAME_PLACEHOLDER, str(user_name))
+
+
+def _partial_placeholder_len(text):
+    """Длина конца text, который может оказаться началом плейсхолдера."""
+    for size in range(min(len(NAME_PLACEHOLDER) - 1, len(text)), 0, -1):
+        if text.endswith(NAME_PLACEHOLDER[:size]):
+            return size
+    return 0
+
+
+def personalize_stream(chunks, user_name):
+    """personalize() для текста, который приходит кусками: плейсхолдер может попасть на границу кусков."""
+    tail = ''
+    for chunk in chunks:
+        text = tail + chunk
+        # Возможное начало плейсхолдера придерживаем до следующего куска
+        keep = _partial_placeholder_len(text)
+        head, tail = text[:len(text) - keep], text[len(text) - keep:]
+        if head:
+            yield personalize(head, user_name)
+    if tail:
+        yield tail
+
+
+def _ttl():
+    return timedelta(days=settings.AI_REPORT_CACHE_TTL_DAYS)
+
+
+def _remember(key, text, expires_at=None):
+    with _lock:
+        _memory[key] = (text, expires_at or timezone.now() + _ttl())
+        _memory.move_to_end(key)
+        while len(_memory) > settings.AI_REPORT_MEMO_SIZE:
+            _memory.popitem(last=False)
+
+
+def lookup(key):
+    """Текст с плейсхолдером или None."""
+    now = timezone.now()
+    with _lock:
+        entry = _memory.get(key)
+        if entry and entry[1] > now:
+            _memory.move_to_end(key)
+            _stats['memory_hits'] += 1
+            return entry[0]
+        if entry:
+            del _memory[key]
+
+    row = AIReportCache.objects.filter(key=key, created_at__gt=now - _ttl()).values('text', 'created_at').first()
+    if row is None:
+        with _lock:
+            _stats['misses'] += 1
+        return None
+
+    AIReportCache.objects.filter(key=key).update(hits=F('hits') + 1, last_used_at=now)
+    with _lock:
+        _stats['db_hits'] += 1
+    # В памяти - не дольше, чем проживет строка в БД
+    _remember(key, row['text'], row['created_at'] + _ttl())
+    return row['text']
+
+
+def store(key, text):
+    global _stores_since_prune
+    _remember(key, text)
+    now = timezone.now()
+    try:
+        AIReportCache.objects.update_or_create(
+            key=key, defaults={'text': text, 'created_at': now, 'last_used_at': now}
+        )
+    except IntegrityError:
+        # Тот же отчет параллельно сохранил другой воркер - это нормально
+        pass
+
+    with _lock:
+        _stats['stores'] += 1
+        _stores_since_prune += 1
+        need_prune = _stores_since_prune >= PRUNE_EVERY
+        if need_prune:
+            _stores_since_prune = 0
+    if need_prune:
+        prune()
+
+
+def prune():
+    """Удаляет просроченные строки и самые давно использованные сверх лимита."""
+    expired, _ = AIReportCache.objects.filter(created_at__lt=timezone.now() - _ttl()).delete()
+    excess = AIReportCache.objects.count() - settings.AI_REPORT_CACHE_MAX_ROWS
+    evicted = 0
+    if excess > 0:
+        old_ids = list(AIReportCache.objects.order_by('last_used_at').values_list('id', flat=True)[:excess])
+        evicted, _ = AIReportCache.objects.filter(id__in=old_ids).delete()
+    return expired + evicted
+
+
+def reset():
+    """Очищает память процесса и счетчики (таблица не трогается)."""
+    global _stores_since_prune
+    with _lock:
+        _memory.clear()
+        _stats.update(dict.fromkeys(_stats, 0))
+        _stores_since_prune = 0
+
+
+def stats():
+    """Счетчики этого процесса + общие данные таблицы."""
+    with _lock:
+        data = dict(_stats)
+        data['memory_size'] = len(_memory)
+    db = AIReportCache.objects.aggregate(total_hits=Sum('hits'))
+    data['db_rows'] = AIReportCache.objects.count()
+    data['db_total_hits'] = db['total_hits'] or 0
+    # Сколько обращений к Gemini сэкономил этот процесс
+    data['api_calls_saved'] = data['memory_hits'] + data['db_hits']
+    return data
@@ -0,0 +1,139 @@
+"""
+Очередь генерации ИИ-отчетов в базе данных.
+
+finish_test только ставит задачу (ReportJob), а генерацию выполняют
+воркеры из команды run_report_workers. Результат пишется в
+UserTestResult.ai_analysis, страница результата подхватывает его сама.
+
+Отчет для самого пользователя (analysis_for='user') сначала ждет
+AI_STREAM_GRACE_SECONDS: за это время страница результата может забрать
+задачу себе и показать анализ по мере генерации (claim_result_job).
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import ReportJob, UserTestResult
+from .ai_service import generate_report
+from .rate_limit import provider_limiter
+
+# Сколько раз пробуем сгенерировать отчет, прежде чем сдаться
+MAX_ATTEMPTS = 3
+# Текст, который увидит пользователь, если все попытки провалились
+UNAVAILABLE_TEXT = "Analysis currently unavailable."
+
+
+def enqueue_report(result, **report_kwargs):
+    """Ставит отчет для результата в очередь. report_kwargs - аргументы generate_report."""
+    return ReportJob.objects.create(result=result, payload=report_kwargs)
+
+
+def claim_jobs(limit):
+    """
+    Забирает до limit задач из очереди и помечает их 'running'.
+    Захват - условный UPDATE, поэтому несколько процессов воркеров
+    никогда не возьмут одну и ту же задачу.
+    """
+    # Отчеты пользователю пока оставляем странице результата (стриминг)
+    stream_border = timezone.now() - timedelta(seconds=settings.AI_STREAM_GRACE_SECONDS)
+    candidate_ids = list(
+        ReportJob.objects.filter(status='pending')
+        .filter(Q(created_at__lt=stream_border) | ~Q(payload__analysis_for='user'))
+        .order_by('created_at')
+        .values_list('id', flat=True)[:limit]
+    )
+    claimed = []
+    for job_id in candidate_ids:
+        updated = ReportJob.objects.filter(pk=job_id, status='pending').update(
+            status='running',
+            started_at=timezone.now(),
+            attempts=F('attempts') + 1,
+        )
+        if updated:
+            claimed.append(job_id)
+    return claimed
+
+
+def claim_result_job(result_id):
+    """
+    Забирает задачу отчета результата для стриминга на странице.
+    None - задачи нет или ее уже взял воркер/другая вкладка.
+    """
+    job = ReportJob.objects.filter(result_id=result_id, status='pending').only('id', 'result', 'attempts', 'payload').first()
+    if job is None:
+        return None
+    updated = ReportJob.objects.filter(pk=job.pk, status='pending', attempts=job.attempts).update(
+        status='running',
+        started_at=timezone.now(),
+        attempts=F('attempts') + 1,
+    )
+    if not updated:
+        return None
+    # attempts после захвата - наш "токен": по нему завершаем или возвращаем именно свой захват
+    job.attempts += 1
+    return job
+
+
+def complete_claimed_job(job, analysis):
+    """Сохраняет отчет захваченной задачи. Ровно один раз: повторный вызов или чужой захват ничего не пишут."""
+    with transaction.atomic():
+        done = ReportJob.objects.filter(pk=job.pk, status='running', attempts=job.attempts).update(
+            status='done', finished_at=timezone.now()
+        )
+        if done:
+            UserTestResult.objects.filter(pk=job.result_id).update(ai_analysis=analysis)
+    return bool(done)
+
+
+def release_claimed_job(job, error=''):
+    """Возвращает захваченную задачу в очередь (клиент ушел или ИИ упал посреди ответа)."""
+    return ReportJob.objects.filter(pk=job.pk, status='running', attempts=job.attempts).update(
+        status='pending', last_error=error
+    )
+
+
+def requeue_stale_jobs(stale_after_seconds):
+    """Возвращает в очередь задачи, зависшие в 'running' (например, воркер упал)."""
+    border = timezone.now() - timedelta(seconds=stale_after_seconds)
+    return ReportJob.objects.filter(status='running', started_at__lt=border).update(status='pending')
+
+
+def _without_analysis(result_id):
+    return UserTestResult.objects.filter(pk=result_id).filter(Q(ai_analysis__isnull=True) | Q(ai_analysis=''))
+
+
+def run_job(job_id):
+    """
+    Генерирует отчет для одной задачи. Возвращает итоговый статус.
+    Пишем только пока задача наша (status='running' и тот же attempts, что при
+    захвате); если ее успели вернуть в очередь или забрала страница результата - 'lost'.
+    """
+    job = ReportJob.objects.get(pk=job_id)
+    owned = ReportJob.objects.filter(pk=job_id, status='running', attempts=job.attempts)
+
+    # Лимит частоты провайдера (AI_RATE_LIMIT_PER_MINUTE) общий с generate_reports
+    limiter = provider_limiter()
+    if limiter is not None:
+        limiter.acquire()
+
+    try:
+        analysis, from_ai = generate_report(**job.payload)
+        analysis = analysis or UNAVAILABLE_TEXT
+    except Exception as e:
+        error = f"{type(e).__name__}: {str(e)[:500]}"
+        if job.attempts < MAX_ATTEMPTS:
+            return 'pending' if owned.update(status='pending', last_error=error) else 'lost'
+        with transaction.atomic():
+            if not owned.update(status='failed', last_error=error, finished_at=timezone.now()):
+                return 'lost'
+            _without_analysis(job.result_id).update(ai_analysis=UNAVAILABLE_TEXT)
+        return 'failed'
+
+    with transaction.atomic():
+        if not owned.update(status='done', finished_at=timezone.now()):
+            return 'lost'
+        # Заглушкой не заменяем уже готовый анализ (перегенерация с HR-панели при недоступном ИИ)
+        results = UserTestResult.objects.filter(pk=job.result_id) if from_ai else _without_analysis(job.result_id)
+        results.update(ai_analysis=analysis)
+    return 'done'
@@ -0,0 +1,203 @@
+"""
+Метрики HTTP-запросов: SQL, время view и шаблонов.
+
+RequestMetricsMiddleware на каждый запрос считает число SQL-запросов и их
+суммарное время (через connection.execute_wrapper), время view и рендера
+шаблонов (через TimedDjangoTemplates) и отдает их в заголовке Server-Timing -
+его видно во вкладке Network браузера.
+
+Итоги копятся в гистограммах по url_name в памяти процесса и читаются
+staff-эндпоинтом ops/requests/. Тексты SQL собираются только у
+сэмплированных запросов (REQUEST_METRICS_SAMPLE_RATE, по умолчанию 0):
+если такой запрос оказался медленным, в лог пишутся самые повторяющиеся
+запросы - так видно N+1. Без сэмплирования на запрос добавляется только
+пара perf_counter и обертка вокруг каждого execute.
+"""
+import contextvars
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.db import connection
+from django.template.backends.django import DjangoTemplates, Template
+
+logger = logging.getLogger(__name__)
+
+# Верхние границы корзин гистограммы, мс (последняя корзина - все, что дольше)
+BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# Сколько разных SQL показывать в логе медленного запроса
+TOP_SQL = 5
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+_lock = threading.Lock()
+_routes = {}
+
+
+class _RequestMetrics:
+    __slots__ = ('queries', 'db_seconds', 'template_seconds', 'template_depth', 'statements')
+
+    def __init__(self, sampled):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_depth = 0
+        self.statements = Counter() if sampled else None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - started
+            self.queries += 1
+            if self.statements is not None:
+                self.statements[sql] += 1
+
+
+class _TimedTemplate:
+    """Обертка над шаблоном бэкенда: время render() идет в метрики текущего запроса."""
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None:
+            return self.template.render(context, request)
+        # render_to_string внутри шаблонного тега не должен считаться дважды
+        metrics.template_depth += 1
+        started = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            metrics.template_depth -= 1
+            if not metrics.template_depth:
+                metrics.template_seconds += time.perf_counter() - started
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """Бэкенд DjangoTemplates, который замеряет время рендера для Server-Timing."""
+
+    def from_string(self, template_code):
+        return _TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return _TimedTemplate(super().get_template(template_name))
+
+
+def _new_route():
+    return {
+        'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+        'queries': 0, 'max_queries': 0, 'db_ms': 0.0, 'template_ms': 0.0,
+        'buckets': [0] * (len(BUCKETS_MS) + 1),
+    }
+
+
+def _record(route, status, total_ms, metrics):
+    bucket = next((i for i, bound in enumerate(BUCKETS_MS) if total_ms <= bound), len(BUCKETS_MS))
+    with _lock:
+        data = _routes.get(route)
+        if data is None:
+            data = _routes[route] = _new_route()
+        data['count'] += 1
+        if status >= 500:
+            data['errors'] += 1
+        data['total_ms'] += total_ms
+        data['max_ms'] = max(data['max_ms'], total_ms)
+        data['queries'] += metrics.queries
+        data['max_queries'] = max(data['max_queries'], metrics.queries)
+        data['db_ms'] += metrics.db_seconds * 1000
+        data['template_ms'] += metrics.template_seconds * 1000
+        data['buckets'][bucket] += 1
+
+
+def stats():
+    """Гистограммы этого процесса по url_name."""
+    labels = [f'<={bound}ms' for bound in BUCKETS_MS] + [f'>{BUCKETS_MS[-1]}ms']
+    with _lock:
+        routes = {name: dict(data, buckets=list(data['buckets'])) for name, data in _routes.items()}
+    result = {}
+    for name, data in sorted(routes.items()):
+        count = max(1, data['count'])
+        result[name] = {
+            'count': data['count'],
+            'errors': data['errors'],
+            'avg_ms': round(data['total_ms'] / count, 2),
+            'max_ms': round(data['max_ms'], 2),
+            'avg_queries': round(data['queries'] / count, 2),
+            'max_queries': data['max_queries'],
+            'avg_db_ms': round(data['db_ms'] / count, 2),
+            'avg_template_ms': round(data['template_ms'] / count, 2),
+            'histogram': dict(zip(labels, data['buckets'])),
+        }
+    return {
+        'sample_rate': settings.REQUEST_METRICS_SAMPLE_RATE,
+        'slow_ms': settings.REQUEST_METRICS_SLOW_MS,
+        'routes': result,
+    }
+
+
+def reset():
+    with _lock:
+        _routes.clear()
+
+
+def _route_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unresolved>'
+    return match.view_name or match.url_name or '<unnamed>'
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.REQUEST_METRICS_ENABLED:
+            return self.get_response(request)
+
+        sample_rate = settings.REQUEST_METRICS_SAMPLE_RATE
+        metrics = _RequestMetrics(sampled=sample_rate > 0 and random.random() < sample_rate)
+        token = _current.set(metrics)
+        request._metrics_view_started = None
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(metrics):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        finished = time.perf_counter()
+
+        total_ms = (finished - started) * 1000
+        view_started = request._metrics_view_started
+        view_ms = (finished - view_started) * 1000 if view_started else 0.0
+        db_ms = metrics.db_seconds * 1000
+        template_ms = metrics.template_seconds * 1000
+        response['Server-Timing'] = (
+            f'db;dur={db_ms:.1f};desc="{metrics.queries} queries", '
+            f'view;dur={view_ms:.1f}, tpl;dur={template_ms:.1f}, total;dur={total_ms:.1f}'
+        )
+
+        route = _route_name(request)
+        _record(route, response.status_code, total_ms, metrics)
+        if metrics.statements is not None and total_ms >= settings.REQUEST_METRICS_SLOW_MS:
+            self._log_slow(request, route, total_ms, db_ms, template_ms, metrics)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metrics_view_started = time.perf_counter()
+
+    def _log_slow(self, request, route, total_ms, db_ms, template_ms, metrics):
+        top = '\n'.join(
+            f'  {count}x {sql[:300]}' for sql, count in metrics.statements.most_common(TOP_SQL)
+        )
+        logger.warning(
+            f"Slow request {request.method} {request.path} ({route}): {total_ms:.0f} ms, "
+            f"SQL {metrics.queries} queries / {db_ms:.0f} ms, templates {template_ms:.0f} ms\n{top}"
+        )
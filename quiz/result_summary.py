@@ -0,0 +1,77 @@
+"""
+Компактная сводка результата (UserTestResult.summary).
+
+Результат не меняется после finish_test, поэтому все, что нужно странице
+результата (тексты вопросов и выбранных ответов на всех языках, верно/
+неверно, итоги по категориям), записывается один раз в JSON и потом
+отображается из одной строки без обращения к UserAnswer/Question/Answer.
+
+Формат:
+{
+    "v": 1,
+    "items": [{"q": {"ru": .., "kk": .., "en": ..}, "img": bool,
+               "a": {"ru": .., ...} | null, "ok": bool}, ...],
+    "categories": {"logic": [верных, всего], ...}
+}
+"""
+from django.utils.translation import get_language
+
+SUMMARY_VERSION = 1
+LANGS = ('ru', 'kk', 'en')
+
+
+def _texts(obj):
+    return {lang: getattr(obj, f'text_{lang}', None) or '' for lang in LANGS}
+
+
+def _add_item(summary, question, selected_answer, is_correct, has_image):
+    summary['items'].append({
+        'q': _texts(question),
+        'img': has_image,
+        'a': _texts(selected_answer) if selected_answer else None,
+        'ok': is_correct,
+    })
+    tally = summary['categories'].setdefault(question.category or '', [0, 0])
+    tally[0] += 1 if is_correct else 0
+    tally[1] += 1
+
+
+def _empty():
+    return {'v': SUMMARY_VERSION, 'items': [], 'categories': {}}
+
+
+def build_summary(test, rows):
+    """Сводка при завершении теста: test - TestBlueprint, rows - AttemptScore.rows."""
+    summary = _empty()
+    for q_id, ans_id, is_correct in rows:
+        question = test.questions[q_id]
+        selected = next((a for a in question.answers if a.id == ans_id), None)
+        _add_item(summary, question, selected, is_correct, bool(question.image_url))
+    return summary
+
+
+def build_summary_from_details(details):
+    """Сводка для старых результатов по строкам UserAnswer (с select_related)."""
+    summary = _empty()
+    for detail in details:
+        question = detail.question
+        _add_item(summary, question, detail.selected_answer, detail.is_correct, bool(question.image))
+    return summary
+
+
+def _pick(texts, lang):
+    return texts.get(lang) or texts.get('ru') or ''
+
+
+def summary_rows(summary, lang=None):
+    """Строки для шаблона на текущем языке (с откатом на русский, как в modeltranslation)."""
+    lang = (lang or get_language() or 'ru')[:2]
+    return [
+        {
+            'question_text': _pick(item['q'], lang),
+            'has_image': item['img'],
+            'answer_text': _pick(item['a'], lang) if item['a'] else None,
+            'is_correct': item['ok'],
+        }
+        for item in summary['items']
+    ]
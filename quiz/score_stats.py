@@ -0,0 +1,171 @@
+"""
+Распределение баллов по тестам и процентили ("лучше, чем у X%").
+
+Считать процентиль по UserTestResult - значит проходить все результаты
+теста на каждый запрос. Вместо этого finish_test увеличивает счетчик в
+ScoreHistogram: одна строка на (тест, язык, аудиторию, балл), атомарный
+upsert count = count + 1 в той же транзакции, что и сам результат
+(последним запросом - строка корзины блокируется до коммита, держим ее
+как можно меньше).
+
+Процентиль считается по корзинам: их столько, сколько разных баллов, а не
+результатов. Распределение теста грузится одним запросом, сворачивается в
+накопленные суммы и живет в памяти процесса SCORE_PERCENTILE_TTL секунд;
+сам поиск - bisect по списку, время не зависит от числа результатов.
+
+Если счетчики разошлись с таблицей результатов (ручные правки в БД,
+импорт), их пересобирает команда rebuild_score_histograms.
+"""
+import threading
+from bisect import bisect_left
+from collections import Counter
+from itertools import accumulate
+from cachetools import TTLCache
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Sum
+from .models import ScoreHistogram, UserTestResult
+
+AUDIENCE_USER = 'user'
+AUDIENCE_CANDIDATE = 'recruiter'
+
+_lock = threading.Lock()
+_cache = {'ttl': None, 'distributions': None}
+
+
+def _upsert_sql():
+    table = ScoreHistogram._meta.db_table
+    return (
+        f'INSERT INTO {table} (test_id, language, audience, score, count) VALUES (%s, %s, %s, %s, 1) '
+        f'ON CONFLICT (test_id, language, audience, score) DO UPDATE SET count = {table}.count + 1'
+    )
+
+
+def record_score(test_id, score, language='', audience=AUDIENCE_USER):
+    """+1 в корзину балла. Вызывать внутри транзакции, в которой создан результат."""
+    if connection.vendor in ('postgresql', 'sqlite'):
+        # Один запрос и для новой корзины, и для существующей
+        with connection.cursor() as cursor:
+            cursor.execute(_upsert_sql(), [test_id, language, audience, score])
+        return
+    bucket = ScoreHistogram.objects.filter(test_id=test_id, language=language, audience=audience, score=score)
+    if bucket.update(count=F('count') + 1):
+        return
+    try:
+        with transaction.atomic():
+            ScoreHistogram.objects.create(test_id=test_id, language=language, audience=audience, score=score, count=1)
+    except IntegrityError:
+        # Параллельное завершение успело создать эту корзину
+        bucket.update(count=F('count') + 1)
+
+
+def _store():
+    with _lock:
+        ttl = settings.SCORE_PERCENTILE_TTL
+        if _cache['ttl'] != ttl:
+            _cache['ttl'] = ttl
+            _cache['distributions'] = TTLCache(maxsize=4096, ttl=max(ttl, 1))
+        return _cache['distributions']
+
+
+def reset():
+    with _lock:
+        _cache['ttl'] = None
+        _cache['distributions'] = None
+
+
+def _load(test_id, language, audience):
+    buckets = ScoreHistogram.objects.filter(test_id=test_id, count__gt=0)
+    if language is not None:
+        buckets = buckets.filter(language=language)
+    if audience is not None:
+        buckets = buckets.filter(audience=audience)
+    rows = list(buckets.values_list('score').annotate(n=Sum('count')).order_by('score'))
+    scores = [score for score, _ in rows]
+    # below[i] - сколько результатов набрали меньше scores[i]
+    below = [0, *accumulate(n for _, n in rows)]
+    return scores, below
+
+
+def distribution(test_id, language=None, audience=None):
+    """(отсортированные баллы, накопленные суммы) теста; None в фильтре - все языки/аудитории."""
+    key = (test_id, language, audience)
+    store = _store()
+    with _lock:
+        cached = store.get(key)
+    if cached is None:
+        cached = _load(test_id, language, audience)
+        with _lock:
+            store[key] = cached
+    return cached
+
+
+def percentile(test_id, score, language=None, audience=None):
+    """
+    Доля результатов теста (в %), набравших меньше score. None, пока
+    результатов меньше SCORE_PERCENTILE_MIN_RESULTS - на паре человек цифра ничего не значит.
+    """
+    if score is None:
+        return None
+    scores, below = distribution(test_id, language, audience)
+    total = below[-1]
+    if not total or total < settings.SCORE_PERCENTILE_MIN_RESULTS:
+        return None
+    return below[bisect_left(scores, score)] * 100 // total
+
+
+def _lock_histograms():
+    # Блокируем запись в гистограммы: завершения тестов подождут пересборку,
+    # а их +1 ляжет уже в новые строки
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(f'LOCK TABLE {ScoreHistogram._meta.db_table} IN EXCLUSIVE MODE')
+
+
+def rebuild(test_id=None, chunk_size=10000, progress=None):
+    """
+    Пересчитывает гистограммы по таблице результатов. Результаты читаются
+    кусками по id (keyset), в памяти держатся только счетчики корзин.
+    Возвращает (результатов, корзин).
+    """
+    results = UserTestResult.objects.all()
+    if test_id:
+        results = results.filter(test_id=test_id)
+    fields = ('id', 'test_id', 'language', 'audience', 'score')
+    counts = Counter()
+    scanned = 0
+
+    def scan(rows):
+        nonlocal scanned
+        last_id = None
+        for row in rows:
+            last_id = row[0]
+            counts[row[1:]] += 1
+            scanned += 1
+        return last_id
+
+    # Основной проход - без блокировок, завершения тестов идут как обычно
+    last_id = 0
+    while True:
+        chunk = list(results.filter(id__gt=last_id).order_by('id').values_list(*fields)[:chunk_size])
+        if not chunk:
+            break
+        last_id = scan(chunk)
+        if progress:
+            progress(scanned)
+
+    with transaction.atomic():
+        _lock_histograms()
+        # Результаты, сохраненные за время прохода
+        scan(results.filter(id__gt=last_id).values_list(*fields).iterator(chunk_size=chunk_size))
+        histograms = ScoreHistogram.objects.all()
+        if test_id:
+            histograms = histograms.filter(test_id=test_id)
+        histograms.delete()
+        ScoreHistogram.objects.bulk_create(
+            [ScoreHistogram(test_id=t, language=language, audience=audience, score=score, count=n)
+             for (t, language, audience, score), n in counts.items()],
+            batch_size=1000,
+        )
+    reset()
+    return scanned, len(counts)
@@ -0,0 +1,80 @@
+"""
+Подсчет результата попытки за один проход.
+
+Все выбранные и правильные ответы берутся из чертежа теста (blueprints.py),
+поэтому подсчет не делает запросов к БД, а строки UserAnswer готовятся
+сразу для bulk_create - количество запросов на завершение теста не
+зависит от его длины.
+"""
+from dataclasses import dataclass, field
+from .models import UserAnswer
+
+
+@dataclass
+class AttemptScore:
+    score: int = 0
+    # Название категории -> количество верных ответов
+    category_stats: dict = field(default_factory=dict)
+    test_type: str = 'iq'
+    # (question_id, selected_answer_id | None, is_correct) в порядке попытки
+    rows: list = field(default_factory=list)
+    # Детали ответов для психологического отчета (None для IQ)
+    detailed_answers: list = None
+
+    def build_user_answers(self, result):
+        """Несохраненные UserAnswer для bulk_create."""
+        return [
+            UserAnswer(result=result, question_id=q_id, selected_answer_id=ans_id, is_correct=is_correct)
+            for q_id, ans_id, is_correct in self.rows
+        ]
+
+
+def score_attempt(test, question_ids, saved_answers):
+    """
+    test - TestBlueprint, question_ids - порядок вопросов попытки,
+    saved_answers - {str(question_id): answer_id}.
+    """
+    scored = AttemptScore()
+    # (вопрос, выбранный ответ, правильный ответ, верно?) - для детального отчета
+    answered = []
+
+    for q_id in question_ids:
+        question = test.questions.get(q_id)
+        if not question:
+            continue
+
+        answers_by_id = {a.id: a for a in question.answers}
+        selected_answer = None
+        ans_id = saved_answers.get(str(q_id))
+        if ans_id:
+            # Чужие/несуществующие id ответов просто игнорируем
+            selected_answer = answers_by_id.get(int(ans_id))
+
+        is_correct = bool(selected_answer and selected_answer.is_correct)
+        if is_correct:
+            scored.score += 1
+            # Для статистики берем красивое название категории
+            cat_display = question.get_category_display()
+            scored.category_stats[cat_display] = scored.category_stats.get(cat_display, 0) + 1
+
+        scored.rows.append((q_id, selected_answer.id if selected_answer else None, is_correct))
+        correct_answer = next((a for a in question.answers if a.is_correct), None)
+        answered.append((question, selected_answer, correct_answer, is_correct))
+
+    # Тип теста определяет чертеж (вопросы категории psychology или "Психология" в названии)
+    scored.test_type = test.test_type
+    if scored.test_type == 'psychology':
+        scored.detailed_answers = [
+            {
+                'question_id': question.id,
+                'category': question.get_category_display(),
+                'question_text': question.text,
+                'selected_answer_text': selected.text if selected else 'Не отвечено',
+                'correct_answer_text': correct.text if correct else 'Не определено',
+                'is_correct': is_correct,
+                'answered': selected is not None,
+            }
+            for question, selected, correct, is_correct in answered
+        ]
+
+    return scored
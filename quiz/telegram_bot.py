@@ -2,16 +2,21 @@
 import os
 import random
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
 from aiogram.filters import CommandStart, Command, CommandObject
 from asgiref.sync import sync_to_async
+from django.db import transaction
 from users.models import CustomUser
-from quiz.models import Question, Answer, BotResult
+from quiz.models import Question, Answer, BotResult, QuestionTelegramFile
+from quiz.bot_context import TgUserMiddleware, TgUser, expire_version
+from quiz.bot_deck import MAX_RETRIES, next_question_id
 
 # Инициализация
 TOKEN = os.getenv('TELEGRAM_TOKEN')
 # ВАЖНО: для вебхука убираем таймауты или делаем их дефолтными
 dp = Dispatcher()
+# Пользователь определяется один раз на обновление и передается в хендлеры как tg_user
+dp.update.outer_middleware(TgUserMiddleware())
 
 # --- СЛОВАРЬ ПЕРЕВОДОВ ДЛЯ БОТА ---
 MESSAGES = {
@@ -51,56 +56,95 @@ MESSAGES = {
 }
 
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
-@sync_to_async
-def get_user_lang(chat_id):
-    try:
-        user = CustomUser.objects.get(telegram_chat_id=str(chat_id))
-        return user.language if user.language else 'ru'
-    except CustomUser.DoesNotExist:
-        return 'ru'
+def get_user_lang(tg_user):
+    return tg_user.language if tg_user else 'ru'
 
 @sync_to_async
 def register_user(code, chat_id, username):
     try:
         user = CustomUser.objects.get(telegram_code=code)
-        user.telegram_chat_id = str(chat_id)
-        user.save()
-        return user
     except CustomUser.DoesNotExist:
         return None
+    with transaction.atomic():
+        # telegram_chat_id уникален - отвязываем чат от прежнего аккаунта
+        CustomUser.objects.filter(telegram_chat_id=str(chat_id)).exclude(pk=user.pk).update(telegram_chat_id=None)
+        user.telegram_chat_id = str(chat_id)
+        user.save()
+    # Версия уже поднята (on_commit) - следующий /train увидит привязку без задержки
+    expire_version()
+    return user
+
+@sync_to_async
+def get_random_question(tg_user: TgUser):
+    # Проверка лимитов (упрощено, добавь логику проверки премиума если нужно)
+    # if tg_user.plan == 'free' and ...: return None
+
+    # Следующий вопрос из перемешанной колоды пользователя (см. bot_deck.py)
+    for _ in range(MAX_RETRIES):
+        question_id = next_question_id(tg_user.id, tg_user.bot_category)
+        if question_id is None:
+            return None
+        # Ответы подгружаем сразу, чтобы send_question не ходил в БД еще раз
+        question = (
+            Question.objects.prefetch_related('answers', 'telegram_files')
+            .filter(id=question_id).first()
+        )
+        if question:
+            return question
+    return None
 
 @sync_to_async
-def get_random_question(chat_id):
+def remember_file_id(question, bot_id, file_id):
+    QuestionTelegramFile.objects.update_or_create(
+        question=question, bot_id=bot_id,
+        defaults={'image_name': question.image.name, 'file_id': file_id},
+    )
+
+@sync_to_async
+def forget_file_id(question, bot_id):
+    QuestionTelegramFile.objects.filter(question=question, bot_id=bot_id).delete()
+
+async def send_question_photo(message: types.Message, question, caption_text, keyboard):
+    """
+    Фото вопроса: по сохраненному file_id, а если его нет (или картинку
+    заменили) - загрузка файла с диска и запоминание file_id от Telegram.
+    Возвращает False, если фото отправить не удалось.
+    """
+    bot_id = message.bot.id
+    cached = next(
+        (f for f in question.telegram_files.all()
+         if f.bot_id == bot_id and f.image_name == question.image.name),
+        None,
+    )
+    if cached:
+        try:
+            await message.answer_photo(cached.file_id, caption=caption_text, reply_markup=keyboard, parse_mode="HTML")
+            return True
+        except Exception as e:
+            # file_id больше не принимается - загрузим файл заново
+            print(f"Telegram file_id rejected for question {question.id}: {e}")
+            await forget_file_id(question, bot_id)
+
+    # На Render файловая система эфемерна - файла может уже не быть
     try:
-        user = CustomUser.objects.get(telegram_chat_id=str(chat_id))
-        # Проверка лимитов (упрощено, добавь логику проверки премиума если нужно)
-        # if not user.is_premium and user.today_questions > 10: return None
-        
-        category = user.bot_category
-        # Выбираем вопросы, на которые пользователь еще не отвечал
-        answered_ids = BotResult.objects.filter(user=user).values_list('question_id', flat=True)
-        questions = Question.objects.filter(category=category).exclude(id__in=answered_ids)
-        
-        if not questions.exists():
-            # Если ответил на всё, можно сбросить историю или вернуть None
-            # Для примера берем любой случайный, если закончились новые
-            questions = Question.objects.filter(category=category)
-            if not questions.exists():
-                return None
-                
-        return random.choice(list(questions))
-    except CustomUser.DoesNotExist:
-        return None
+        sent = await message.answer_photo(
+            FSInputFile(question.image.path), caption=caption_text, reply_markup=keyboard, parse_mode="HTML"
+        )
+    except Exception as e:
+        print(f"Error uploading question image {question.id}: {e}")
+        return False
+    if sent.photo:
+        await remember_file_id(question, bot_id, sent.photo[-1].file_id)
+    return True
 
 @sync_to_async
-def save_result(chat_id, answer_id):
+def save_result(user_id, answer_id):
     try:
-        user = CustomUser.objects.get(telegram_chat_id=str(chat_id))
-        answer = Answer.objects.get(id=answer_id)
-        
+        answer = Answer.objects.only('id', 'question_id', 'is_correct').get(id=answer_id)
+
         BotResult.objects.create(
-            user=user,
-            question=answer.question,
+            user_id=user_id,
+            question_id=answer.question_id,
             is_correct=answer.is_correct
         )
         return answer.is_correct
@@ -109,8 +153,8 @@ def save_result(chat_id, answer_id):
 
 # --- ХЕНДЛЕРЫ ---
 @dp.message(CommandStart())
-async def cmd_start(message: types.Message, command: CommandObject):
-    lang = await get_user_lang(message.chat.id)
+async def cmd_start(message: types.Message, command: CommandObject, tg_user: TgUser | None):
+    lang = get_user_lang(tg_user)
     t = MESSAGES[lang]
 
     args = command.args
@@ -126,43 +170,38 @@ async def cmd_start(message: types.Message, command: CommandObject):
     else:
         await message.answer(t['hello'])
 
-async def send_question(message: types.Message):
-    lang = await get_user_lang(message.chat.id)
+async def send_question(message: types.Message, tg_user: TgUser | None):
+    lang = get_user_lang(tg_user)
     t = MESSAGES[lang]
-    
-    question = await get_random_question(message.chat.id)
+
+    # Чат не привязан к аккаунту - вопросов нет (как и раньше)
+    question = await get_random_question(tg_user) if tg_user else None
     
     if not question:
         await message.answer(t['no_questions'])
         return
 
     # Формируем текст вопроса
-    q_text = getattr(question, f'text_{lang}', question.text_ru)
+    q_text = getattr(question, f'text_{lang}', None) or question.text_ru
     caption_text = t['caption'].format(text=q_text)
 
-    # Клавиатура
-    # Получаем ответы асинхронно
-    answers = await sync_to_async(list)(question.answers.all())
+    # Клавиатура (ответы уже подгружены в get_random_question)
+    answers = list(question.answers.all())
     random.shuffle(answers)
     
     buttons = []
     for ans in answers:
-        ans_text = getattr(ans, f'text_{lang}', ans.text_ru)
+        ans_text = getattr(ans, f'text_{lang}', None) or ans.text_ru
         buttons.append([InlineKeyboardButton(text=ans_text, callback_data=f"ans_{ans.id}")])
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
 
     try:
         if question.image:
-            # Важно: для отправки файлов лучше использовать ID файла если он уже загружен в ТГ, 
-            # или URL, или FSInputFile. Здесь предполагаем, что question.image.path доступен.
-            # На Render файловая система эфемерна, поэтому лучше проверять существование.
-            try:
-                photo_file = FSInputFile(question.image.path)
-                await message.answer_photo(photo_file, caption=caption_text, reply_markup=keyboard, parse_mode="HTML")
-            except Exception:
-                # Если картинки нет физически, шлем текст
-                 await message.answer(caption_text, reply_markup=keyboard, parse_mode="HTML")
+            sent = await send_question_photo(message, question, caption_text, keyboard)
+            if not sent:
+                # Если картинку отправить не удалось, шлем текст
+                await message.answer(caption_text, reply_markup=keyboard, parse_mode="HTML")
         else:
             await message.answer(caption_text, reply_markup=keyboard, parse_mode="HTML")
             
@@ -171,16 +210,16 @@ async def send_question(message: types.Message):
         await message.answer("Error / Қате / Ошибка")
 
 @dp.message(Command("train"))
-async def cmd_train(message: types.Message):
-    await send_question(message)
+async def cmd_train(message: types.Message, tg_user: TgUser | None):
+    await send_question(message, tg_user)
 
 @dp.callback_query(F.data.startswith("ans_"))
-async def process_answer(callback: types.CallbackQuery):
-    lang = await get_user_lang(callback.message.chat.id)
+async def process_answer(callback: types.CallbackQuery, tg_user: TgUser | None):
+    lang = get_user_lang(tg_user)
     t = MESSAGES[lang]
 
     ans_id = callback.data.split("_")[1]
-    is_correct = await save_result(callback.message.chat.id, ans_id)
+    is_correct = await save_result(tg_user.id, ans_id) if tg_user else False
 
     # Ответ бота
     result_text = t['correct'] if is_correct else t['wrong']
@@ -195,6 +234,6 @@ async def process_answer(callback: types.CallbackQuery):
     await callback.answer()
 
 @dp.callback_query(F.data == "next_q")
-async def process_next(callback: types.CallbackQuery):
+async def process_next(callback: types.CallbackQuery, tg_user: TgUser | None):
     await callback.message.edit_reply_markup(reply_markup=None)
-    await send_question(callback.message)
\ No newline at end of file
+    await send_question(callback.message, tg_user)
\ No newline at end of file
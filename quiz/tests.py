@@ -1,3 +1,1510 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+import google.generativeai as genai
+from aiohttp import web
+from aiogram.exceptions import TelegramNetworkError
+from aiogram.types import Update
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from users.models import CustomUser
+from .models import (
+    Test, Question, Answer, UserTestResult, UserAnswer, BotResult, TestAttempt, ReportJob, TestInvitation,
+    ScoreHistogram, QuestionTelegramFile, AIReportCache,
+)
+from .versioning import BOT_USERS_VERSION, CATALOG_VERSION, CONTENT_VERSION, bump_version, get_version
+from .blueprints import get_test_blueprint
+from .bot_runtime import BotRuntime
+from .attempts import answer_order, question_order
+from .management.commands.bench_bot_client import FAKE_TOKEN, _fake_api_app
+from . import request_metrics
+from . import ai_service, bot_context, bot_deck, bot_runtime, telegram_bot
+from . import report_batch, report_cache, report_jobs, score_stats
+from .report_jobs import claim_jobs, enqueue_report
+from .ai_service import MODEL_NAMES, ModelRegistry
+from .circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from .prompt_builder import build_answers_context
+from .rate_limit import TokenBucket
+from .report_batch import BatchRunner, select_results
 
-# Create your tests here.
+
+def make_test(questions, category='logic', title='IQ'):
+    """Тест из questions вопросов по 4 ответа (первый - верный)."""
+    test = Test.objects.create(title_ru=title, title_kk=title, title_en=title, questions_count=questions)
+    for i in range(questions):
+        q = Question.objects.create(test=test, text_ru=f'Вопрос {i}', text_kk=f'Сұрақ {i}',
+                                    text_en=f'Question {i}', category=category, order=i)
+        Answer.objects.bulk_create([
+            Answer(question=q, text_ru=f'Ответ {j}', text_kk=f'Жауап {j}', text_en=f'Answer {j}', is_correct=(j == 0))
+            for j in range(4)
+        ])
+    # В TestCase on_commit не срабатывает - сбрасываем кеш чертежей вручную
+    bump_version(CONTENT_VERSION)
+    return test
+
+
+class BlueprintCacheTests(TestCase):
+    """Чертеж теста читается из памяти процесса и пересобирается при изменении содержимого."""
+
+    def setUp(self):
+        self.test = make_test(3)
+
+    def test_warm_read_makes_no_queries(self):
+        blueprint = get_test_blueprint(self.test.id)
+        self.assertEqual(len(blueprint.question_ids), 3)
+        with self.assertNumQueries(0):
+            self.assertIs(get_test_blueprint(self.test.id), blueprint)
+
+    def test_question_and_answer_save_rebuild_blueprint(self):
+        blueprint = get_test_blueprint(self.test.id)
+        version = get_version(CONTENT_VERSION)
+        question = Question.objects.get(pk=blueprint.question_ids[0])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            question.text_ru = 'Новый текст'
+            question.save()
+        self.assertNotEqual(get_version(CONTENT_VERSION), version)
+        rebuilt = get_test_blueprint(self.test.id)
+        self.assertIsNot(rebuilt, blueprint)
+        self.assertEqual(rebuilt.questions[question.id].text_ru, 'Новый текст')
+
+        version = get_version(CONTENT_VERSION)
+        answer = question.answers.order_by('id').first()
+        with self.captureOnCommitCallbacks(execute=True):
+            answer.text_ru = 'Новый ответ'
+            answer.save()
+        self.assertNotEqual(get_version(CONTENT_VERSION), version)
+        self.assertEqual(get_test_blueprint(self.test.id).questions[question.id].answers[0].text_ru, 'Новый ответ')
+
+
+class ReportJobOwnershipTests(TestCase):
+    """Воркер пишет отчет, только пока задача все еще его захват."""
+
+    def setUp(self):
+        self.result = UserTestResult.objects.create(test=make_test(1), score=1)
+        self.job = enqueue_report(self.result, user_name='Ann', total_score=1, analysis_for='recruiter')
+        self.assertEqual(claim_jobs(10), [self.job.pk])
+
+    def test_owned_job_is_saved(self):
+        with mock.patch.object(report_jobs, 'generate_report', return_value=('AI text', True)):
+            self.assertEqual(report_jobs.run_job(self.job.pk), 'done')
+        self.result.refresh_from_db()
+        self.assertEqual(self.result.ai_analysis, 'AI text')
+
+    def test_job_taken_over_while_generating_is_not_written(self):
+        def steal(**payload):
+            # Пока воркер ждал провайдера, задачу вернули в очередь и забрала страница результата
+            report_jobs.requeue_stale_jobs(0)
+            self.stolen = report_jobs.claim_result_job(self.result.id)
+            return 'late worker text', True
+
+        with mock.patch.object(report_jobs, 'generate_report', side_effect=steal):
+            self.assertEqual(report_jobs.run_job(self.job.pk), 'lost')
+        self.result.refresh_from_db()
+        self.assertIsNone(self.result.ai_analysis)
+        self.assertTrue(report_jobs.complete_claimed_job(self.stolen, 'stream text'))
+        self.result.refresh_from_db()
+        self.assertEqual(self.result.ai_analysis, 'stream text')
+
+    def test_failure_of_lost_job_changes_nothing(self):
+        ReportJob.objects.filter(pk=self.job.pk).update(attempts=report_jobs.MAX_ATTEMPTS)
+
+        def fail(**payload):
+            ReportJob.objects.filter(pk=self.job.pk).update(status='done')
+            raise RuntimeError('boom')
+
+        with mock.patch.object(report_jobs, 'generate_report', side_effect=fail):
+            self.assertEqual(report_jobs.run_job(self.job.pk), 'lost')
+        self.result.refresh_from_db()
+        self.assertIsNone(self.result.ai_analysis)
+        self.assertEqual(ReportJob.objects.get(pk=self.job.pk).status, 'done')
+
+
+class FinishTestQueryBudgetTests(TestCase):
+    """Завершение теста стоит постоянное число запросов, независимо от его длины."""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('candidate', password='x')
+        # Pro - чтобы бесплатный лимит в один тест не мешал проходить несколько.
+        # Тест уже выбран - иначе первое завершение еще и записывает locked_test
+        self.user.profile.plan = 'pro'
+        self.user.profile.locked_test = make_test(1, title='Первый')
+        self.user.profile.save()
+        self.client.force_login(self.user)
+
+    def answer_all_and_count_finish(self, test):
+        url = f'/test/{test.id}/'
+        for step in range(test.questions_count):
+            response = self.client.get(url)
+            correct = next(a for a in response.context['answers_list'] if a.is_correct)
+            if step < test.questions_count - 1:
+                self.client.post(url, {'action': 'next', 'selected_answer': correct.id})
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(url, {'action': 'finish', 'selected_answer': correct.id})
+        self.assertEqual(response.status_code, 302)
+        return len(ctx)
+
+    def test_finish_query_count_does_not_depend_on_length(self):
+        short = self.answer_all_and_count_finish(make_test(3))
+        long = self.answer_all_and_count_finish(make_test(40))
+        self.assertEqual(short, long)
+        self.assertLessEqual(long, 12)
+
+        result = UserTestResult.objects.latest('id')
+        self.assertEqual(result.score, 40)
+        self.assertEqual(UserAnswer.objects.filter(result=result, is_correct=True).count(), 40)
+
+    def test_psychology_finish_query_count_does_not_depend_on_length(self):
+        short = self.answer_all_and_count_finish(make_test(3, category='psychology'))
+        long = self.answer_all_and_count_finish(make_test(40, category='psychology'))
+        self.assertEqual(short, long)
+
+        job = UserTestResult.objects.latest('id').report_job
+        self.assertEqual(job.payload['test_type'], 'psychology')
+        self.assertEqual(len(job.payload['detailed_answers']), 40)
+
+
+class ResultPageTests(TestCase):
+    """Страница результата: сводка из одной строки и условные запросы (ETag)."""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('owner')
+        self.client.force_login(self.user)
+        self.test = make_test(3)
+        questions = list(Question.objects.filter(test=self.test).order_by('order'))
+        self.result = UserTestResult.objects.create(user=self.user, test=self.test, score=2, ai_analysis='Готово')
+        UserAnswer.objects.bulk_create([
+            UserAnswer(result=self.result, question=q, selected_answer=q.answers.order_by('id')[i > 1],
+                       is_correct=i <= 1)
+            for i, q in enumerate(questions)
+        ])
+        self.url = f'/result/{self.result.id}/'
+
+    def test_matching_etag_returns_304(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_etag_depends_on_analysis_and_language(self):
+        etag = self.client.get(self.url)['ETag']
+        self.assertNotEqual(self.client.get(self.url, HTTP_ACCEPT_LANGUAGE='en')['ETag'], etag)
+
+        UserTestResult.objects.filter(pk=self.result.pk).update(ai_analysis='Новый анализ')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_legacy_result_summary_is_built_on_view(self):
+        self.client.get(self.url)
+        self.result.refresh_from_db()
+        self.assertEqual(len(self.result.summary['items']), 3)
+        self.assertEqual(self.result.summary['categories'], {'logic': [2, 3]})
+
+    def test_backfill_is_idempotent(self):
+        other = UserTestResult.objects.create(user=self.user, test=self.test, score=0)
+        out = StringIO()
+        call_command('backfill_result_summaries', chunk_size=1, stdout=out)
+        self.assertIn('Заполнено сводок: 2', out.getvalue())
+        self.result.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual([item['ok'] for item in self.result.summary['items']], [True, True, False])
+        self.assertEqual(other.summary['items'], [])
+
+        summary = self.result.summary
+        out = StringIO()
+        call_command('backfill_result_summaries', stdout=out)
+        self.assertIn('Заполнено сводок: 0', out.getvalue())
+        self.result.refresh_from_db()
+        self.assertEqual(self.result.summary, summary)
+
+
+@mock.patch('quiz.views.HR_PAGE_SIZE', 3)
+class FreePlanLockTests(TestCase):
+    """Бесплатный тариф: тест первого результата хранится в профиле (locked_test)."""
+
+    def setUp(self):
+        self.first = make_test(1, title='Первый')
+        self.second = make_test(1, title='Второй')
+        self.user = CustomUser.objects.create_user('free_lock')
+        self.client.force_login(self.user)
+
+    def finish(self, test):
+        url = f'/test/{test.id}/'
+        answer = self.client.get(url).context['answers_list'][0]
+        return self.client.post(url, {'action': 'next', 'selected_answer': answer.id})
+
+    def locked_test_id(self):
+        return CustomUser.objects.get(pk=self.user.pk).profile.locked_test_id
+
+    def test_first_finish_locks_test_once(self):
+        self.assertIsNone(self.locked_test_id())
+        self.assertRedirects(self.finish(self.first), f'/result/{UserTestResult.objects.get().id}/',
+                             fetch_redirect_response=False)
+        self.assertEqual(self.locked_test_id(), self.first.id)
+
+        # Повторное прохождение того же теста профиль не трогает
+        with CaptureQueriesContext(connection) as ctx:
+            self.finish(self.first)
+        self.assertFalse([q for q in ctx.captured_queries if q['sql'].startswith('UPDATE "quiz_userprofile"')])
+        self.assertEqual(self.locked_test_id(), self.first.id)
+        self.assertTemplateUsed(self.client.get(f'/test/{self.second.id}/'), 'subscription_required.html')
+
+    def test_deleting_first_result_moves_lock(self):
+        now = timezone.now()
+        first = UserTestResult.objects.create(user=self.user, test=self.first, score=1)
+        second = UserTestResult.objects.create(user=self.user, test=self.second, score=1)
+        UserTestResult.objects.filter(pk=first.pk).update(date_taken=now - timedelta(days=2))
+        UserTestResult.objects.filter(pk=second.pk).update(date_taken=now - timedelta(days=1))
+        self.user.profile.locked_test = self.first
+        self.user.profile.save()
+
+        first.delete()
+        self.assertEqual(self.locked_test_id(), self.second.id)
+        second.delete()
+        self.assertIsNone(self.locked_test_id())
+
+    def test_free_pages_do_not_look_up_results(self):
+        self.finish(self.first)
+        pro = CustomUser.objects.create_user('pro_lock')
+        pro.profile.plan = 'pro'
+        pro.profile.save()
+        counts = {}
+        for user in (self.user, pro):
+            self.client.force_login(user)
+            self.client.get('/')
+            self.client.get(f'/test/{self.first.id}/')
+            for url in ('/', f'/test/{self.first.id}/'):
+                with CaptureQueriesContext(connection) as ctx:
+                    self.assertEqual(self.client.get(url).status_code, 200)
+                self.assertFalse([q for q in ctx.captured_queries if 'quiz_usertestresult' in q['sql']], url)
+                counts[user.username, url] = len(ctx)
+        # Бесплатному тарифу - столько же запросов, сколько Pro
+        self.assertEqual(counts['free_lock', '/'], counts['pro_lock', '/'])
+        self.assertEqual(counts['free_lock', f'/test/{self.first.id}/'], counts['pro_lock', f'/test/{self.first.id}/'])
+
+
+class HRDashboardTests(TestCase):
+    """Keyset-пагинация и фильтры панели рекрутера."""
+
+    def setUp(self):
+        self.recruiter = CustomUser.objects.create_user('recruiter')
+        self.recruiter.profile.plan = 'hr'
+        self.recruiter.profile.save()
+        self.client.force_login(self.recruiter)
+        self.test = make_test(1)
+        self.other_test = make_test(1, title='Другой')
+
+    def invite(self, email, test=None, completed=False):
+        return TestInvitation.objects.create(
+            recruiter=self.recruiter, test=test or self.test, candidate_email=email, completed=completed,
+        )
+
+    def page(self, query=''):
+        context = self.client.get(f'/hr/dashboard/?{query}').context
+        return [invite.id for invite in context['invitations']], context['next_query']
+
+    def walk(self, query=''):
+        ids = []
+        while True:
+            page, query = self.page(query)
+            ids += page
+            if not query:
+                return ids
+
+    def test_pages_do_not_overlap_when_created_at_ties(self):
+        invites = [self.invite(f'c{i}@example.com') for i in range(8)]
+        # Одинаковое время у всех - порядок и границы страниц держатся на id
+        TestInvitation.objects.update(created_at=timezone.now())
+        ids = self.walk()
+        self.assertEqual(ids, sorted((i.id for i in invites), reverse=True))
+
+    def test_filters(self):
+        done = self.invite('done@example.com', completed=True)
+        other = self.invite('other@example.com', test=self.other_test)
+        self.invite('pending@example.com')
+        self.assertEqual(self.walk('status=completed'), [done.id])
+        self.assertEqual(self.walk(f'test={self.other_test.id}'), [other.id])
+
+    def test_email_prefix_is_case_insensitive(self):
+        self.client.post('/hr/dashboard/', {'test_id': self.test.id, 'candidate_email': ' Alice.Smith@Example.com '})
+        self.invite('bob@example.com')
+        alice = TestInvitation.objects.get(candidate_email='alice.smith@example.com')
+        self.assertEqual(self.walk('email=ALICE'), [alice.id])
+        self.assertEqual(self.walk('email=alice.s'), [alice.id])
+
+    def test_invalid_cursor_falls_back_to_first_page(self):
+        for i in range(4):
+            self.invite(f'c{i}@example.com')
+        first, _ = self.page()
+        for cursor in ('garbage', '12_x', '99999999999999999999999_1', '-99999999999999999999_1'):
+            self.assertEqual(self.page(f'after={cursor}')[0], first, cursor)
+
+
+class BotUserContextTests(TestCase):
+    """Пользователь бота берется из кеша воркера; версия не читается из файлового кеша на каждое обновление."""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('tg', telegram_chat_id='555')
+        bot_context.expire_version()
+        self.resolve = async_to_sync(bot_context.resolve_tg_user)
+
+    def test_version_is_read_once_per_interval(self):
+        with mock.patch.object(bot_context, 'get_version', wraps=bot_context.get_version) as get_version:
+            self.assertEqual(self.resolve(555).id, self.user.id)
+            with self.assertNumQueries(0):
+                self.assertEqual(self.resolve(555).id, self.user.id)
+            self.assertEqual(get_version.call_count, 1)
+
+            bot_context.expire_version()
+            self.resolve(555)
+            self.assertEqual(get_version.call_count, 2)
+
+    def test_profile_change_is_picked_up_after_expire(self):
+        self.assertEqual(self.resolve(555).plan, 'free')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.profile.plan = 'pro'
+            self.user.profile.save()
+        bot_context.expire_version()
+        self.assertEqual(self.resolve(555).plan, 'pro')
+        self.assertIsNone(self.resolve(777))
+
+    def test_only_bot_fields_bump_version(self):
+        test = make_test(1)
+        version = get_version(BOT_USERS_VERSION)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.first_name = 'Другое имя'
+            self.user.save()
+            self.user.profile.locked_test = test
+            self.user.profile.save()
+            CustomUser.objects.create_user('not_in_bot')
+        self.assertEqual(get_version(BOT_USERS_VERSION), version)
+
+        # Смена языка - одно поднятие версии, хотя save() пользователя сохраняет и профиль
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.user.language = 'en'
+            self.user.save()
+        self.assertEqual(len(callbacks), 1)
+        self.assertNotEqual(get_version(BOT_USERS_VERSION), version)
+
+
+class BotDeckTests(TestCase):
+    """Вопросы тренажера идут из перемешанной колоды пользователя."""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('trainee')
+        self.test = make_test(4, category='memory')
+        self.bank = set(Question.objects.filter(category='memory').values_list('id', flat=True))
+
+    def draw(self, count):
+        return [bot_deck.next_question_id(self.user.id, 'memory') for _ in range(count)]
+
+    def test_exhausted_deck_is_reshuffled(self):
+        answered = min(self.bank)
+        BotResult.objects.create(user=self.user, question_id=answered, is_correct=True)
+        first = self.draw(4)
+        self.assertEqual(set(first), self.bank)
+        # Уже отвеченный вопрос - в конце первого круга
+        self.assertEqual(first[-1], answered)
+        # Колода кончилась - новый круг по всему банку, не с того же вопроса
+        second = self.draw(4)
+        self.assertEqual(set(second), self.bank)
+        self.assertNotEqual(second[0], first[-1])
+
+    def test_content_change_refreshes_deck(self):
+        shown = self.draw(2)
+        removed = next(q for q in self.bank if q not in shown)
+        Question.objects.filter(pk=removed).delete()
+        added = Question.objects.create(test=self.test, text_ru='Новый', category='memory', order=10)
+        bump_version(CONTENT_VERSION)
+
+        rest = self.draw(2)
+        self.assertEqual(set(rest), (self.bank - set(shown) - {removed}) | {added.id})
+        self.assertNotIn(removed, self.draw(4))
+
+    def test_empty_category(self):
+        self.assertIsNone(bot_deck.next_question_id(self.user.id, 'spatial'))
+
+
+class FakeTelegramMessage:
+    """message для send_question_photo: запоминает отправленное, часть file_id отвергает."""
+
+    def __init__(self, rejected=()):
+        self.bot = SimpleNamespace(id=42)
+        self.rejected = set(rejected)
+        self.sent = []
+
+    async def answer_photo(self, photo, **kwargs):
+        self.sent.append(photo)
+        if isinstance(photo, str) and photo in self.rejected:
+            raise RuntimeError('wrong file identifier')
+        return SimpleNamespace(photo=[SimpleNamespace(file_id='thumb'), SimpleNamespace(file_id=f'file-{len(self.sent)}')])
+
+
+class BotPhotoFileIdTests(TestCase):
+    """Картинка вопроса загружается в Telegram один раз, дальше шлется по file_id."""
+
+    def setUp(self):
+        self.question = Question.objects.create(test=make_test(0), text_ru='С картинкой', category='spatial', order=0)
+        self.question.image.name = 'questions/q1.png'
+        self.question.save()
+
+    def send(self, message):
+        question = Question.objects.prefetch_related('telegram_files').get(pk=self.question.pk)
+        return async_to_sync(telegram_bot.send_question_photo)(message, question, 'caption', None)
+
+    def stored(self):
+        return list(QuestionTelegramFile.objects.filter(question=self.question).values_list('file_id', flat=True))
+
+    def test_file_id_is_reused(self):
+        message = FakeTelegramMessage()
+        self.assertTrue(self.send(message))
+        self.assertIsInstance(message.sent[0], telegram_bot.FSInputFile)
+        self.assertEqual(self.stored(), ['file-1'])
+
+        self.assertTrue(self.send(message))
+        self.assertEqual(message.sent[1], 'file-1')
+        self.assertEqual(self.stored(), ['file-1'])
+
+    def test_rejected_file_id_is_replaced(self):
+        self.send(FakeTelegramMessage())
+        message = FakeTelegramMessage(rejected={'file-1'})
+        with mock.patch('builtins.print'):
+            self.assertTrue(self.send(message))
+        # Отвергнутый id забыт, файл загружен заново и запомнен новый id
+        self.assertEqual(message.sent[0], 'file-1')
+        self.assertIsInstance(message.sent[1], telegram_bot.FSInputFile)
+        self.assertEqual(self.stored(), ['file-2'])
+
+    def test_replaced_image_is_uploaded_again(self):
+        self.send(FakeTelegramMessage())
+        Question.objects.filter(pk=self.question.pk).update(image='questions/q2.png')
+        message = FakeTelegramMessage()
+        self.send(message)
+        self.assertIsInstance(message.sent[0], telegram_bot.FSInputFile)
+        self.assertEqual(QuestionTelegramFile.objects.get(question=self.question).image_name, 'questions/q2.png')
+
+
+@mock.patch.dict('os.environ', {'TELEGRAM_TOKEN': 'test-token'})
+class BotWebhookQueueTests(TestCase):
+    """Вебхук только ставит обновление в очередь: дубли отбрасываются, при переполнении - 503."""
+
+    def setUp(self):
+        self.runtime = BotRuntime(workers=1, queue_size=1, dedupe_size=100)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.processed = []
+
+        async def process_update(update):
+            self.started.set()
+            while not self.release.is_set():
+                await asyncio.sleep(0.005)
+            self.processed.append(update.update_id)
+
+        self.runtime.process_update = process_update
+        patcher = mock.patch('quiz.views.bot_runtime', self.runtime)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.release.set()
+        self.runtime.shutdown(timeout=2)
+
+    def post(self, update_id, chat_id=5):
+        update = {
+            'update_id': update_id,
+            'message': {'message_id': update_id, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': 'hi'},
+        }
+        return self.client.post('/webhook/telegram/', json.dumps(update), content_type='application/json')
+
+    def test_duplicate_update_is_dropped(self):
+        self.assertEqual(self.post(1).json()['status'], 'queued')
+        self.assertEqual(self.post(1).json()['status'], 'duplicate')
+        self.release.set()
+        self.runtime.submit(self.runtime._drain(2)).result(timeout=3)
+        self.assertEqual(self.processed, [1])
+        self.assertEqual(self.runtime.stats()['duplicates'], 1)
+
+    def test_full_queue_returns_503(self):
+        self.post(1)
+        # Воркер занят первым обновлением, второе ждет в очереди (размер 1)
+        self.assertTrue(self.started.wait(2))
+        self.assertEqual(self.post(2).json()['status'], 'queued')
+        response = self.post(3)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.runtime.stats()['rejected'], 1)
+
+        # Отвергнутое обновление не помечено как виденное - повторная доставка проходит
+        self.release.set()
+        self.runtime.submit(self.runtime._drain(2)).result(timeout=3)
+        self.assertEqual(self.post(3).json()['status'], 'queued')
+
+    def test_busy_loop_returns_503_and_forgets_update(self):
+        loop_free = threading.Event()
+
+        async def block_loop():
+            loop_free.wait(5)
+
+        blocker = self.runtime.submit(block_loop())
+        enqueue = self.runtime.enqueue
+        self.runtime.enqueue = lambda update: enqueue(update, timeout=0.05)
+        response = self.post(1)
+        self.assertEqual((response.status_code, response.json()['status']), (503, 'busy'))
+
+        loop_free.set()
+        blocker.result(timeout=2)
+        # Опоздавшая постановка в очередь отменена, а повторная доставка не считается дублем
+        self.assertEqual(self.post(1).json()['status'], 'queued')
+        self.release.set()
+        self.runtime.submit(self.runtime._drain(2)).result(timeout=3)
+        self.assertEqual(self.processed, [1])
+
+
+class BotClientTests(TestCase):
+    """Один Bot и одна aiohttp-сессия на процесс (фейковый Bot API из bench_bot_client)."""
+
+    def setUp(self):
+        self.server_loop = asyncio.new_event_loop()
+        server_thread = threading.Thread(target=self.server_loop.run_forever, daemon=True)
+        server_thread.start()
+        self.client_ports = []
+
+        async def start():
+            app = _fake_api_app(0)
+
+            @web.middleware
+            async def remember_port(request, handler):
+                # Порт клиента: тот же порт - то же TCP-соединение
+                self.client_ports.append(request.transport.get_extra_info('peername')[1])
+                return await handler(request)
+
+            app.middlewares.append(remember_port)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            return runner, site._server.sockets[0].getsockname()[1]
+
+        runner, port = asyncio.run_coroutine_threadsafe(start(), self.server_loop).result(timeout=5)
+        self.runtime = BotRuntime(token=FAKE_TOKEN, api_url=f'http://127.0.0.1:{port}', workers=1)
+        self.bots = []
+
+        async def feed_update(bot, update):
+            self.bots.append(bot)
+            if update.update_id == 13:
+                raise TelegramNetworkError(method=None, message='connection reset')
+            await bot.send_message(chat_id=1, text='ping')
+
+        patcher = mock.patch.object(bot_runtime.dp, 'feed_update', side_effect=feed_update)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        def stop_server():
+            self.runtime.shutdown(timeout=2)
+            asyncio.run_coroutine_threadsafe(runner.cleanup(), self.server_loop).result(timeout=5)
+            self.server_loop.call_soon_threadsafe(self.server_loop.stop)
+            server_thread.join(timeout=5)
+            self.server_loop.close()
+
+        self.addCleanup(stop_server)
+
+    def feed(self, update_id):
+        update = Update.model_validate({
+            'update_id': update_id,
+            'message': {'message_id': update_id, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': 'hi'},
+        })
+        return self.runtime.feed_update(update).result(timeout=5)
+
+    def test_bot_and_connection_are_reused(self):
+        for update_id in range(1, 4):
+            self.feed(update_id)
+        self.assertEqual(len({id(bot) for bot in self.bots}), 1)
+        self.assertEqual(len(self.client_ports), 3)
+        self.assertEqual(len(set(self.client_ports)), 1)
+
+    def test_network_error_reconnects(self):
+        self.feed(1)
+        first = self.bots[0]
+        client_session = first.session._session
+        with self.assertRaises(TelegramNetworkError):
+            self.feed(13)
+        self.assertTrue(client_session.closed)
+        self.feed(2)
+        self.assertIsNot(self.bots[-1], first)
+        self.assertEqual(len(set(self.client_ports)), 2)
+
+    def test_shutdown_closes_session(self):
+        self.feed(1)
+        client_session = self.bots[0].session._session
+        self.assertFalse(client_session.closed)
+        self.runtime.shutdown(timeout=2)
+        self.assertTrue(client_session.closed)
+        self.assertIsNone(self.runtime._loop)
+
+
+class ImportQuestionsTests(TestCase):
+    """Импорт вопросов идемпотентен, сухой прогон ничего не пишет."""
+    ROWS = [
+        'category;text;correct_answer;wrong_1;wrong_2;wrong_3',
+        'logic;2 + 2?;4;3;5;',
+        'math;3 * 3?;9;6;;',
+        # Дубль строки внутри файла
+        'logic;2 + 2?;4;3;5;',
+    ]
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.csv_path = os.path.join(tmp.name, 'questions.csv')
+        with open(self.csv_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self.ROWS) + '\n')
+        media = override_settings(MEDIA_ROOT=os.path.join(tmp.name, 'media'))
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def run_import(self, *args):
+        out = StringIO()
+        call_command('import_questions', self.csv_path, *args, stdout=out)
+        return out.getvalue()
+
+    def test_second_import_creates_nothing(self):
+        output = self.run_import()
+        self.assertIn('Добавлено вопросов: 2', output)
+        self.assertIn('дублей в файлах: 1', output)
+        self.assertEqual(Question.objects.count(), 2)
+        self.assertEqual(Answer.objects.count(), 5)
+
+        output = self.run_import()
+        self.assertIn('Добавлено вопросов: 0', output)
+        self.assertIn('уже есть: 3', output)
+        self.assertEqual(Test.objects.count(), 1)
+        self.assertEqual(Question.objects.count(), 2)
+        self.assertEqual(Answer.objects.count(), 5)
+
+    def test_dry_run_writes_nothing(self):
+        output = self.run_import('--dry-run')
+        self.assertIn('[DRY RUN] Будет добавлено вопросов: 2', output)
+        self.assertFalse(Test.objects.exists())
+        self.assertFalse(Question.objects.exists())
+
+        self.run_import()
+        self.assertIn('Будет добавлено вопросов: 0', self.run_import('--dry-run'))
+        self.assertEqual(Question.objects.count(), 2)
+
+
+class HotQueryIndexTests(TestCase):
+    """
+    Горячие запросы идут по индексам (проверка по EXPLAIN).
+    На PostgreSQL смотрим на Index Scan, на SQLite - на SEARCH ... USING INDEX.
+    """
+    USERS = 300
+    QUESTIONS = 2000
+    RESULTS_PER_USER = 10
+    BOT_ANSWERS = 20000
+
+    @classmethod
+    def setUpTestData(cls):
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            return
+        rnd = random.Random(13)
+        users = CustomUser.objects.bulk_create([
+            CustomUser(username=f'user{i}', telegram_chat_id=str(100000 + i), telegram_code=str(10000 + i))
+            for i in range(cls.USERS)
+        ])
+        test = Test.objects.create(title_ru='IQ', questions_count=cls.QUESTIONS)
+        categories = ['logic', 'math', 'spatial', 'memory', 'Multi_table', 'psychology']
+        questions = Question.objects.bulk_create([
+            Question(test=test, text_ru=f'Вопрос {i}', category=categories[i % len(categories)], order=i)
+            for i in range(cls.QUESTIONS)
+        ])
+        UserTestResult.objects.bulk_create([
+            UserTestResult(user=user, test=test, score=rnd.randint(0, 40))
+            for user in users for _ in range(cls.RESULTS_PER_USER)
+        ])
+        BotResult.objects.bulk_create([
+            BotResult(user=rnd.choice(users), question=rnd.choice(questions), is_correct=rnd.random() < 0.5)
+            for _ in range(cls.BOT_ANSWERS)
+        ])
+        cls.user = users[cls.USERS // 2]
+        cls.question = questions[cls.QUESTIONS // 2]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+    def setUp(self):
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            self.skipTest(f'EXPLAIN checks are not written for {connection.vendor}')
+        if connection.vendor == 'postgresql':
+            # На маленьких таблицах планировщик может честно выбрать Seq Scan;
+            # запрещаем его, чтобы Seq Scan в плане означал "подходящего индекса нет"
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertUsesIndex(self, queryset, index_name=None):
+        plan = queryset.explain()
+        if connection.vendor == 'postgresql':
+            self.assertRegex(plan, r'Index (Only )?Scan|Bitmap Index Scan', plan)
+            self.assertNotIn('Seq Scan', plan, plan)
+        else:
+            self.assertRegex(plan, r'USING (COVERING )?INDEX|USING INTEGER PRIMARY KEY', plan)
+            # Полный проход по таблице: "SCAN <таблица>" без USING
+            self.assertNotRegex(plan, r'(?m)\bSCAN \w+$', plan)
+        if index_name:
+            self.assertIn(index_name, plan)
+
+    def test_first_result_of_user(self):
+        # Лимит бесплатного тарифа в home / test_detail
+        qs = UserTestResult.objects.filter(user=self.user).order_by('date_taken')[:1]
+        self.assertUsesIndex(qs, 'quiz_result_user_date_idx')
+
+    def test_bot_history_of_user(self):
+        self.assertUsesIndex(
+            BotResult.objects.filter(user=self.user, question=self.question),
+            'quiz_botresult_user_q_idx',
+        )
+        self.assertUsesIndex(
+            BotResult.objects.filter(user=self.user).values_list('question_id', flat=True),
+            'quiz_botresult_user_q_idx',
+        )
+
+    def test_question_bank_by_category(self):
+        qs = Question.objects.filter(category='memory').values_list('id', flat=True)
+        self.assertUsesIndex(qs, 'quiz_question_category_idx')
+
+    def test_bot_user_lookups(self):
+        self.assertUsesIndex(CustomUser.objects.filter(telegram_chat_id=self.user.telegram_chat_id))
+        self.assertUsesIndex(CustomUser.objects.filter(telegram_code=self.user.telegram_code))
+
+
+class GcTestAttemptsTests(TestCase):
+    def test_removes_only_expired_attempts(self):
+        test = make_test(1)
+        attempts = [
+            TestAttempt.objects.create(session_key=f's{i}', test=test, seed=i, content_fingerprint=0,
+                                       answers=b'\x00', locked_steps=b'\x00')
+            for i in range(5)
+        ]
+        TestAttempt.objects.filter(pk__in=[a.pk for a in attempts[:3]]).update(
+            updated_at=timezone.now() - timedelta(days=31)
+        )
+        # На границе: 29 дней без изменений - еще живая попытка
+        TestAttempt.objects.filter(pk=attempts[3].pk).update(updated_at=timezone.now() - timedelta(days=29))
+
+        out = StringIO()
+        call_command('gc_test_attempts', days=30, batch_size=2, stdout=out)
+        self.assertIn('Удалено попыток: 3', out.getvalue())
+        self.assertEqual(
+            set(TestAttempt.objects.values_list('pk', flat=True)), {attempts[3].pk, attempts[4].pk}
+        )
+
+
+class SeededOrderTests(TestCase):
+    """Порядок вопросов и ответов попытки выводится из seed и не зависит от момента вызова."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.test = make_test(30)
+        cls.test.questions_count = 20
+        cls.test.save()
+        bump_version(CONTENT_VERSION)
+
+    def test_regeneration_is_stable(self):
+        test = get_test_blueprint(self.test.id)
+        rnd = random.Random(16)
+        for _ in range(200):
+            seed = rnd.getrandbits(63)
+            order = question_order(test, seed)
+            # Та же перестановка при каждом вызове (на любом воркере - Random от строки детерминирован)
+            self.assertEqual(order, question_order(test, seed))
+            self.assertEqual(len(order), 20)
+            self.assertEqual(len(set(order)), 20)
+            self.assertTrue(set(order) <= set(test.question_ids))
+            for q_id in order:
+                question = test.questions[q_id]
+                answers = answer_order(question, seed)
+                self.assertEqual([a.id for a in answers], [a.id for a in answer_order(question, seed)])
+                self.assertEqual(sorted(a.id for a in answers), sorted(a.id for a in question.answers))
+
+        orders = {tuple(question_order(test, seed)) for seed in range(50)}
+        self.assertGreater(len(orders), 45)
+
+    def test_answer_order_survives_refresh(self):
+        user = CustomUser.objects.create_user('refresher', password='x')
+        self.client.force_login(user)
+        url = f'/test/{self.test.id}/'
+        first = [a.id for a in self.client.get(url).context['answers_list']]
+        second = [a.id for a in self.client.get(url).context['answers_list']]
+        self.assertEqual(first, second)
+
+    def test_questions_count_raised_mid_attempt(self):
+        user = CustomUser.objects.create_user('recounted')
+        user.profile.plan = 'pro'
+        user.profile.save()
+        self.client.force_login(user)
+        url = f'/test/{self.test.id}/'
+        self.client.get(url)
+        self.assertEqual(len(TestAttempt.objects.get(user=user).answers), 20)
+
+        # Правка откатится вместе с транзакцией теста - кешированный чертеж тоже не должен пережить тест
+        self.addCleanup(bump_version, CONTENT_VERSION)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.test.questions_count = 25
+            self.test.save()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        # Попытка началась заново - с 25 шагами
+        attempt = TestAttempt.objects.get(user=user)
+        self.assertEqual((len(attempt.answers), len(attempt.locked_steps)), (25, 4))
+        answer = response.context['answers_list'][0]
+        self.client.post(url, {'action': 'next', 'selected_answer': answer.id})
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_state_size_for_96_questions(self):
+        test = make_test(96, title='IQ 96')
+        user = CustomUser.objects.create_user('sizer', password='x')
+        user.profile.plan = 'pro'
+        user.profile.save()
+        self.client.force_login(user)
+        url = f'/test/{test.id}/'
+        for _ in range(95):
+            answer = self.client.get(url).context['answers_list'][0]
+            self.client.post(url, {'action': 'next', 'selected_answer': answer.id})
+
+        attempt = TestAttempt.objects.get(user=user, test=test)
+        state_bytes = 8 + 8 + len(attempt.answers) + len(attempt.locked_steps) + 4
+        # Прежнее состояние: 4 ключа сессии (порядок id, индекс, ответы, заблокированные шаги)
+        blueprint = get_test_blueprint(test.id)
+        order = question_order(blueprint, attempt.seed)
+        legacy = json.dumps({
+            f'test_{test.id}_order': order,
+            f'test_{test.id}_index': 95,
+            f'test_{test.id}_answers': {str(q): blueprint.questions[q].answers[0].id for q in order[:95]},
+            f'test_{test.id}_locked': [],
+        })
+        sizes = f'96 questions: attempt state {state_bytes} B, legacy session state {len(legacy)} B'
+        self.assertLessEqual(state_bytes, 140, sizes)
+        self.assertLess(state_bytes * 10, len(legacy), sizes)
+
+
+class RequestMetricsTests(TestCase):
+    """Server-Timing и гистограммы по url_name из RequestMetricsMiddleware."""
+
+    def setUp(self):
+        request_metrics.reset()
+        self.test = make_test(3)
+        bump_version(CONTENT_VERSION)
+
+    def test_server_timing_counts_queries(self):
+        user = CustomUser.objects.create_user('timed', password='x')
+        self.client.force_login(user)
+        url = f'/test/{self.test.id}/'
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        header = response['Server-Timing']
+        self.assertIn(f'desc="{len(ctx)} queries"', header)
+        for metric in ('db;dur=', 'view;dur=', 'tpl;dur=', 'total;dur='):
+            self.assertIn(metric, header)
+
+        route = request_metrics.stats()['routes']['test_detail']
+        self.assertEqual(route['count'], 1)
+        self.assertEqual(route['max_queries'], len(ctx))
+        self.assertEqual(sum(route['histogram'].values()), 1)
+
+    def test_stats_endpoint_is_staff_only(self):
+        user = CustomUser.objects.create_user('ops', password='x')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get('/ops/requests/').status_code, 302)
+        user.is_staff = True
+        user.save()
+        self.client.get('/')
+        data = self.client.get('/ops/requests/').json()['requests']
+        self.assertIn('home', data['routes'])
+
+    @override_settings(REQUEST_METRICS_SAMPLE_RATE=1, REQUEST_METRICS_SLOW_MS=0)
+    def test_sampled_slow_request_logs_top_sql(self):
+        self.client.force_login(CustomUser.objects.create_user('sampled', password='x'))
+        with self.assertLogs('quiz.request_metrics', level='WARNING') as logs:
+            self.client.get('/')
+        self.assertIn('Slow request GET / (home)', logs.output[0])
+        self.assertIn('x SELECT', logs.output[0])
+
+
+@override_settings(AI_PROVIDER='gemini', GOOGLE_API_KEY='test-key')
+class ModelRegistryTests(TestCase):
+    """Модель Gemini выбирается один раз на процесс, дальше get() не ходит в сеть."""
+
+    def setUp(self):
+        self.registry = ModelRegistry()
+
+    def _info(self, methods=('generateContent',)):
+        return mock.Mock(supported_generation_methods=list(methods))
+
+    def test_probe_once_and_skip_unavailable(self):
+        def get_model(name, **kwargs):
+            if name == f'models/{MODEL_NAMES[0]}':
+                raise RuntimeError('404 not found')
+            return self._info()
+
+        with mock.patch.object(genai, 'configure') as configure, \
+                mock.patch.object(genai, 'get_model', side_effect=get_model) as probe, \
+                mock.patch.object(genai, 'GenerativeModel') as model_cls:
+            first = self.registry.get()
+            for _ in range(10):
+                self.assertIs(self.registry.get(), first)
+        configure.assert_called_once_with(api_key='test-key')
+        self.assertEqual(probe.call_count, 2)
+        model_cls.assert_called_once_with(MODEL_NAMES[1])
+        stats = self.registry.stats()
+        self.assertEqual(stats['model'], MODEL_NAMES[1])
+        self.assertTrue(stats['verified'])
+        self.assertEqual(stats['probes'], 1)
+
+    def test_unreachable_api_keeps_primary_model_unverified(self):
+        with mock.patch.object(genai, 'configure'), \
+                mock.patch.object(genai, 'get_model', side_effect=OSError('network')), \
+                mock.patch.object(genai, 'list_models', side_effect=OSError('network')), \
+                mock.patch.object(genai, 'GenerativeModel'):
+            self.assertIsNotNone(self.registry.get())
+        self.assertEqual(self.registry.stats()['model'], MODEL_NAMES[0])
+        self.assertFalse(self.registry.stats()['verified'])
+
+    def test_repeated_failures_trigger_background_reprobe(self):
+        with mock.patch.object(genai, 'configure'), \
+                mock.patch.object(genai, 'get_model', return_value=self._info()), \
+                mock.patch.object(genai, 'GenerativeModel'), \
+                mock.patch.object(self.registry, '_reprobe_in_background') as reprobe:
+            self.registry.get()
+            for _ in range(3):
+                self.registry.report_failure(RuntimeError('500'))
+        reprobe.assert_called_once()
+
+
+@override_settings(AI_PROVIDER='fake', AI_TIMEOUT=0.05)
+class AIBreakerTests(TestCase):
+    """Дедлайн и предохранитель вокруг генерации на медленной заглушке."""
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=2, cooldown=60, slow_call_seconds=1)
+        patcher = mock.patch.object(ai_service, 'breaker', self.breaker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def generate(self):
+        return ai_service.generate_report_uncached('Ann', {'logic': 1}, 1, language='en')
+
+    @override_settings(AI_FAKE_DELAY=0.3)
+    def test_timeouts_open_breaker_and_serve_fallback(self):
+        for _ in range(2):
+            text, from_ai = self.generate()
+            self.assertFalse(from_ai)
+            self.assertTrue(text.startswith('Dear Ann!'))
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.breaker.stats()['timeouts'], 2)
+
+        started = time.monotonic()
+        text, from_ai = self.generate()
+        # Открытый предохранитель не ждет провайдера
+        self.assertLess(time.monotonic() - started, 0.05)
+        self.assertFalse(from_ai)
+        self.assertEqual(self.breaker.stats()['rejected'], 1)
+
+    def test_half_open_probe_closes_breaker(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.cooldown = 0
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+        # Пока идет пробный вызов, остальные получают заглушку
+        self.assertFalse(self.breaker.allow())
+        self.breaker.release()
+
+        text, from_ai = self.generate()
+        self.assertTrue(from_ai)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_slow_successes_count_as_failures(self):
+        self.breaker.record_success(1.5)
+        self.breaker.record_success(2)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.breaker.stats()['slow_calls'], 2)
+
+    def test_transport_timeout_and_no_client_retries(self):
+        model = mock.Mock()
+        model.generate_content.return_value = SimpleNamespace(text='ok')
+        with mock.patch.object(ai_service, 'get_model', return_value=model):
+            self.assertEqual(self.generate(), ('ok', True))
+        self.assertEqual(model.generate_content.call_args.kwargs['request_options'], {'timeout': 0.05, 'retry': None})
+
+    def occupy_pool(self, seconds):
+        pool = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(pool.shutdown)
+        patcher = mock.patch.object(ai_service, '_call_pool', pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        pool.submit(time.sleep, seconds)
+
+    @override_settings(AI_TIMEOUT=0.2, AI_FAKE_DELAY=0.1)
+    def test_waiting_for_a_thread_is_not_counted_in_deadline(self):
+        # 0.15 с в очереди пула + 0.1 с вызова > AI_TIMEOUT, но сам вызов укладывается
+        self.occupy_pool(0.15)
+        text, from_ai = self.generate()
+        self.assertTrue(from_ai)
+        self.assertEqual(self.breaker.stats()['timeouts'], 0)
+
+    @override_settings(AI_TIMEOUT=0.05)
+    def test_busy_pool_serves_fallback_without_tripping_breaker(self):
+        self.occupy_pool(0.3)
+        text, from_ai = self.generate()
+        self.assertFalse(from_ai)
+        stats = self.breaker.stats()
+        self.assertEqual((stats['calls'], stats['failures'], stats['state']), (0, 0, CLOSED))
+
+
+@override_settings(AI_PROVIDER='fake', AI_FAKE_DELAY=0)
+class AnalysisStreamTests(TestCase):
+    """Анализ на странице результата приходит кусками и сохраняется один раз."""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('streamer', password='x')
+        self.client.force_login(self.user)
+        self.result = UserTestResult.objects.create(user=self.user, test=make_test(1), score=1)
+        self.job = enqueue_report(
+            self.result, user_name='Ann', category_stats={'logic': 1}, total_score=1,
+            test_type='iq', language='ru', total_questions=1, analysis_for='user',
+        )
+        self.url = f'/result/{self.result.id}/analysis/stream/'
+
+    def events(self, response):
+        body = b''.join(response.streaming_content).decode()
+        return [
+            (block.split('\n')[0][len('event: '):], json.loads(block.split('\n')[1][len('data: '):])['text'])
+            for block in body.strip().split('\n\n')
+        ]
+
+    def test_streams_chunks_and_persists_once(self):
+        events = self.events(self.client.get(self.url))
+        chunks = [text for name, text in events if name == 'chunk']
+        self.assertGreater(len(chunks), 3)
+        self.assertEqual(events[-1][0], 'done')
+        text = ''.join(chunks)
+        # Плейсхолдер имени, разрезанный границами кусков, все равно заменен
+        self.assertIn('пользователя Ann.', text)
+        self.assertNotIn('{{', text)
+
+        self.result.refresh_from_db()
+        self.assertEqual(self.result.ai_analysis, text)
+        self.assertEqual(ReportJob.objects.get(pk=self.job.pk).status, 'done')
+
+        # Повторное открытие отдает сохраненный текст, ничего не генерируя и не перезаписывая
+        self.assertEqual(self.events(self.client.get(self.url)), [('chunk', text), ('done', '')])
+
+    def test_job_taken_by_worker_falls_back_to_polling(self):
+        ReportJob.objects.filter(pk=self.job.pk).update(status='running')
+        self.assertEqual(self.events(self.client.get(self.url)), [('pending', '')])
+
+    def test_disconnect_returns_job_to_queue(self):
+        response = self.client.get(self.url)
+        next(iter(response.streaming_content))
+        response.close()
+        job = ReportJob.objects.get(pk=self.job.pk)
+        self.assertEqual(job.status, 'pending')
+        self.result.refresh_from_db()
+        self.assertIsNone(self.result.ai_analysis)
+
+    def test_user_jobs_wait_for_the_page(self):
+        self.assertEqual(claim_jobs(10), [])
+        ReportJob.objects.filter(pk=self.job.pk).update(created_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(claim_jobs(10), [self.job.pk])
+
+    def test_personalize_stream_boundaries(self):
+        text = 'Привет, {{user_name}}! {{user_name}}{ {{user'
+        for size in range(1, len(text) + 1):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            self.assertEqual(
+                ''.join(report_cache.personalize_stream(chunks, 'Ann')),
+                'Привет, Ann! Ann{ {{user',
+            )
+
+
+class ReportCacheTests(TestCase):
+    """Двухуровневый кеш анализов: память процесса, затем таблица AIReportCache."""
+
+    def setUp(self):
+        report_cache.reset()
+        self.addCleanup(report_cache.reset)
+        self.key = report_cache.make_key('iq', 'ru', 'user', 5, 10, {'Логика': 5})
+
+    def later(self, days):
+        return mock.patch.object(report_cache.timezone, 'now', return_value=timezone.now() + timedelta(days=days))
+
+    def test_miss_then_memory_hit(self):
+        self.assertIsNone(report_cache.lookup(self.key))
+        report_cache.store(self.key, 'Текст')
+        with self.assertNumQueries(0):
+            self.assertEqual(report_cache.lookup(self.key), 'Текст')
+        stats = report_cache.stats()
+        self.assertEqual((stats['misses'], stats['memory_hits'], stats['db_hits'], stats['stores']), (1, 1, 0, 1))
+        self.assertEqual(stats['api_calls_saved'], 1)
+
+    def test_db_hit_fills_memory(self):
+        report_cache.store(self.key, 'Текст')
+        report_cache.reset()
+        self.assertEqual(report_cache.lookup(self.key), 'Текст')
+        self.assertEqual(AIReportCache.objects.get(key=self.key).hits, 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(report_cache.lookup(self.key), 'Текст')
+        stats = report_cache.stats()
+        self.assertEqual((stats['db_hits'], stats['memory_hits'], stats['misses']), (1, 1, 0))
+
+    def test_expired_entries_miss(self):
+        report_cache.store(self.key, 'Текст')
+        with self.later(31):
+            self.assertIsNone(report_cache.lookup(self.key))
+        report_cache.reset()
+        AIReportCache.objects.update(created_at=timezone.now() - timedelta(days=31))
+        self.assertIsNone(report_cache.lookup(self.key))
+        self.assertEqual(report_cache.stats()['misses'], 1)
+
+    def test_db_hit_does_not_outlive_row(self):
+        AIReportCache.objects.create(key=self.key, text='Текст')
+        AIReportCache.objects.update(created_at=timezone.now() - timedelta(days=29))
+        self.assertEqual(report_cache.lookup(self.key), 'Текст')
+        # Строке остался день - запись в памяти живет столько же
+        with self.later(2), self.assertNumQueries(1):
+            self.assertIsNone(report_cache.lookup(self.key))
+
+    @override_settings(AI_REPORT_CACHE_MAX_ROWS=2)
+    def test_prune_drops_expired_and_least_used(self):
+        now = timezone.now()
+        for i in range(4):
+            AIReportCache.objects.create(key=f'k{i}', text='t')
+            AIReportCache.objects.filter(key=f'k{i}').update(last_used_at=now - timedelta(hours=i))
+        AIReportCache.objects.create(key='old', text='t')
+        AIReportCache.objects.filter(key='old').update(created_at=now - timedelta(days=31))
+        self.assertEqual(report_cache.prune(), 3)
+        self.assertEqual(set(AIReportCache.objects.values_list('key', flat=True)), {'k0', 'k1'})
+
+
+class PromptBuilderTests(TestCase):
+    """Блок ответов психологического отчета укладывается в бюджет и сохраняет итоги по всем шкалам."""
+
+    def answers(self, count):
+        categories = ['Эмпатия', 'Стресс', 'Команда']
+        return [
+            {
+                'question_id': 1000 + i,
+                'category': categories[i % 3],
+                'question_text': f'Ситуация {i}: коллега сорвал срок и просит прикрыть его перед руководителем. ' * 2,
+                'selected_answer_text': 'Промолчать',
+                'correct_answer_text': 'Промолчать' if i % 2 else 'Поговорить с коллегой наедине',
+                'is_correct': bool(i % 2),
+                'answered': i % 10 != 0,
+            }
+            for i in range(count)
+        ]
+
+    def test_budget_and_category_totals(self):
+        answers = self.answers(120)
+        context = build_answers_context(answers, 'ru', 800)
+        self.assertLessEqual(context.tokens_after, 800 + 20)
+        self.assertLess(context.tokens_after * 4, context.tokens_before)
+        self.assertGreater(context.dropped, 0)
+        for category in ('Эмпатия', 'Стресс', 'Команда'):
+            self.assertIn(f'- {category}: 20/40', context.text)
+            # Ошибки берутся по очереди из каждой шкалы
+            self.assertIn(f'[{category}]', context.text)
+        self.assertEqual(context.codes['Q1'], 1000)
+        # Верные ответы подробно не расписываются
+        self.assertNotIn('Ситуация 1:', context.text)
+
+    def test_small_test_fits_entirely(self):
+        context = build_answers_context(self.answers(6), 'en', 1500)
+        self.assertEqual(context.dropped, 0)
+        self.assertIn('Unanswered: Q1', context.text)
+        self.assertIn('Correct: Q2 Q4 Q6', context.text)
+        self.assertIn('Q3 [Команда] Ситуация 2:', context.text)
+
+
+@override_settings(AI_PROVIDER='fake', AI_FAKE_DELAY=0)
+class BatchReportTests(TestCase):
+    """Пакетная генерация анализов и перезапуск с HR-панели."""
+
+    def setUp(self):
+        self.recruiter = CustomUser.objects.create_user('batch_hr')
+        self.recruiter.profile.plan = 'hr'
+        self.recruiter.profile.save()
+        test = make_test(2, category='psychology', title='Soft')
+        self.results = []
+        for i in range(6):
+            candidate = CustomUser.objects.create_user(f'batch_c{i}')
+            result = UserTestResult.objects.create(user=candidate, test=test, score=1,
+                                                   ai_analysis='old' if i < 2 else None)
+            enqueue_report(result, user_name=f'C{i}', category_stats={}, total_score=1, test_type='psychology',
+                           language='ru', detailed_answers=[], total_questions=2, analysis_for='recruiter')
+            TestInvitation.objects.create(recruiter=self.recruiter, test=test, candidate_email=f'c{i}@x.kz',
+                                          completed=True, result=result)
+            self.results.append(result)
+
+    def test_batch_writes_all_reports(self):
+        ids = [r.id for r in select_results(recruiter=self.recruiter)]
+        self.assertEqual(len(ids), 6)
+        ReportJob.objects.filter(result=self.results[5]).update(status='running')
+
+        stats = BatchRunner(workers=3, rate_per_minute=0, write_batch_size=2).run(ids)
+        self.assertEqual((stats['ai'], stats['busy']), (5, 1))
+
+        analyses = dict(UserTestResult.objects.filter(pk__in=ids).values_list('id', 'ai_analysis'))
+        for result in self.results[:5]:
+            self.assertTrue(analyses[result.id].startswith('[FAKE AI]'))
+        # Задачу, которую генерирует кто-то другой, пакет не трогает
+        self.assertIsNone(analyses[self.results[5].id])
+        self.assertEqual(ReportJob.objects.filter(status='done').count(), 5)
+
+    def test_failed_generation_keeps_existing_analysis(self):
+        with mock.patch.object(report_batch, 'generate_report', return_value=('fallback', False)):
+            stats = BatchRunner(workers=2, retries=1, backoff=0).run([r.id for r in self.results[:3]])
+        self.assertEqual((stats['kept'], stats['fallback'], stats['retries']), (2, 1, 3))
+        analyses = dict(UserTestResult.objects.values_list('id', 'ai_analysis'))
+        self.assertEqual(analyses[self.results[0].id], 'old')
+        self.assertEqual(analyses[self.results[2].id], 'fallback')
+
+    def test_job_going_stale_mid_batch(self):
+        ReportJob.objects.update(status='done')
+        ids = [r.id for r in self.results[2:5]]
+        calls = []
+        taken = []
+        stolen = threading.Event()
+        runner = BatchRunner(workers=1, retries=2, backoff=0, heartbeat_seconds=0.01)
+        heartbeat = runner._heartbeat
+
+        def stale_heartbeat(claims):
+            if not stolen.is_set():
+                # Пакет идет дольше порога: задачу вернули в очередь и забрал воркер
+                report_jobs.requeue_stale_jobs(0)
+                taken.extend(claim_jobs(10))
+            heartbeat(claims)
+            stolen.set()
+
+        def generate(**payload):
+            calls.append(payload['user_name'])
+            if len(calls) == 1:
+                stolen.wait(5)
+                return 'fallback', False
+            return f"AI {payload['user_name']}", True
+
+        runner._heartbeat = stale_heartbeat
+        with mock.patch.object(report_batch, 'generate_report', side_effect=generate):
+            stats = runner.run(ids)
+        # Остальные задачи пакет еще не забирал - они не попали под возврат в очередь
+        self.assertEqual(taken, [ReportJob.objects.get(result=self.results[2]).id])
+        # Повтор для уже чужой задачи провайдера не вызывает
+        self.assertEqual(calls, ['C2', 'C3', 'C4'])
+        self.assertEqual((stats['ai'], stats['lost']), (2, 1))
+        analyses = dict(UserTestResult.objects.values_list('id', 'ai_analysis'))
+        self.assertEqual([analyses[i] for i in ids], [None, 'AI C3', 'AI C4'])
+        self.assertEqual(ReportJob.objects.get(result=self.results[2]).status, 'running')
+
+    def test_legacy_result_without_job_is_backfilled(self):
+        test = self.results[0].test
+        candidate = CustomUser.objects.create_user('batch_legacy')
+        legacy = UserTestResult.objects.create(user=candidate, test=test, score=1, language='en')
+        blueprint = get_test_blueprint(test.id)
+        UserAnswer.objects.bulk_create([
+            UserAnswer(result=legacy, question_id=q_id, selected_answer_id=blueprint.questions[q_id].answers[0].id,
+                       is_correct=True)
+            for q_id in blueprint.question_ids
+        ])
+        TestInvitation.objects.create(recruiter=self.recruiter, test=test, candidate_email='legacy@x.kz',
+                                      completed=True, result=legacy)
+        ReportJob.objects.update(status='done')
+
+        self.client.force_login(self.recruiter)
+        self.client.post('/hr/dashboard/', {'action': 'regenerate', 'email': 'legacy'})
+        job = ReportJob.objects.get(result=legacy)
+        self.assertEqual(job.status, 'pending')
+        self.assertEqual(
+            {key: job.payload[key] for key in ('user_name', 'total_score', 'test_type', 'language',
+                                               'total_questions', 'analysis_for')},
+            {'user_name': 'batch_legacy', 'total_score': 1, 'test_type': 'psychology', 'language': 'en',
+             'total_questions': 2, 'analysis_for': 'recruiter'},
+        )
+        self.assertEqual([a['answered'] for a in job.payload['detailed_answers']], [True, True])
+
+        self.assertIn(legacy.id, [r.id for r in select_results(recruiter=self.recruiter)])
+        stats = BatchRunner(workers=1, rate_per_minute=0).run([legacy.id])
+        self.assertEqual(stats['ai'], 1)
+        self.assertTrue(UserTestResult.objects.get(pk=legacy.pk).ai_analysis.startswith('[FAKE AI]'))
+
+    def test_token_bucket_paces_calls(self):
+        bucket = TokenBucket(rate_per_minute=600)
+        started = time.monotonic()
+        for _ in range(4):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.25)
+
+    def test_hr_regenerate_requeues_filtered_results(self):
+        ReportJob.objects.update(status='done', attempts=2)
+        self.client.force_login(self.recruiter)
+        response = self.client.post('/hr/dashboard/', {'action': 'regenerate', 'email': 'c1'})
+        self.assertEqual(response.status_code, 302)
+        job = ReportJob.objects.get(result=self.results[1])
+        self.assertEqual((job.status, job.attempts), ('pending', 0))
+        self.assertEqual(ReportJob.objects.filter(status='pending').count(), 1)
+
+    def test_requeued_worker_fallback_keeps_existing_analysis(self):
+        ReportJob.objects.update(status='done', attempts=2)
+        self.client.force_login(self.recruiter)
+        self.client.post('/hr/dashboard/', {'action': 'regenerate'})
+        # ИИ недоступен - воркер получает заглушку
+        with mock.patch.object(report_jobs, 'generate_report', return_value=('fallback', False)):
+            for job_id in claim_jobs(10):
+                self.assertEqual(report_jobs.run_job(job_id), 'done')
+        analyses = dict(UserTestResult.objects.values_list('id', 'ai_analysis'))
+        self.assertEqual([analyses[r.id] for r in self.results[:3]], ['old', 'old', 'fallback'])
+
+
+class CatalogCacheTests(TestCase):
+    """Каталог на главной берется из кеша; кнопки свои у каждого пользователя."""
+
+    def setUp(self):
+        self.first = make_test(1, title='Первый')
+        self.second = make_test(1, title='Второй')
+        self.recruiter_only = make_test(1, title='Для HR')
+        Test.objects.filter(pk=self.recruiter_only.pk).update(test_audience='recruiter')
+        bump_version(CATALOG_VERSION)
+
+    def test_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(ctx), 0)
+
+        self.client.force_login(CustomUser.objects.create_user('viewer'))
+        self.client.get('/')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/')
+        self.assertFalse([q for q in ctx.captured_queries if 'quiz_test' in q['sql']])
+        self.assertContains(response, 'Первый')
+        self.assertNotContains(response, 'Для HR')
+
+    def test_test_change_invalidates_catalog(self):
+        self.client.force_login(CustomUser.objects.create_user('viewer'))
+        self.client.get('/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.first.title_ru = 'Переименован'
+            self.first.save()
+        self.assertContains(self.client.get('/'), 'Переименован')
+
+    def test_per_user_buttons(self):
+        free = CustomUser.objects.create_user('free_user')
+        free.profile.locked_test = self.second
+        free.profile.save()
+        self.client.force_login(free)
+        body = self.client.get('/').content.decode()
+        self.assertIn(f'href="/test/{self.second.id}/" class="btn btn-primary', body)
+        self.assertEqual(body.count('disabled'), 1)
+
+        hr = CustomUser.objects.create_user('hr_user')
+        hr.profile.plan = 'hr'
+        hr.profile.save()
+        self.client.force_login(hr)
+        body = self.client.get('/').content.decode()
+        self.assertIn('Для HR', body)
+        self.assertEqual(body.count('btn btn-success w-100'), 3)
+        self.assertNotIn('catalog-action', body)
+
+
+@override_settings(SCORE_PERCENTILE_MIN_RESULTS=1)
+class ScorePercentileTests(TestCase):
+    def setUp(self):
+        score_stats.reset()
+        self.test = make_test(1)
+
+    def add_results(self, scores, audience='user', language='ru'):
+        for score in scores:
+            UserTestResult.objects.create(test=self.test, score=score, language=language, audience=audience)
+            score_stats.record_score(self.test.id, score, language=language, audience=audience)
+
+    def buckets(self):
+        return dict(ScoreHistogram.objects.filter(test=self.test).values_list('score', 'count'))
+
+    def test_percentile_from_histogram(self):
+        self.add_results([1, 2, 2, 3, 4, 4, 4, 5])
+        self.add_results([1, 9], audience='recruiter', language='en')
+        self.assertEqual(score_stats.percentile(self.test.id, 5), 80)
+        self.assertEqual(score_stats.percentile(self.test.id, 1), 0)
+        self.assertEqual(score_stats.percentile(self.test.id, 10), 100)
+        self.assertEqual(score_stats.percentile(self.test.id, 5, audience='user'), 87)
+        self.assertEqual(score_stats.percentile(self.test.id, 9, language='en'), 50)
+        # Распределение в памяти процесса - повторный поиск без запросов
+        with self.assertNumQueries(0):
+            score_stats.percentile(self.test.id, 3)
+
+    @override_settings(SCORE_PERCENTILE_MIN_RESULTS=5)
+    def test_too_few_results(self):
+        self.add_results([1, 2])
+        self.assertIsNone(score_stats.percentile(self.test.id, 2))
+
+    def test_finish_records_score_and_delete_forgets_it(self):
+        user = CustomUser.objects.create_user('taker')
+        self.client.force_login(user)
+        url = f'/test/{self.test.id}/'
+        correct = next(a for a in self.client.get(url).context['answers_list'] if a.is_correct)
+        self.client.post(url, {'action': 'finish', 'selected_answer': correct.id})
+        result = UserTestResult.objects.get(user=user)
+        self.assertEqual((result.language, result.audience), ('ru', 'user'))
+        self.assertEqual(ScoreHistogram.objects.get(test=self.test, score=1).count, 1)
+
+        result.delete()
+        self.assertEqual(ScoreHistogram.objects.get(test=self.test, score=1).count, 0)
+
+    def test_result_page_shows_percentile(self):
+        self.add_results([0, 0, 0, 1])
+        user = CustomUser.objects.create_user('viewer')
+        result = UserTestResult.objects.create(user=user, test=self.test, score=1, language='ru', summary={'items': [], 'categories': {}})
+        score_stats.record_score(self.test.id, 1, language='ru')
+        self.client.force_login(user)
+        response = self.client.get(f'/result/{result.id}/')
+        self.assertEqual(response.context['percentile'], 60)
+        etag = response['ETag']
+
+        # Тест прошли еще - процентиль сдвинулся, а с ним и ETag
+        self.add_results([0, 0, 0, 0, 0])
+        score_stats.reset()
+        response = self.client.get(f'/result/{result.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['percentile'], 80)
+
+    def test_rebuild_matches_results(self):
+        self.add_results([1, 2, 2, 3])
+        other = make_test(1, title='Другой')
+        UserTestResult.objects.create(test=other, score=7, language='kk')
+        # Счетчики разошлись с результатами
+        ScoreHistogram.objects.filter(test=self.test, score=2).update(count=50)
+        ScoreHistogram.objects.create(test=self.test, score=99, count=3)
+
+        scanned, buckets = score_stats.rebuild(chunk_size=2)
+        self.assertEqual((scanned, buckets), (5, 4))
+        self.assertEqual(self.buckets(), {1: 1, 2: 2, 3: 1})
+        self.assertEqual(ScoreHistogram.objects.get(test=other).language, 'kk')
+
+        # Пересборка одного теста не трогает другие
+        ScoreHistogram.objects.filter(test=other).update(count=10)
+        self.assertEqual(score_stats.rebuild(test_id=self.test.id), (4, 3))
+        self.assertEqual(ScoreHistogram.objects.get(test=other).count, 10)
@@ -7,8 +7,13 @@ urlpatterns = [
     path('test/<int:test_id>/', views.test_detail, name='test_detail'),
     # НОВАЯ СТРОКА:
     path('result/<int:result_id>/', views.result_detail, name='result_detail'),
+    path('result/<int:result_id>/analysis/', views.result_analysis, name='result_analysis'),
+    path('result/<int:result_id>/analysis/stream/', views.result_analysis_stream, name='result_analysis_stream'),
     path('hr/dashboard/', views.hr_dashboard, name='hr_dashboard'),
     path('invite/<uuid:uuid>/', views.accept_invitation, name='accept_invitation'),
     path('upgrade/<str:plan_type>/', views.upgrade_profile, name='upgrade_profile'),
     path('webhook/telegram/', telegram_webhook, name='telegram_webhook'),
+    path('ops/ai/', views.ai_stats, name='ai_stats'),
+    path('ops/bot/', views.bot_stats, name='bot_stats'),
+    path('ops/requests/', views.request_stats, name='request_stats'),
 ]
@@ -0,0 +1,45 @@
+"""
+Счетчики версий в общем кеше ('shared').
+
+Каждый воркер держит свои локальные копии редко меняющихся данных
+(тесты, каталог и т.п.) и помечает их номером версии. Изменение данных
+увеличивает счетчик, и все воркеры при следующем обращении видят,
+что их копия устарела.
+"""
+import time
+from django.core.cache import caches
+
+# Версия содержимого тестов (Test / Question / Answer)
+CONTENT_VERSION = 'quiz:content_version'
+# Версия каталога тестов на главной (только Test: названия, описания, аудитория)
+CATALOG_VERSION = 'quiz:catalog_version'
+# Версия данных пользователей бота (язык, категория, тариф, привязка чата)
+BOT_USERS_VERSION = 'quiz:bot_users_version'
+
+
+def _shared():
+    return caches['shared']
+
+
+def _fresh_value():
+    # Если ключ потерялся (очистили кеш), начинаем с числа, которое
+    # гарантированно не совпадет ни с одной старой версией в памяти воркеров
+    return time.time_ns()
+
+
+def get_version(name):
+    """Текущая версия (создается при первом обращении)."""
+    version = _shared().get(name)
+    if version is None:
+        _shared().add(name, _fresh_value())
+        version = _shared().get(name)
+    return version
+
+
+def bump_version(name):
+    """Помечает все локальные копии с этой версией как устаревшие."""
+    try:
+        return _shared().incr(name)
+    except ValueError:
+        _shared().set(name, _fresh_value())
+        return _shared().get(name)
@@ -1,24 +1,45 @@
+import hashlib
 import json
 import logging
 import random # <--- Тот самый потерянный импорт
 import os
 import sys
+import uuid
+from datetime import datetime, timedelta, timezone as dt_timezone
+from urllib.parse import urlencode
 from django.shortcuts import render, get_object_or_404, redirect
 from django.utils import timezone
+from django.urls import reverse
+from django.core.cache import caches
+from django.db.models import Q, Count, F
+from django.db import transaction
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import logout
 from django.utils.translation import get_language
 from django.utils.translation import gettext as _ # Импорт для переводов внутри Python
 from django.contrib import messages
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, Http404, StreamingHttpResponse
+from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
 from django.views.decorators.csrf import csrf_exempt
-from aiogram import Bot
 from aiogram.types import Update
-from .telegram_bot import dp  # Импортируем из нового файла
+from .bot_runtime import LOOP_BUSY, QUEUE_FULL, runtime as bot_runtime
 # Импорт моделей
-from .models import Test, Question, Answer, UserTestResult, UserAnswer, TestInvitation, UserProfile
-# Импорт сервиса ИИ
-from .ai_service import generate_test_report
+from .models import Test, UserTestResult, UserAnswer, TestInvitation, UserProfile, ReportJob, CATEGORY_CHOICES, invitation_counts_key
+from .blueprints import get_test_blueprint
+from .catalog import AUDIENCE_ALL, AUDIENCE_PUBLIC, render_catalog
+from .scoring import score_attempt
+from .attempts import answer_order, load_attempt
+from .result_summary import build_summary, build_summary_from_details, summary_rows
+from .score_stats import AUDIENCE_CANDIDATE, AUDIENCE_USER, percentile as score_percentile, record_score
+# Очередь ИИ-отчетов
+from .report_jobs import enqueue_report, claim_result_job, complete_claimed_job, release_claimed_job, UNAVAILABLE_TEXT
+from . import report_cache
+from .ai_service import generation_stats, model_registry, stream_test_report
+from . import request_metrics
+from .report_batch import backfill_jobs, requeue_results
 
 logger = logging.getLogger(__name__)
 
@@ -39,29 +60,27 @@ def safe_print(*args, **kwargs):
                 safe_args.append(arg)
         print(*safe_args, **kwargs)
 @csrf_exempt
-async def telegram_webhook(request):
+def telegram_webhook(request):
     """
     Обработчик вебхуков от Telegram.
+    Обновление ставится в очередь бота, ответ уходит сразу - не дожидаясь хендлеров.
     """
     if request.method == "POST":
         try:
-            # 1. Получаем токен
-            token = os.getenv('TELEGRAM_TOKEN')
-            if not token:
+            # 1. Проверяем токен
+            if not os.getenv('TELEGRAM_TOKEN'):
                 return JsonResponse({"error": "Token not found"}, status=500)
 
-            # 2. Создаем бота ТОЛЬКО на время этого запроса
-            # Использование 'async with' гарантирует, что сессия закроется правильно
-            async with Bot(token=token) as bot:
-                # 3. Читаем данные от Телеграм
-                data = json.loads(request.body)
-                update = Update.model_validate(data)
-                
-                # 4. Передаем обновление в диспетчер
-                # feed_update сам найдет нужный хендлер в telegram_bot.py
-                await dp.feed_update(bot, update)
-            
-            return JsonResponse({"status": "ok"})
+            # 2. Читаем данные от Телеграм
+            data = json.loads(request.body)
+            update = Update.model_validate(data)
+
+            # 3. Ставим в очередь долгоживущего бота этого процесса
+            status = bot_runtime.enqueue(update)
+            if status in (QUEUE_FULL, LOOP_BUSY):
+                # Telegram повторит доставку позже
+                return JsonResponse({"status": status}, status=503)
+            return JsonResponse({"status": status})
             
         except Exception as e:
             # Логируем ошибку, чтобы видеть её в Render Logs
@@ -71,6 +90,13 @@ async def telegram_webhook(request):
             
     return HttpResponse("Bot is active. Use POST to send updates.")
 
+def _locked_test_id(user):
+    """Тест, выбранный на бесплатном тарифе (из уже загруженного профиля)."""
+    try:
+        return user.profile.locked_test_id
+    except UserProfile.DoesNotExist:
+        return None
+
 # --- 1. ГЛАВНАЯ (HOME) ---
 def home(request):
     user_plan = 'guest'
@@ -83,30 +109,33 @@ def home(request):
         except:
             user_plan = 'free' # Если профиль не найден
             
-        # Логика Free: ищем "выбранный" тест
+        # Логика Free: "выбранный" тест хранится прямо в профиле
         if user_plan == 'free':
-            first_result = UserTestResult.objects.filter(user=request.user).order_by('date_taken').first()
-            if first_result:
-                locked_test_id = first_result.test.id
+            locked_test_id = _locked_test_id(request.user)
     
-    # Фильтруем тесты в зависимости от тарифа пользователя
-    # Тесты для рекрутеров видны только пользователям с тарифом 'hr' или суперпользователям
-    if request.user.is_authenticated and (user_plan == 'hr' or request.user.is_superuser):
-        # Рекрутеры видят все тесты
-        tests = Test.objects.all()
-    else:
-        # Обычные пользователи видят только тесты для пользователей или для всех
-        tests = Test.objects.exclude(test_audience='recruiter')
+    # Гостю каталог не показываем - главная для него без запросов к БД
+    catalog = None
+    if request.user.is_authenticated:
+        # Тесты для рекрутеров видны только пользователям с тарифом 'hr' или суперпользователям
+        is_recruiter = user_plan == 'hr' or request.user.is_superuser
+        catalog = render_catalog(
+            AUDIENCE_ALL if is_recruiter else AUDIENCE_PUBLIC,
+            full_access=user_plan in ('pro', 'hr') or request.user.is_superuser,
+            locked_test_id=locked_test_id,
+        )
 
     return render(request, 'home.html', {
-        'tests': tests,
+        'catalog': catalog,
         'user_plan': user_plan,
         'locked_test_id': locked_test_id
     })
 
 # --- 2. ЛОГИКА ТЕСТА (Единая функция) ---
 def test_detail(request, test_id):
-    test = get_object_or_404(Test, pk=test_id)
+    # Тест со всеми вопросами и ответами берем из кеша процесса (без запросов к БД)
+    test = get_test_blueprint(test_id)
+    if test is None:
+        raise Http404("Test not found")
     
     # === 0. ПРОВЕРКА ДОСТУПА К ТЕСТУ ДЛЯ РЕКРУТЕРОВ ===
     # Если тест предназначен только для рекрутеров, проверяем доступ
@@ -138,10 +167,9 @@ def test_detail(request, test_id):
 
         # Если FREE: проверяем, тот ли это тест
         if plan == 'free':
-            first_result = UserTestResult.objects.filter(user=request.user).order_by('date_taken').first()
+            locked_test_id = _locked_test_id(request.user)
             
-            if first_result:
-                locked_test_id = first_result.test.id
+            if locked_test_id:
                 # Если пытаемся открыть НЕ тот тест, который выбрали первым
                 if test.id != locked_test_id:
                     return render(request, 'subscription_required.html', {
@@ -150,106 +178,72 @@ def test_detail(request, test_id):
                     })
     # ==============================
     
-    # Ключи сессии для хранения состояния
-    session_key_order = f'test_{test_id}_order'
-    session_key_index = f'test_{test_id}_index'
-    session_key_answers = f'test_{test_id}_answers'
-    session_key_locked = f'test_{test_id}_locked'
-
-    # 1. ИНИЦИАЛИЗАЦИЯ (Если пользователь зашел первый раз)
-    if session_key_order not in request.session:
-        # Получаем все ID вопросов
-        all_q = list(test.questions.values_list('id', flat=True))
-        
-        # Перемешиваем
-        random.shuffle(all_q)
-        
-        # Обрезаем, если в настройках теста задано ограничение количества
-        if test.questions_count > 0 and len(all_q) > test.questions_count:
-            all_q = all_q[:test.questions_count]
-            
-        # Сохраняем в сессию
-        request.session[session_key_order] = all_q
-        request.session[session_key_index] = 0
-        request.session[session_key_answers] = {}
-        request.session[session_key_locked] = []
-        request.session.modified = True
+    # 1. СОСТОЯНИЕ ПРОХОЖДЕНИЯ (создается при первом заходе, см. attempts.py)
+    attempt = load_attempt(request, test)
 
     # 2. ЗАГРУЖАЕМ ТЕКУЩЕЕ СОСТОЯНИЕ
-    question_ids = request.session[session_key_order]
-    current_index = request.session[session_key_index]
-    saved_answers = request.session[session_key_answers]
-    locked_steps = request.session[session_key_locked]
+    question_ids = attempt.question_ids
+    current_index = attempt.current_index
 
     # 3. ОБРАБОТКА ОТВЕТОВ (Метод POST)
-    if request.method == 'POST':
+    if request.method == 'POST' and current_index < len(question_ids):
         action = request.POST.get('action')
         
-        # Сохраняем выбранный ответ
+        # Сохраняем выбранный ответ (только вариант текущего вопроса)
         current_q_id = question_ids[current_index]
+        current_q_obj = test.questions.get(current_q_id)
         selected_ans_id = request.POST.get('selected_answer')
         
-        if selected_ans_id:
-            saved_answers[str(current_q_id)] = int(selected_ans_id)
-            request.session[session_key_answers] = saved_answers
+        if selected_ans_id and selected_ans_id.isdigit():
+            attempt.set_answer(current_index, int(selected_ans_id))
         
         # Логика блокировки возврата назад (для вопросов на память)
-        # Получаем объект вопроса, чтобы проверить exposure_time
-        try:
-            current_q_obj = Question.objects.get(pk=current_q_id)
-            if current_q_obj.exposure_time > 0:
-                if current_index not in locked_steps:
-                    locked_steps.append(current_index)
-                    request.session[session_key_locked] = locked_steps
-        except Question.DoesNotExist:
-            pass # Если вопроса нет, пропускаем логику блокировки
+        if current_q_obj and current_q_obj.exposure_time > 0:
+            attempt.lock(current_index)
         
         # Навигация
         if action == 'next':
             if current_index < len(question_ids) - 1:
-                request.session[session_key_index] = current_index + 1
+                attempt.move_to(current_index + 1)
             else:
                 # Это был последний вопрос
-                return finish_test(request, test, question_ids, saved_answers)
+                return finish_test(request, test, question_ids, attempt.saved_answers(), attempt)
                 
         elif action == 'prev':
             prev_index = current_index - 1
             # Разрешаем назад, только если шаг не заблокирован
-            if prev_index >= 0 and prev_index not in locked_steps:
-                request.session[session_key_index] = prev_index
+            if prev_index >= 0 and not attempt.is_locked(prev_index):
+                attempt.move_to(prev_index)
 
         elif action == 'finish':
-            return finish_test(request, test, question_ids, saved_answers)
+            return finish_test(request, test, question_ids, attempt.saved_answers(), attempt)
 
-        request.session.modified = True
+        # Один UPDATE только изменившихся колонок
+        attempt.save()
         return redirect('test_detail', test_id=test_id)
 
     # 4. ПОДГОТОВКА К ОТОБРАЖЕНИЮ (Метод GET)
     
     # Проверка на выход за границы (на всякий случай)
     if current_index >= len(question_ids):
-        return finish_test(request, test, question_ids, saved_answers)
+        return finish_test(request, test, question_ids, attempt.saved_answers(), attempt)
 
     current_q_id = question_ids[current_index]
     
-    # Пытаемся получить вопрос из БД
-    try:
-        current_question = Question.objects.get(pk=current_q_id)
-    except Question.DoesNotExist:
+    current_question = test.questions.get(current_q_id)
+    if current_question is None:
         # Если вопрос удалили из базы во время прохождения теста - сброс
-        if session_key_order in request.session:
-            del request.session[session_key_order]
+        attempt.delete()
         return redirect('test_detail', test_id=test_id)
 
-    current_answer_id = saved_answers.get(str(current_q_id))
+    current_answer_id = attempt.answer_for(current_index)
     
     # Можно ли вернуться назад?
-    can_go_back = (current_index > 0) and ((current_index - 1) not in locked_steps)
+    can_go_back = (current_index > 0) and not attempt.is_locked(current_index - 1)
     is_last = (current_index == len(question_ids) - 1)
 
-    # Получаем и перемешиваем варианты ответов
-    answers_list = list(current_question.answers.all())
-    random.shuffle(answers_list)
+    # Варианты ответов в порядке, выведенном из seed попытки (не меняется при обновлении)
+    answers_list = answer_order(current_question, attempt.seed)
 
     return render(request, 'test_detail.html', {
         'test': test,
@@ -263,87 +257,17 @@ def test_detail(request, test_id):
     })
 
 # --- 3. ФИНАЛИЗАЦИЯ ТЕСТА ---
-def finish_test(request, test, question_ids, saved_answers):
-    score = 0
-    category_stats = {}
-    
+def finish_test(request, test, question_ids, saved_answers, attempt=None):
     user = request.user if request.user.is_authenticated else None
-    
-    # Создаем запись результата
-    result_obj = UserTestResult.objects.create(user=user, test=test, score=0)
-    
-    # 1. ОПТИМИЗАЦИЯ: Загружаем вопросы массово
-    questions_map = Question.objects.in_bulk(question_ids)
-    user_answers_to_create = []
-    
-    # Переменная для определения типа теста
-    has_psychology_questions = False
-
-    for q_id in question_ids:
-        question = questions_map.get(q_id)
-        if not question:
-            continue
-
-        # Собираем статистику для определения типа теста
-        cat_code = question.category.lower() if question.category else ""
-        if 'psychology' in cat_code or 'психология' in cat_code:
-            has_psychology_questions = True
-
-        ans_id = saved_answers.get(str(q_id))
-        selected_answer = None
-        is_correct = False
-        
-        if ans_id:
-            selected_answer = Answer.objects.filter(pk=ans_id).first()
-            if selected_answer and selected_answer.is_correct:
-                is_correct = True
-                score += 1
-                # Для статистики берем красивое название категории
-                cat_display = question.get_category_display()
-                category_stats[cat_display] = category_stats.get(cat_display, 0) + 1
-        
-        user_answers_to_create.append(UserAnswer(
-            result=result_obj,
-            question=question,
-            selected_answer=selected_answer,
-            is_correct=is_correct
-        ))
-
-    # ОПРЕДЕЛЯЕМ ТИП ТЕСТА
-    test_type = 'iq' # По умолчанию
-    # Если в тесте есть вопросы категории psychology ИЛИ в названии теста есть "Психология"
-    if has_psychology_questions or 'psychology' in test.title_en.lower() or 'психология' in test.title_ru.lower():
-        test_type = 'psychology'
-
-    # Для психологических тестов собираем детальную информацию об ответах ДО сохранения
-    detailed_answers = None
-    if test_type == 'psychology':
-        detailed_answers = []
-        # Загружаем все правильные ответы заранее для оптимизации
-        all_questions_ids = [ua.question.id for ua in user_answers_to_create]
-        correct_answers_map = {
-            ans.question_id: ans 
-            for ans in Answer.objects.filter(question_id__in=all_questions_ids, is_correct=True)
-        }
-        
-        for user_answer_obj in user_answers_to_create:
-            question = user_answer_obj.question
-            selected_answer = user_answer_obj.selected_answer
-            correct_answer = correct_answers_map.get(question.id)
-            
-            detailed_answers.append({
-                'question_text': question.text,
-                'selected_answer_text': selected_answer.text if selected_answer else 'Не отвечено',
-                'correct_answer_text': correct_answer.text if correct_answer else 'Не определено',
-                'is_correct': user_answer_obj.is_correct
-            })
 
-    # Сохраняем ответы
-    if user_answers_to_create:
-        UserAnswer.objects.bulk_create(user_answers_to_create)
+    # 1. Считаем результат в памяти по чертежу теста (без запросов на каждый ответ)
+    scored = score_attempt(test, question_ids, saved_answers)
+    score = scored.score
+    category_stats = scored.category_stats
+    test_type = scored.test_type
+    # Для психологических тестов - детальная информация об ответах
+    detailed_answers = scored.detailed_answers
 
-    result_obj.score = score
-    
     # Определяем, для кого делается анализ
     # Если тест проходит через приглашение (кандидат) - анализ для рекрутера
     # Если тест проходит обычный пользователь - анализ для пользователя
@@ -363,75 +287,51 @@ def finish_test(request, test, question_ids, saved_answers):
         else:
             analysis_for = 'user'  # Обычный пользователь проходит тест
     
-    # Генерируем отчет с учетом типа
     current_lang = get_language()
+    # Для процентилей кандидаты сравниваются с кандидатами, пользователи - со всеми
+    audience = AUDIENCE_CANDIDATE if is_candidate_test else AUDIENCE_USER
     username_for_ai = user.username if user else "Candidate"
-    
-    try:
-        # Отладочная информация
-        safe_print(f"[DEBUG] test_type={test_type}, analysis_for={analysis_for}, is_candidate={is_candidate_test}, detailed_answers count={len(detailed_answers) if detailed_answers else 0}, total_questions={len(question_ids)}")
-        
-        # Передаем test_type, analysis_for и детальную информацию об ответах в функцию
-        analysis_result = generate_test_report(
-            username_for_ai, 
-            category_stats, 
-            score, 
-            test_type=test_type, 
+
+    # 2. Сохраняем результат, все ответы (одним bulk_create) и задачу на ИИ-анализ.
+    # Анализ генерируется в фоне (run_report_workers), чтобы кандидат
+    # не ждал ответа Gemini на последнем клике
+    safe_print(f"[DEBUG] test_type={test_type}, analysis_for={analysis_for}, is_candidate={is_candidate_test}, detailed_answers count={len(detailed_answers) if detailed_answers else 0}, total_questions={len(question_ids)}")
+    with transaction.atomic():
+        # test - чертеж из кеша, поэтому передаем только id
+        result_obj = UserTestResult.objects.create(
+            user=user, test_id=test.id, score=score,
+            # Сводка для страницы результата пишется один раз здесь
+            summary=build_summary(test, scored.rows),
+            language=current_lang or '', audience=audience,
+        )
+        user_answers_to_create = scored.build_user_answers(result_obj)
+        if user_answers_to_create:
+            UserAnswer.objects.bulk_create(user_answers_to_create)
+
+        # Первый результат выбирает тест для бесплатного тарифа. Условный UPDATE:
+        # при параллельных завершениях выигрывает только первый
+        if user and _locked_test_id(user) is None:
+            UserProfile.objects.filter(user=user, locked_test__isnull=True).update(locked_test_id=test.id)
+
+        # Попытка завершена - ее состояние больше не нужно
+        if attempt is not None:
+            attempt.delete()
+
+        enqueue_report(
+            result_obj,
+            user_name=username_for_ai,
+            category_stats=category_stats,
+            total_score=score,
+            test_type=test_type,
             language=current_lang,
             detailed_answers=detailed_answers,
             total_questions=len(question_ids),
-            analysis_for=analysis_for  # Новый параметр: 'recruiter' или 'user'
+            analysis_for=analysis_for,  # 'recruiter' или 'user'
         )
-        
-        if analysis_result:
-            result_obj.ai_analysis = analysis_result
-            safe_print(f"[OK] AI Analysis generated successfully, length: {len(analysis_result)}")
-        else:
-            safe_print(f"[WARNING] AI Analysis returned empty, using fallback")
-            result_obj.ai_analysis = "Analysis currently unavailable."
-        
-    except Exception as e:
-        safe_print(f"[ERROR] AI Error: {e}")
-        import traceback
-        traceback.print_exc()
-        result_obj.ai_analysis = f"Analysis currently unavailable. Error: {str(e)[:100]}"
-    
-    # Сохраняем результат безопасно, используя update() для оптимизации памяти
-    try:
-        # Используем update() вместо save() для больших текстов - это более эффективно
-        from django.db import transaction
-        with transaction.atomic():
-            UserTestResult.objects.filter(pk=result_obj.pk).update(
-                score=result_obj.score,
-                ai_analysis=result_obj.ai_analysis
-            )
-        safe_print(f"[OK] Result saved successfully (ID: {result_obj.id})")
-    except Exception as e:
-        safe_print(f"[ERROR] Error saving result: {e}")
-        import traceback
-        traceback.print_exc()
-        # Пробуем сохранить без AI анализа
-        try:
-            with transaction.atomic():
-                UserTestResult.objects.filter(pk=result_obj.pk).update(
-                    score=result_obj.score,
-                    ai_analysis=None
-                )
-            safe_print(f"[WARNING] Result saved without AI analysis")
-        except Exception as e2:
-            safe_print(f"[CRITICAL] Could not save result at all: {e2}")
-            # В критическом случае удаляем объект, чтобы не было мусора в БД
-            try:
-                result_obj.delete()
-            except:
-                pass
-            raise
-    
-    # Очистка сессии
-    keys = [f'test_{test.id}_order', f'test_{test.id}_index', f'test_{test.id}_answers', f'test_{test.id}_locked']
-    for k in keys:
-        if k in request.session:
-            del request.session[k]
+
+        # Последним запросом: строка корзины балла блокируется до конца транзакции
+        record_score(test.id, score, language=current_lang or '', audience=audience)
+    safe_print(f"[OK] Result saved successfully (ID: {result_obj.id}), AI report queued")
 
     # Обработка приглашений (используем уже определенный invite_id выше)
     if invite_id:
@@ -448,34 +348,186 @@ def finish_test(request, test, question_ids, saved_answers):
     return redirect('result_detail', result_id=result_obj.id)
 
 # --- 4. ПРОСМОТР РЕЗУЛЬТАТА ---
-def result_detail(request, result_id):
-    # 1. Сначала просто ищем результат по ID (независимо от того, чей он)
-    result = get_object_or_404(UserTestResult, pk=result_id)
-    
-    # 2. Проверяем права доступа
+def can_view_result(request, result):
     # Разрешаем просмотр, если:
     # - Пользователь владелец результата (result.user == request.user)
     # - ИЛИ Пользователь - сотрудник/админ (request.user.is_staff)
     # - ИЛИ Результат анонимный (result.user is None) — чтобы вы могли видеть свои тесты при разработке
-    
-    is_owner = (request.user.is_authenticated and result.user == request.user)
+    is_owner = (request.user.is_authenticated and result.user_id == request.user.id)
     is_staff = (request.user.is_authenticated and request.user.is_staff)
-    is_anonymous_result = (result.user is None)
+    is_anonymous_result = (result.user_id is None)
+    return is_owner or is_staff or is_anonymous_result
+
+
+def _result_etag(request, result, percentile=None):
+    """
+    ETag страницы результата. Сам результат не меняется, поэтому страница
+    зависит только от зрителя (шапка, CSRF-токен), языка, готовности ИИ-анализа
+    и процентиля (он сдвигается по мере того, как тест проходят другие).
+    """
+    analysis = hashlib.md5(result.ai_analysis.encode('utf-8')).hexdigest() if result.ai_analysis else 'pending'
+    # get_token каждый раз маскирует токен по-новому, поэтому берем сам секрет
+    get_token(request)
+    csrf_secret = request.META.get('CSRF_COOKIE', '')
+    parts = [result.pk, request.user.pk, get_language(), csrf_secret, analysis, percentile]
+    return '"%s"' % hashlib.md5(':'.join(map(str, parts)).encode('utf-8')).hexdigest()
+
+
+def _set_result_cache_headers(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    # Браузер хранит страницу у себя, но каждый раз переспрашивает (и получает 304)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
-    if not (is_owner or is_staff or is_anonymous_result):
+
+def result_detail(request, result_id):
+    # 1. Сначала просто ищем результат по ID (независимо от того, чей он)
+    result = get_object_or_404(UserTestResult, pk=result_id)
+    
+    # 2. Проверяем права доступа
+    if not can_view_result(request, result):
         # Если ни одно условие не совпало — запрещаем доступ
         return render(request, 'hr/error.html', {'message': 'У вас нет прав для просмотра этого результата.'})
 
-    user_answers = result.details.all()
-    
-    return render(request, 'test_result.html', {
-        'test': result.test,
+    # 3. Повторный просмотр - 304 без рендера
+    # Процентиль - по гистограмме баллов в памяти процесса, без прохода по результатам
+    percentile = score_percentile(result.test_id, result.score)
+    etag = _result_etag(request, result, percentile)
+    # Пока анализ генерируется, страница еще изменится. Процентиль тоже меняется,
+    # поэтому с ним проверяем только ETag
+    last_modified = int(result.date_taken.timestamp()) if result.ai_analysis and percentile is None else None
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return _set_result_cache_headers(not_modified, etag, last_modified)
+
+    summary = result.summary
+    if summary is None:
+        # Старый результат без сводки (до backfill_result_summaries) - собираем один раз
+        details = result.details.select_related('question', 'selected_answer').order_by('id')
+        summary = build_summary_from_details(details)
+        UserTestResult.objects.filter(pk=result.pk).update(summary=summary)
+
+    user_answers = summary_rows(summary)
+    category_labels = dict(CATEGORY_CHOICES)
+    categories = [
+        {'name': category_labels.get(code, code), 'correct': tally[0], 'total': tally[1]}
+        for code, tally in summary['categories'].items()
+    ]
+
+    response = render(request, 'test_result.html', {
+        'result': result,
+        # Тест берем из кеша чертежей - без запроса к БД
+        'test': get_test_blueprint(result.test_id),
         'score': result.score,
-        'total': user_answers.count(),
+        'total': len(user_answers),
+        'percentile': percentile,
         'ai_analysis': result.ai_analysis,
+        # Анализ еще генерируется в фоне - страница дождется его сама
+        'analysis_pending': not result.ai_analysis,
         'user_answers': user_answers,
+        'categories': categories,
         'is_old_result': True 
     })
+    return _set_result_cache_headers(response, etag, last_modified)
+
+
+def result_analysis(request, result_id):
+    """JSON со статусом ИИ-анализа (страница результата опрашивает его, пока отчет не готов)."""
+    result = get_object_or_404(UserTestResult, pk=result_id)
+    if not can_view_result(request, result):
+        return JsonResponse({'error': 'forbidden'}, status=403)
+
+    if result.ai_analysis:
+        return JsonResponse({'status': 'done', 'ai_analysis': result.ai_analysis})
+
+    job = ReportJob.objects.filter(result=result).values('status').first()
+    # Нет задачи - это старый результат без анализа, ждать нечего
+    status = job['status'] if job else 'missing'
+    return JsonResponse({'status': status, 'ai_analysis': None})
+
+
+def _sse(event, text=''):
+    # JSON экранирует переводы строк, которые иначе разорвали бы событие
+    return f"event: {event}\ndata: {json.dumps({'text': text}, ensure_ascii=False)}\n\n"
+
+
+def _stream_job_events(job):
+    """События SSE с кусками анализа; итоговый текст сохраняется один раз в конце."""
+    parts = []
+    error = 'client disconnected'
+    saved = False
+    try:
+        for chunk in stream_test_report(**job.payload):
+            parts.append(chunk)
+            yield _sse('chunk', chunk)
+        saved = complete_claimed_job(job, ''.join(parts) or UNAVAILABLE_TEXT)
+        yield _sse('done')
+    except Exception as e:
+        error = f"{type(e).__name__}: {str(e)[:500]}"
+        logger.error(f"AI analysis stream failed for result {job.result_id}: {error}")
+        # Страница перейдет на опрос result_analysis, отчет допишет воркер
+        yield _sse('error')
+    finally:
+        if not saved:
+            release_claimed_job(job, error)
+
+
+def result_analysis_stream(request, result_id):
+    """
+    Server-sent events: ИИ-анализ появляется на странице результата по мере генерации.
+    Если отчет уже генерирует воркер - событие 'pending', страница опрашивает result_analysis.
+    """
+    result = get_object_or_404(UserTestResult.objects.only('id', 'user_id', 'ai_analysis'), pk=result_id)
+    if not can_view_result(request, result):
+        return JsonResponse({'error': 'forbidden'}, status=403)
+
+    if result.ai_analysis:
+        events = iter([_sse('chunk', result.ai_analysis), _sse('done')])
+    else:
+        job = claim_result_job(result.id)
+        events = _stream_job_events(job) if job else iter([_sse('pending')])
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # nginx не должен копить поток в буфере
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+HR_PAGE_SIZE = 50
+# Максимум анализов, которые рекрутер перезапускает одним нажатием
+HR_REGENERATE_LIMIT = 500
+_ZERO_UUID = uuid.UUID(int=0)
+
+
+def _make_invitation_cursor(invite):
+    # Курсор: микросекунды created_at + id (id различает приглашения с одинаковым временем)
+    delta = invite.created_at - datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return f"{micros}_{invite.id}"
+
+
+def _parse_invitation_cursor(raw):
+    try:
+        micros, invite_id = (int(part) for part in raw.split('_', 1))
+        return datetime(1970, 1, 1, tzinfo=dt_timezone.utc) + timedelta(microseconds=micros), invite_id
+    except (ValueError, OverflowError):
+        # Испорченный курсор - просто первая страница
+        return None
+
+
+def _invitation_counts(recruiter_id):
+    """Количество приглашений по статусам (кеш сбрасывается сигналом при изменениях)."""
+    key = invitation_counts_key(recruiter_id)
+    counts = caches['shared'].get(key)
+    if counts is None:
+        counts = TestInvitation.objects.filter(recruiter_id=recruiter_id).aggregate(
+            total=Count('id'),
+            completed=Count('id', filter=Q(completed=True)),
+        )
+        counts['pending'] = counts['total'] - counts['completed']
+        caches['shared'].set(key, counts, 300)
+    return counts
 
 # --- 5. HR DASHBOARD (Панель рекрутера) ---
 # quiz/views.py
@@ -484,9 +536,8 @@ def result_detail(request, result_id):
 def hr_dashboard(request):
     # 1. Получаем план подписки
     try:
-        # Пытаемся получить профиль
-        profile = UserProfile.objects.get(user=request.user)
-        plan = profile.plan
+        # Пытаемся получить профиль (он же потом используется в шапке сайта)
+        plan = request.user.profile.plan
     except UserProfile.DoesNotExist:
         # Если профиля вдруг нет — считаем халявщиком
         plan = 'free'
@@ -505,11 +556,9 @@ def hr_dashboard(request):
         })
 
     # 3. Если проверка пройдена — показываем дашборд
-    invitations = TestInvitation.objects.filter(recruiter=request.user).order_by('-created_at')
-    
-    # Чтобы в выпадающем списке не было ошибок при создании приглашения
-    tests = Test.objects.all() 
-    
+    if request.method == 'POST' and request.POST.get('action') == 'regenerate':
+        return _regenerate_analyses(request)
+
     if request.method == 'POST':
         test_id = request.POST.get('test_id')
         email = request.POST.get('candidate_email')
@@ -519,15 +568,93 @@ def hr_dashboard(request):
             TestInvitation.objects.create(
                 recruiter=request.user,
                 test=test,
-                candidate_email=email
+                # Храним в нижнем регистре - так поиск по началу email работает по индексу
+                candidate_email=email.strip().lower()
             )
             return redirect('hr_dashboard') # Перезагрузка страницы после создания
+
+    invitations = TestInvitation.objects.filter(recruiter=request.user)
+
+    # Фильтры (все поддержаны индексами TestInvitation)
+    status = request.GET.get('status', '')
+    if status == 'completed':
+        invitations = invitations.filter(completed=True)
+    elif status == 'pending':
+        invitations = invitations.filter(completed=False)
+
+    test_filter = request.GET.get('test', '')
+    if test_filter.isdigit():
+        invitations = invitations.filter(test_id=int(test_filter))
+
+    email_prefix = request.GET.get('email', '').strip().lower()
+    if email_prefix:
+        invitations = invitations.filter(candidate_email__startswith=email_prefix)
+
+    # Keyset-пагинация: вместо OFFSET продолжаем с последней показанной строки,
+    # поэтому любая страница стоит одинаково, сколько бы приглашений ни было
+    cursor = _parse_invitation_cursor(request.GET.get('after', ''))
+    if cursor:
+        created_at, invite_id = cursor
+        invitations = invitations.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=invite_id)
+        )
+
+    page = list(
+        invitations.select_related('test').annotate(result_score=F('result__score'))
+        .order_by('-created_at', '-id')[:HR_PAGE_SIZE + 1]
+    )
+    next_cursor = None
+    if len(page) > HR_PAGE_SIZE:
+        page = page[:HR_PAGE_SIZE]
+        next_cursor = _make_invitation_cursor(page[-1])
+    # Место кандидата среди всех кандидатов теста (распределение - один запрос на тест)
+    for invite in page:
+        invite.percentile = score_percentile(invite.test_id, invite.result_score, audience=AUDIENCE_CANDIDATE)
+
+    # Чтобы в выпадающем списке не было ошибок при создании приглашения
+    tests = Test.objects.all() 
+
+    # Ссылки строим из готовых префиксов, а не через reverse() в каждой строке
+    invite_prefix = request.build_absolute_uri(reverse('accept_invitation', args=[_ZERO_UUID])).rsplit(str(_ZERO_UUID), 1)[0]
+    result_prefix = reverse('result_detail', args=[0]).rsplit('0', 1)[0]
+
+    filters = {k: v for k, v in (('status', status), ('test', test_filter), ('email', email_prefix)) if v}
     
     return render(request, 'hr/dashboard.html', {
-        'invitations': invitations,
+        'invitations': page,
         'tests': tests,
+        'counts': _invitation_counts(request.user.id),
+        'filters': filters,
+        'next_query': urlencode({**filters, 'after': next_cursor}) if next_cursor else '',
+        'is_first_page': cursor is None,
+        'invite_prefix': invite_prefix,
+        'result_prefix': result_prefix,
     })
 
+
+def _regenerate_analyses(request):
+    """
+    Заново ставит в очередь ИИ-анализы пройденных приглашений по текущему фильтру
+    панели. Генерируют их воркеры run_report_workers (с лимитом частоты провайдера).
+    """
+    invitations = TestInvitation.objects.filter(recruiter=request.user, completed=True, result__isnull=False)
+    test_filter = request.POST.get('test', '')
+    if test_filter.isdigit():
+        invitations = invitations.filter(test_id=int(test_filter))
+    email_prefix = request.POST.get('email', '').strip().lower()
+    if email_prefix:
+        invitations = invitations.filter(candidate_email__startswith=email_prefix)
+
+    result_ids = list(invitations.order_by('-created_at').values_list('result_id', flat=True)[:HR_REGENERATE_LIMIT])
+    # У результатов, сохраненных до очереди отчетов, задачи еще нет
+    backfill_jobs(result_ids)
+    queued = requeue_results(result_ids)
+    messages.success(request, _('Анализов поставлено в очередь: %(count)s') % {'count': queued})
+
+    filters = {k: v for k, v in (('status', 'completed'), ('test', test_filter), ('email', email_prefix)) if v}
+    return redirect(f"{reverse('hr_dashboard')}?{urlencode(filters)}")
+
+
 # --- 6. ПРИНЯТИЕ ПРИГЛАШЕНИЯ ---
 def accept_invitation(request, uuid):
     invite = get_object_or_404(TestInvitation, uuid=uuid)
@@ -563,4 +690,25 @@ def upgrade_profile(request, plan_type):
     
     if plan_type == 'hr':
         return redirect('hr_dashboard')
-    return redirect('home')
\ No newline at end of file
+    return redirect('home')
+
+# --- 7. СЛУЖЕБНАЯ СТАТИСТИКА ИИ (только для staff) ---
+@staff_member_required
+def ai_stats(request):
+    return JsonResponse({
+        'report_cache': report_cache.stats(),
+        'model': model_registry.stats(),
+        'generation': generation_stats(),
+    })
+
+# Очереди Telegram-бота этого процесса (только для staff)
+@staff_member_required
+def bot_stats(request):
+    return JsonResponse({'bot': bot_runtime.stats()})
+
+# Гистограммы времени и SQL по url_name в этом процессе (только для staff)
+@staff_member_required
+def request_stats(request):
+    if request.method == 'POST' and request.POST.get('reset'):
+        request_metrics.reset()
+    return JsonResponse({'requests': request_metrics.stats()})
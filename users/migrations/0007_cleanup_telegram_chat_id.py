@@ -0,0 +1,33 @@
+# Generated by Django 5.2.8 on 2026-10-18 22:10
+
+from django.db import migrations
+from django.db.models import Count, F
+
+
+def cleanup_chat_ids(apps, schema_editor):
+    # Перед уникальным индексом: пустые строки -> NULL, а если один чат
+    # привязан к нескольким аккаунтам, оставляем его последнему вошедшему
+    CustomUser = apps.get_model('users', 'CustomUser')
+    CustomUser.objects.filter(telegram_chat_id='').update(telegram_chat_id=None)
+    duplicated = (
+        CustomUser.objects.filter(telegram_chat_id__isnull=False)
+        .values('telegram_chat_id').annotate(n=Count('id')).filter(n__gt=1)
+        .values_list('telegram_chat_id', flat=True)
+    )
+    for chat_id in list(duplicated):
+        owners = list(
+            CustomUser.objects.filter(telegram_chat_id=chat_id)
+            .order_by(F('last_login').desc(nulls_last=True), '-id').values_list('id', flat=True)
+        )
+        CustomUser.objects.filter(id__in=owners[1:]).update(telegram_chat_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_alter_customuser_bot_category'),
+    ]
+
+    operations = [
+        migrations.RunPython(cleanup_chat_ids, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-18 21:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_cleanup_telegram_chat_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='customuser',
+            name='telegram_chat_id',
+            field=models.CharField(blank=True, max_length=50, null=True, unique=True, verbose_name='ID Телеграм чата'),
+        ),
+        migrations.AlterField(
+            model_name='customuser',
+            name='telegram_code',
+            field=models.CharField(blank=True, db_index=True, max_length=10, null=True, verbose_name='Код подключения'),
+        ),
+    ]
@@ -21,8 +21,9 @@ LANG_CHOICES = [
 class CustomUser(AbstractUser):
     iq_score = models.IntegerField(null=True, blank=True, verbose_name="IQ Результат")
     is_premium = models.BooleanField(default=False, verbose_name="Премиум аккаунт")
-    telegram_chat_id = models.CharField(max_length=50, blank=True, null=True, verbose_name="ID Телеграм чата")
-    telegram_code = models.CharField(max_length=10, blank=True, null=True, verbose_name="Код подключения")
+    # Один чат - один аккаунт; по этим полям бот ищет пользователя на каждом обновлении
+    telegram_chat_id = models.CharField(max_length=50, blank=True, null=True, unique=True, verbose_name="ID Телеграм чата")
+    telegram_code = models.CharField(max_length=10, blank=True, null=True, db_index=True, verbose_name="Код подключения")
 
     # НОВОЕ ПОЛЕ: Настройка для бота
     bot_category = models.CharField(